@@ -0,0 +1,65 @@
+import { NextResponse } from 'next/server'
+import { streamPaymentService } from '../../../lib/paymentService'
+
+export const dynamic = 'force-dynamic'
+
+// Token required for exports (the route is disabled without it)
+const EXPORT_TOKEN = process.env.PAYMENT_EXPORT_TOKEN || ''
+
+const CONTENT_TYPES = {
+  ndjson: 'application/x-ndjson; charset=utf-8',
+  csv: 'text/csv; charset=utf-8'
+}
+
+// Stream transactions as NDJSON or CSV: ?format=csv&since=2026-01-01&until=2026-12-31&source=...&status=paid
+export async function GET(request) {
+  if (!EXPORT_TOKEN || request.headers.get('authorization') !== `Bearer ${EXPORT_TOKEN}`) {
+    return NextResponse.json({ error: 'Unauthorized' }, { status: 401 })
+  }
+
+  const params = request.nextUrl.searchParams
+  const format = params.get('format') || 'ndjson'
+  if (!CONTENT_TYPES[format]) {
+    return NextResponse.json({ error: `Unknown format: ${format}` }, { status: 400 })
+  }
+
+  const payload = { format }
+  for (const key of ['since', 'until', 'source', 'status']) {
+    if (params.get(key)) payload[key] = params.get(key)
+  }
+
+  const messages = streamPaymentService('export', payload)
+
+  // Pull-based: the next batch is only read from the service once the client took the previous one
+  const stream = new ReadableStream({
+    async pull(controller) {
+      try {
+        const { value: message, done } = await messages.next()
+        if (done || message.done) {
+          controller.close()
+        } else if (message.error) {
+          console.error('Export error:', message.error)
+          controller.error(new Error(message.error))
+        } else {
+          controller.enqueue(new Uint8Array(message.body))
+        }
+      } catch (error) {
+        console.error('Export error:', error)
+        controller.error(error)
+      }
+    },
+    async cancel() {
+      await messages.return()
+    }
+  })
+
+  const day = new Date().toISOString().slice(0, 10)
+  return new Response(stream, {
+    headers: {
+      'Content-Type': CONTENT_TYPES[format],
+      'Content-Disposition': `attachment; filename="transactions-${day}.${format}"`,
+      'Cache-Control': 'no-store',
+      'X-Accel-Buffering': 'no'
+    }
+  })
+}
@@ -0,0 +1,62 @@
+import { NextResponse } from 'next/server'
+import { callPaymentService } from '../../../../lib/paymentService'
+
+export const dynamic = 'force-dynamic'
+
+// How long to wait for the webhook before falling back to a Stripe lookup (ms)
+const STREAM_DEADLINE = parseInt(process.env.PAYMENT_STREAM_DEADLINE || '20000')
+
+// Server-sent events: push the final payment status as soon as the webhook lands
+export async function GET(request, { params }) {
+  const sessionId = params.sessionId
+
+  if (!sessionId) {
+    return NextResponse.json({ error: 'Session ID required' }, { status: 400 })
+  }
+
+  const encoder = new TextEncoder()
+  const abort = new AbortController()
+  let cancelled = false
+
+  const stream = new ReadableStream({
+    start(controller) {
+      const send = (event, data) => {
+        if (cancelled) return
+        controller.enqueue(encoder.encode(`event: ${event}\ndata: ${JSON.stringify(data)}\n\n`))
+      }
+
+      // Flush the headers right away so proxies open the stream
+      controller.enqueue(encoder.encode(': connected\n\n'))
+
+      // The service falls back to one Stripe lookup at the deadline, allow time for it
+      callPaymentService(
+        'watch',
+        { session_id: sessionId, timeout_ms: STREAM_DEADLINE },
+        { timeout: STREAM_DEADLINE + 15000, signal: abort.signal }
+      )
+        .then((result) => send(result.error ? 'error' : 'status', result))
+        .catch((error) => {
+          if (cancelled) return
+          console.error('Payment stream error:', error)
+          send('error', { error: 'Failed to check payment status' })
+        })
+        .finally(() => {
+          if (!cancelled) controller.close()
+        })
+    },
+    cancel() {
+      // Browser left the page before the status arrived: stop the watch, no Stripe lookup for nobody
+      cancelled = true
+      abort.abort()
+    }
+  })
+
+  return new Response(stream, {
+    headers: {
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache, no-transform',
+      'Connection': 'keep-alive',
+      'X-Accel-Buffering': 'no'
+    }
+  })
+}
@@ -0,0 +1,4 @@
+import catalog from '../../payment_service/catalog.json'
+
+// Prix affiché (euros) d'une pizza, lu dans le catalogue du service de paiement
+export const catalogPrice = (packageId) => catalog.packages[packageId].amount_cents / 100
@@ -0,0 +1,109 @@
+import net from 'net'
+
+// Socket of the Python payment service (see payment_service/)
+const SOCKET_PATH = process.env.PAYMENT_SERVICE_SOCKET || '/tmp/getyoursite-payments.sock'
+const REQUEST_TIMEOUT = parseInt(process.env.PAYMENT_SERVICE_TIMEOUT || '30000')
+
+// Frames: JSON header length and raw body length (uint32 big-endian), then both (see payment_service/protocol.py)
+const FRAME_PREFIX = 8
+
+function encodeFrame(message, body) {
+  const header = Buffer.from(JSON.stringify(message), 'utf8')
+  const raw = body ? Buffer.from(body) : Buffer.alloc(0)
+  const prefix = Buffer.alloc(FRAME_PREFIX)
+  prefix.writeUInt32BE(header.length, 0)
+  prefix.writeUInt32BE(raw.length, 4)
+  return Buffer.concat([prefix, header, raw])
+}
+
+// Returns a function fed with socket chunks that yields the complete messages received so far
+function frameDecoder() {
+  let pending = Buffer.alloc(0)
+  return (chunk) => {
+    pending = pending.length ? Buffer.concat([pending, chunk]) : chunk
+    const messages = []
+    while (pending.length >= FRAME_PREFIX) {
+      const headerEnd = FRAME_PREFIX + pending.readUInt32BE(0)
+      const end = headerEnd + pending.readUInt32BE(4)
+      if (pending.length < end) break
+      const message = JSON.parse(pending.subarray(FRAME_PREFIX, headerEnd).toString('utf8'))
+      if (end > headerEnd) message.body = pending.subarray(headerEnd, end)
+      messages.push(message)
+      pending = pending.subarray(end)
+    }
+    return messages
+  }
+}
+
+// Send one action to the long-lived payment service and resolve with its JSON response.
+// `body` (Buffer) travels raw next to the JSON payload, e.g. the webhook bytes covered by Stripe's signature.
+// Aborting `signal` closes the connection, which cancels a `watch` on the service side
+export function callPaymentService(action, payload, { timeout = REQUEST_TIMEOUT, body, signal } = {}) {
+  return new Promise((resolve, reject) => {
+    const socket = net.createConnection(SOCKET_PATH)
+    const decode = frameDecoder()
+    let settled = false
+
+    const finish = (error, result) => {
+      if (settled) return
+      settled = true
+      socket.destroy()
+      if (error) {
+        reject(error)
+      } else {
+        resolve(result)
+      }
+    }
+
+    socket.setTimeout(timeout, () => {
+      finish(new Error(`Payment service timeout after ${timeout}ms`))
+    })
+
+    if (signal) {
+      const abort = () => finish(new Error('Payment service call aborted'))
+      if (signal.aborted) return abort()
+      signal.addEventListener('abort', abort, { once: true })
+    }
+
+    socket.on('connect', () => {
+      socket.write(encodeFrame({ action, payload }, body))
+    })
+
+    socket.on('data', (chunk) => {
+      try {
+        const [message] = decode(chunk)
+        if (message) finish(null, message)
+      } catch (error) {
+        finish(error)
+      }
+    })
+
+    socket.on('error', (error) => finish(error))
+    socket.on('close', () => finish(new Error('Payment service closed the connection')))
+  })
+}
+
+// Send a streamed action (export) and yield each message until the final `done` or `error` one;
+// data messages carry their bytes in `body`
+export async function* streamPaymentService(action, payload, { timeout = REQUEST_TIMEOUT } = {}) {
+  const socket = net.createConnection(SOCKET_PATH)
+  socket.setTimeout(timeout, () => {
+    socket.destroy(new Error(`Payment service timeout after ${timeout}ms`))
+  })
+  socket.on('connect', () => {
+    socket.write(encodeFrame({ action, payload }))
+  })
+
+  const decode = frameDecoder()
+  try {
+    for await (const chunk of socket) {
+      for (const message of decode(chunk)) {
+        yield message
+        if (message.done || message.error) return
+      }
+    }
+    throw new Error('Payment service closed the connection')
+  } finally {
+    socket.destroy()
+  }
+}
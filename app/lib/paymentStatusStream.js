@@ -0,0 +1,22 @@
+// Wait for the final status of a checkout session pushed over SSE.
+// Rejects when the stream is unavailable so callers can fall back to polling.
+export function waitForPaymentStatus(sessionId) {
+  return new Promise((resolve, reject) => {
+    if (typeof EventSource === 'undefined') {
+      reject(new Error('EventSource not supported'))
+      return
+    }
+
+    const source = new EventSource(`/api/payments/stream/${sessionId}`)
+
+    source.addEventListener('status', (event) => {
+      source.close()
+      resolve(JSON.parse(event.data))
+    })
+
+    source.addEventListener('error', () => {
+      source.close()
+      reject(new Error('Payment status stream failed'))
+    })
+  })
+}
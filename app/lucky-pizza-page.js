@@ -23,6 +23,8 @@ import {
   Facebook,
   Twitter
 } from 'lucide-react'
+import { waitForPaymentStatus } from './lib/paymentStatusStream'
+import { catalogPrice } from './lib/catalog'
 
 // Composants UI modernes
 const Button = ({ children, className = "", variant = "default", size = "default", onClick, type, disabled, loading }) => {
@@ -128,7 +130,7 @@ export default function LuckyPizzaPage() {
       package_id: 'margherita',
       name: "Margherita Authentique",
       description: "Sauce tomate San Marzano, mozzarella di bufala, basilic frais, huile d'olive extra vierge",
-      price: 12.90,
+      price: catalogPrice('margherita'),
       image: "https://images.unsplash.com/photo-1713393281034-c7c9b046e1d3?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwxfHxwcm9mZXNzaW9uYWwlMjBwaXp6YXxlbnwwfHx8fDE3NTU3Nzc0Mzh8MA&ixlib=rb-4.1.0&q=85",
       popular: true
     },
@@ -137,7 +139,7 @@ export default function LuckyPizzaPage() {
       package_id: 'napoletana',
       name: "Napoletana Traditionelle",
       description: "Sauce tomate, mozzarella, anchois, olives noires, origan, ail",
-      price: 15.90,
+      price: catalogPrice('napoletana'),
       image: "https://images.pexels.com/photos/784636/pexels-photo-784636.jpeg"
     },
     {
@@ -145,7 +147,7 @@ export default function LuckyPizzaPage() {
       package_id: 'quattro_formaggi',
       name: "Quattro Formaggi Déluxe",
       description: "Mozzarella, gorgonzola DOP, parmesan vieilli 24 mois, chèvre de Lannilis",
-      price: 18.90,
+      price: catalogPrice('quattro_formaggi'),
       image: "https://images.pexels.com/photos/6969975/pexels-photo-6969975.jpeg"
     },
     {
@@ -153,7 +155,7 @@ export default function LuckyPizzaPage() {
       package_id: 'diavola',
       name: "Diavola Piccante",
       description: "Sauce tomate épicée, mozzarella, salami piquant, piment de Calabre, huile piquante",
-      price: 17.90,
+      price: catalogPrice('diavola'),
       image: "https://images.unsplash.com/photo-1689915972091-debe902f72fd?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwyfHxtb2Rlcm4lMjBwaXp6YSUyMHJlc3RhdXJhbnR8ZW58MHx8fHwxNzU1Nzc3NDI3fDA&ixlib=rb-4.1.0&q=85"
     },
     {
@@ -161,7 +163,7 @@ export default function LuckyPizzaPage() {
       package_id: 'vegetariana',
       name: "Végétarienne du Terroir",
       description: "Sauce tomate, mozzarella, légumes de saison locaux, herbes de Provence, pesto basilic",
-      price: 16.90,
+      price: catalogPrice('vegetariana'),
       image: "https://images.unsplash.com/photo-1573586698223-e9502ddf5b07?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwzfHxtb2Rlcm4lMjBwaXp6YSUyMHJlc3RhdXJhbnR8ZW58MHx8fHwxNzU1Nzc3NDI3fDA&ixlib=rb-4.1.0&q=85"
     },
     {
@@ -169,7 +171,7 @@ export default function LuckyPizzaPage() {
       package_id: 'prosciutto',
       name: "Prosciutto & Roquette",
       description: "Sauce tomate, mozzarella, prosciutto di Parma 18 mois, roquette fraîche, copeaux de parmesan",
-      price: 19.90,
+      price: catalogPrice('prosciutto'),
       image: "https://images.unsplash.com/photo-1713393281034-c7c9b046e1d3?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwxfHxwcm9mZXNzaW9uYWwlMjBwaXp6YXxlbnwwfHx8fDE3NTU3Nzc0Mzh8MA&ixlib=rb-4.1.0&q=85"
     }
   ]
@@ -211,8 +213,8 @@ export default function LuckyPizzaPage() {
     return cart.reduce((total, item) => total + item.quantity, 0)
   }
 
-  // Fonction de paiement
-  const handlePayment = async (packageId, pizzaName) => {
+  // Fonction de paiement : une seule session Stripe pour toutes les pizzas commandées
+  const handlePayment = async (items) => {
     setIsProcessingPayment(true)
     setPaymentStatus(null)
     
@@ -223,9 +225,8 @@ export default function LuckyPizzaPage() {
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({
-          package_id: packageId,
+          items: items.map(({ package_id, quantity }) => ({ package_id, quantity })),
           metadata: {
-            pizza_name: pizzaName,
             restaurant: 'Lucky Pizza Lannilis'
           }
         })
@@ -251,6 +252,25 @@ export default function LuckyPizzaPage() {
     }
   }
 
+  // Met à jour l'affichage; renvoie true si le statut est définitif
+  const applyPaymentStatus = (data) => {
+    if (data.payment_status === 'paid') {
+      setPaymentStatus({ 
+        type: 'success', 
+        message: 'Paiement réussi ! Merci pour votre commande.' 
+      })
+      setCart([]) // Vider le panier
+      return true
+    } else if (data.status === 'expired') {
+      setPaymentStatus({ 
+        type: 'error', 
+        message: 'Session de paiement expirée. Veuillez recommencer.' 
+      })
+      return true
+    }
+    return false
+  }
+
   // Polling du statut de paiement
   const pollPaymentStatus = async (sessionId, attempts = 0) => {
     const maxAttempts = 5
@@ -272,18 +292,7 @@ export default function LuckyPizzaPage() {
 
       const data = await response.json()
       
-      if (data.payment_status === 'paid') {
-        setPaymentStatus({ 
-          type: 'success', 
-          message: 'Paiement réussi ! Merci pour votre commande.' 
-        })
-        setCart([]) // Vider le panier
-        return
-      } else if (data.status === 'expired') {
-        setPaymentStatus({ 
-          type: 'error', 
-          message: 'Session de paiement expirée. Veuillez recommencer.' 
-        })
+      if (applyPaymentStatus(data)) {
         return
       }
 
@@ -310,7 +319,14 @@ export default function LuckyPizzaPage() {
         type: 'pending', 
         message: 'Vérification du paiement...' 
       })
-      pollPaymentStatus(sessionId)
+      // Statut poussé par le serveur (SSE), repli sur le polling si le flux échoue
+      waitForPaymentStatus(sessionId)
+        .then((data) => {
+          if (!applyPaymentStatus(data)) {
+            pollPaymentStatus(sessionId)
+          }
+        })
+        .catch(() => pollPaymentStatus(sessionId))
     }
   }, [])
 
@@ -527,7 +543,7 @@ export default function LuckyPizzaPage() {
                       Ajouter au panier
                     </Button>
                     <Button 
-                      onClick={() => handlePayment(pizza.package_id, pizza.name)}
+                      onClick={() => handlePayment([{ package_id: pizza.package_id, quantity: 1 }])}
                       variant="secondary"
                       size="default"
                       loading={isProcessingPayment}
@@ -865,7 +881,12 @@ export default function LuckyPizzaPage() {
                         {getCartTotal().toFixed(2)}€
                       </span>
                     </div>
-                    <Button className="w-full" size="lg">
+                    <Button
+                      className="w-full"
+                      size="lg"
+                      onClick={() => handlePayment(cart)}
+                      loading={isProcessingPayment}
+                    >
                       <CreditCard className="w-4 h-4 mr-2" />
                       Commander Maintenant
                     </Button>
@@ -15,6 +15,7 @@ import {
 import Link from 'next/link'
 import OptimizedImage from '../../components/OptimizedImage'
 import useEdgeOptimization from '../../hooks/useEdgeOptimization'
+import { catalogPrice } from '../../lib/catalog'
 
 // Composants UI modernes
 const Button = ({ children, className = "", variant = "default", size = "default", onClick, loading, disabled }) => {
@@ -103,7 +104,7 @@ export default function MenuPage() {
       package_id: 'test_free',
       name: "🎁 Pizza Test Gratuite",
       description: "Pizza de démonstration pour tester le système de commande - 100% gratuite !",
-      price: 0.00,
+      price: catalogPrice('test_free'),
       image: "https://images.unsplash.com/photo-1513104890138-7c749659a591?w=400&h=224&fit=crop&crop=entropy&cs=srgb&fm=webp&q=85&blend=F97316&blend-mode=multiply&blend-alpha=10",
       isTest: true,
       testBadge: "TEST GRATUIT"
@@ -113,7 +114,7 @@ export default function MenuPage() {
       package_id: 'margherita',
       name: "Margherita Authentique",
       description: "Sauce tomate San Marzano, mozzarella di bufala, basilic frais, huile d'olive extra vierge",
-      price: 12.90,
+      price: catalogPrice('margherita'),
       image: "https://images.unsplash.com/photo-1713393281034-c7c9b046e1d3?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwxfHxwcm9mZXNzaW9uYWwlMjBwaXp6YXxlbnwwfHx8fDE3NTU3Nzc0Mzh8MA&ixlib=rb-4.1.0&q=85",
       popular: true
     },
@@ -122,7 +123,7 @@ export default function MenuPage() {
       package_id: 'napoletana',
       name: "Napoletana Traditionelle",
       description: "Sauce tomate, mozzarella, anchois, olives noires, origan, ail",
-      price: 15.90,
+      price: catalogPrice('napoletana'),
       image: "https://images.pexels.com/photos/784636/pexels-photo-784636.jpeg"
     },
     {
@@ -130,7 +131,7 @@ export default function MenuPage() {
       package_id: 'quattro_formaggi',
       name: "Quattro Formaggi Déluxe",
       description: "Mozzarella, gorgonzola DOP, parmesan vieilli 24 mois, chèvre de Lannilis",
-      price: 18.90,
+      price: catalogPrice('quattro_formaggi'),
       image: "https://images.pexels.com/photos/6969975/pexels-photo-6969975.jpeg"
     },
     {
@@ -138,7 +139,7 @@ export default function MenuPage() {
       package_id: 'diavola',
       name: "Diavola Piccante",
       description: "Sauce tomate épicée, mozzarella, salami piquant, piment de Calabre, huile piquante",
-      price: 17.90,
+      price: catalogPrice('diavola'),
       image: "https://images.unsplash.com/photo-1689915972091-debe902f72fd?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwyfHxtb2Rlcm4lMjBwaXp6YSUyMHJlc3RhdXJhbnR8ZW58MHx8fHwxNzU1Nzc3NDI3fDA&ixlib=rb-4.1.0&q=85"
     },
     {
@@ -146,7 +147,7 @@ export default function MenuPage() {
       package_id: 'vegetariana',
       name: "Végétarienne du Terroir",
       description: "Sauce tomate, mozzarella, légumes de saison locaux, herbes de Provence, pesto basilic",
-      price: 16.90,
+      price: catalogPrice('vegetariana'),
       image: "https://images.unsplash.com/photo-1573586698223-e9502ddf5b07?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwzfHxtb2Rlcm4lMjBwaXp6YSUyMHJlc3RhdXJhbnR8ZW58MHx8fHwxNzU1Nzc3NDI3fDA&ixlib=rb-4.1.0&q=85"
     },
     {
@@ -154,7 +155,7 @@ export default function MenuPage() {
       package_id: 'prosciutto',
       name: "Prosciutto & Roquette",
       description: "Sauce tomate, mozzarella, prosciutto di Parma 18 mois, roquette fraîche, copeaux de parmesan",
-      price: 19.90,
+      price: catalogPrice('prosciutto'),
       image: "https://images.unsplash.com/photo-1713393281034-c7c9b046e1d3?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1ODB8MHwxfHNlYXJjaHwxfHxwcm9mZXNzaW9uYWwlMjBwaXp6YXxlbnwwfHx8fDE3NTU3Nzc0Mzh8MA&ixlib=rb-4.1.0&q=85"
     }
   ]
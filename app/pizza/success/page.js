@@ -4,6 +4,7 @@ import { useState, useEffect, Suspense } from 'react'
 import { useSearchParams } from 'next/navigation'
 import { Check, Loader2, ChefHat, Clock, MapPin, ArrowLeft, X } from 'lucide-react'
 import Link from 'next/link'
+import { waitForPaymentStatus } from '../../lib/paymentStatusStream'
 
 const Button = ({ children, className = "", variant = "default", size = "default", onClick, href }) => {
   const baseStyles = "inline-flex items-center justify-center rounded-lg text-sm font-medium transition-all duration-200 focus-visible:outline-none focus-visible:ring-2 focus-visible:ring-offset-2 disabled:pointer-events-none disabled:opacity-50"
@@ -50,10 +51,36 @@ function PaymentSuccessContent() {
 
   useEffect(() => {
     if (sessionId) {
-      checkPaymentStatus(sessionId)
+      // Statut poussé par le serveur (SSE), repli sur le polling si le flux échoue
+      waitForPaymentStatus(sessionId)
+        .then((data) => {
+          if (!applyPaymentStatus(data)) {
+            checkPaymentStatus(sessionId)
+          }
+        })
+        .catch(() => checkPaymentStatus(sessionId))
     }
   }, [sessionId])
 
+  // Met à jour l'affichage; renvoie true si le statut est définitif
+  const applyPaymentStatus = (data) => {
+    if (data.payment_status === 'paid') {
+      setPaymentStatus('success')
+      setOrderDetails({
+        sessionId: data.session_id,
+        amount: (data.amount_total / 100).toFixed(2), // Stripe returns cents
+        currency: data.currency,
+        pizzaName: data.metadata?.pizza_name || 'Pizza',
+        orderNumber: data.session_id.substring(0, 8).toUpperCase()
+      })
+      return true
+    } else if (data.status === 'expired') {
+      setPaymentStatus('expired')
+      return true
+    }
+    return false
+  }
+
   const checkPaymentStatus = async (sessionId, attempts = 0) => {
     const maxAttempts = 5
     const pollInterval = 2000
@@ -71,18 +98,7 @@ function PaymentSuccessContent() {
 
       const data = await response.json()
       
-      if (data.payment_status === 'paid') {
-        setPaymentStatus('success')
-        setOrderDetails({
-          sessionId: data.session_id,
-          amount: (data.amount_total / 100).toFixed(2), // Stripe returns cents
-          currency: data.currency,
-          pizzaName: data.metadata?.pizza_name || 'Pizza',
-          orderNumber: data.session_id.substring(0, 8).toUpperCase()
-        })
-        return
-      } else if (data.status === 'expired') {
-        setPaymentStatus('expired')
+      if (applyPaymentStatus(data)) {
         return
       }
 
@@ -264,6 +264,7 @@ yarn build
 # 9. Configuration PM2
 echo -e "${BLUE}⚙️  Configuration PM2...${NC}"
 pm2 delete "$PROJECT_NAME" 2>/dev/null || true
+pm2 delete "${PROJECT_NAME}-payments" 2>/dev/null || true
 
 # Créer une configuration PM2 optimisée pour VPS
 cat > ecosystem.config.js << EOF
@@ -285,6 +286,22 @@ module.exports = {
     error_file: '/var/log/pm2/${PROJECT_NAME}.err.log',
     out_file: '/var/log/pm2/${PROJECT_NAME}.out.log',
     log_file: '/var/log/pm2/${PROJECT_NAME}.log'
+  }, {
+    name: '${PROJECT_NAME}-payments',
+    script: 'python3',
+    args: '-m payment_service serve',
+    interpreter: 'none',
+    cwd: '${PROJECT_DIR}',
+    instances: 1,
+    autorestart: true,
+    watch: false,
+    max_memory_restart: '300M',
+    env: {
+      NODE_ENV: 'production'
+    },
+    error_file: '/var/log/pm2/${PROJECT_NAME}-payments.err.log',
+    out_file: '/var/log/pm2/${PROJECT_NAME}-payments.out.log',
+    log_file: '/var/log/pm2/${PROJECT_NAME}-payments.log'
   }]
 }
 EOF
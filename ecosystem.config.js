@@ -11,7 +11,22 @@ module.exports = {
     env: {
       NODE_ENV: 'production',
       PORT: 3000,
-      HOSTNAME: '0.0.0.0'
+      HOSTNAME: '0.0.0.0',
+      PAYMENT_SERVICE_SOCKET: '/tmp/getyoursite-payments.sock'
+    }
+  }, {
+    name: 'getyoursite-payments',
+    script: 'python3',
+    args: '-m payment_service serve',
+    interpreter: 'none',
+    cwd: '/app',
+    instances: 1,
+    autorestart: true,
+    watch: false,
+    max_memory_restart: '300M',
+    env: {
+      NODE_ENV: 'production',
+      PAYMENT_SERVICE_SOCKET: '/tmp/getyoursite-payments.sock'
     }
   }]
 }
@@ -13,6 +13,10 @@ from datetime import datetime
 from pymongo import MongoClient
 import uuid
 
+from payment_service.catalog import Catalog, DEFAULT_CATALOG_PATH
+from payment_service.config import load_settings
+from payment_service.startup import startup_report
+
 class LuckyPizzaPaymentTester:
     def __init__(self):
         self.base_url = "http://localhost:3000"
@@ -22,12 +26,9 @@ class LuckyPizzaPaymentTester:
         
         # Test packages as defined in the backend
         self.test_packages = {
-            'margherita': {'amount': 12.90, 'name': 'Pizza Margherita'},
-            'napoletana': {'amount': 15.90, 'name': 'Pizza Napoletana'},
-            'quattro_formaggi': {'amount': 18.90, 'name': 'Pizza Quattro Formaggi'},
-            'diavola': {'amount': 17.90, 'name': 'Pizza Diavola'},
-            'vegetariana': {'amount': 16.90, 'name': 'Pizza Végétarienne'},
-            'prosciutto': {'amount': 19.90, 'name': 'Pizza Prosciutto'}
+            package_id: {'amount': package.amount, 'name': package.name}
+            for package_id, package in Catalog(DEFAULT_CATALOG_PATH).packages.items()
+            if not package.is_test
         }
         
     def log_test(self, test_name, status, message="", details=None):
@@ -488,9 +489,7 @@ class LuckyPizzaPaymentTester:
                 session_id = data.get('session_id')
                 
                 if session_id:
-                    # Check if transaction was created in database
-                    time.sleep(2)  # Give time for database write
-                    
+                    # The transaction is written before checkout responds
                     try:
                         mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
                         client = MongoClient(mongo_url, serverSelectionTimeoutMS=5000)
@@ -565,7 +564,6 @@ class LuckyPizzaPaymentTester:
                 return False
             
             # Step 2: Check payment status
-            time.sleep(1)
             status_response = requests.get(
                 f"{self.api_url}/payments/status/{session_id}",
                 timeout=15
@@ -579,7 +577,6 @@ class LuckyPizzaPaymentTester:
             status_data = status_response.json()
             
             # Step 3: Verify database record
-            time.sleep(1)
             try:
                 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
                 client = MongoClient(mongo_url, serverSelectionTimeoutMS=5000)
@@ -607,6 +604,30 @@ class LuckyPizzaPaymentTester:
             self.log_test("Integration Flow", "FAIL", f"Integration test failed: {str(e)}")
             return False
 
+    def test_cold_start_budget(self):
+        """Test that a payment worker's Mongo-only path starts within its import budget"""
+        try:
+            report = startup_report(load_settings().cold_start_budget_ms)
+            mongo = report['mongo']
+            details = {scenario: report[scenario]['total_ms'] for scenario in ('mongo', 'stripe', 'server')}
+
+            if mongo['stripe_loaded']:
+                self.log_test("Cold Start Budget", "FAIL",
+                            "Mongo-only path imports the Stripe integration", details)
+                return False
+            if not report['within_budget']:
+                self.log_test("Cold Start Budget", "FAIL",
+                            f"Mongo-only path takes {mongo['total_ms']}ms (budget {report['budget_ms']}ms)", details)
+                return False
+
+            self.log_test("Cold Start Budget", "PASS",
+                        f"Mongo-only path imports in {mongo['total_ms']}ms (budget {report['budget_ms']}ms)", details)
+            return True
+
+        except Exception as e:
+            self.log_test("Cold Start Budget", "FAIL", f"Startup report failed: {str(e)}")
+            return False
+
     def run_all_tests(self):
         """Run all Lucky Pizza payment system tests"""
         print("🍕💳 Starting Lucky Pizza Lannilis Payment System Tests")
@@ -639,6 +660,9 @@ class LuckyPizzaPaymentTester:
         # Integration test
         self.test_integration_flow()
         
+        # Startup benchmark
+        self.test_cold_start_budget()
+        
         # Final summary
         print("\n" + "=" * 80)
         print("🏁 Lucky Pizza Payment System Test Summary")
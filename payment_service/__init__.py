@@ -0,0 +1,10 @@
+"""
+Lucky Pizza payment service.
+
+Long-lived Python process hosting the Stripe checkout, payment status and
+webhook handlers. The Next.js routes under ``app/api/payments`` and
+``app/api/webhook`` talk to it over a local Unix socket instead of spawning
+a fresh ``python3 -c`` interpreter for every request.
+"""
+
+__version__ = '1.0.0'
@@ -0,0 +1,241 @@
+"""
+Command line entry point: ``python3 -m payment_service <command>``
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+
+from .config import load_env_file, load_settings
+
+
+def _serve(args):
+    from .server import serve
+
+    asyncio.run(serve(load_settings()))
+
+
+def _worker(args):
+    from .worker import run_worker
+
+    asyncio.run(run_worker(load_settings()))
+
+
+def _ensure_indexes(args):
+    from . import db
+    from .indexes import ensure_indexes
+
+    settings = load_settings()
+    missing = ensure_indexes(db.init_pool(settings), settings)
+    db.close_pool()
+    return 1 if missing else 0
+
+
+def _reconcile(args):
+    from . import db
+    from .reconcile import reconcile_pending
+
+    settings = load_settings()
+    db.init_pool(settings)
+    try:
+        stats = asyncio.run(reconcile_pending(
+            settings,
+            older_than=args.older_than,
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+            max_rate=args.max_rate,
+        ))
+    finally:
+        db.close_pool()
+    print(json.dumps(stats))
+
+
+def _archive(args):
+    from . import db
+    from .archive import archive_settled
+
+    settings = load_settings()
+    db.init_pool(settings)
+    try:
+        stats = asyncio.run(archive_settled(
+            settings,
+            older_than=args.older_than,
+            batch_size=args.batch_size,
+            max_batches=args.max_batches,
+        ))
+    finally:
+        db.close_pool()
+    print(json.dumps(stats))
+
+
+def _migrate_timestamps(args):
+    from . import db
+    from .timestamps import migrate_timestamps
+
+    settings = load_settings()
+    db.init_pool(settings)
+    try:
+        stats = asyncio.run(migrate_timestamps(settings, batch_size=args.batch_size))
+    finally:
+        db.close_pool()
+    print(json.dumps(stats))
+
+
+def _export(args):
+    from . import db
+    from .export import export_transactions
+
+    settings = load_settings()
+    db.init_pool(settings)
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+
+    async def write(text):
+        output.write(text)
+
+    try:
+        stats = asyncio.run(export_transactions(
+            settings, write,
+            format=args.format,
+            since=args.since,
+            until=args.until,
+            source=args.source,
+            status=args.status,
+            batch_size=args.batch_size,
+        ))
+    finally:
+        if args.output:
+            output.close()
+        db.close_pool()
+    # Rows go to stdout unless --output is given; the report always goes to stderr
+    print(json.dumps(stats), file=sys.stderr)
+
+
+def _rollups(args):
+    from . import db
+    from .rollups import rebuild_rollups, sales_report
+
+    settings = load_settings()
+    db.init_pool(settings)
+    try:
+        if args.rebuild:
+            print(json.dumps(asyncio.run(rebuild_rollups())))
+        else:
+            print(json.dumps(asyncio.run(sales_report(args.since, args.until))))
+    finally:
+        db.close_pool()
+
+
+def _startup_report(args):
+    from .startup import startup_report
+
+    settings = load_settings()
+    budget_ms = settings.cold_start_budget_ms if args.budget_ms is None else args.budget_ms
+    report = startup_report(budget_ms, runs=args.runs)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for scenario in ('mongo', 'stripe', 'server'):
+            profile = report[scenario]
+            stripe = 'stripe loaded' if profile['stripe_loaded'] else 'no stripe'
+            print(f'{scenario:<8} {profile["total_ms"]:>8.1f} ms  {profile["modules"]:>4} modules  {stripe}')
+            for name, self_ms in profile['slowest'][:5]:
+                print(f'           {self_ms:>6.1f} ms  {name}')
+        verdict = 'OK' if report['within_budget'] else 'OVER BUDGET'
+        print(f'mongo cold start budget {budget_ms:.0f} ms: {verdict}')
+    return 0 if report['within_budget'] else 1
+
+
+def _stripe_standin(args):
+    from .stripe_standin import run_standin
+
+    load_env_file()
+    run_standin(
+        args.host, args.port, args.webhook_url,
+        args.webhook_secret or os.environ.get('STRIPE_WEBHOOK_SECRET', 'whsec_standin'),
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        retry_errors=not args.no_retry, seed=args.seed,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='payment_service', description='Lucky Pizza payment service')
+    subparsers = parser.add_subparsers(dest='command')
+
+    serve_parser = subparsers.add_parser('serve', help='Run the payment service on its Unix socket')
+    serve_parser.set_defaults(func=_serve)
+
+    worker_parser = subparsers.add_parser('worker', help='Run one pool worker on stdin/stdout (started by serve)')
+    worker_parser.set_defaults(func=_worker)
+
+    indexes_parser = subparsers.add_parser('ensure-indexes', help='Create the payment_transactions indexes')
+    indexes_parser.set_defaults(func=_ensure_indexes)
+
+    reconcile_parser = subparsers.add_parser('reconcile', help='Sync pending transactions with Stripe')
+    reconcile_parser.add_argument('--older-than', type=float, help='Only transactions older than N seconds')
+    reconcile_parser.add_argument('--concurrency', type=int, help='Concurrent Stripe lookups')
+    reconcile_parser.add_argument('--batch-size', type=int, help='Transactions per cursor batch and bulk write')
+    reconcile_parser.add_argument('--max-rate', type=float, help='Max Stripe lookups per second (0 = unlimited)')
+    reconcile_parser.set_defaults(func=_reconcile)
+
+    archive_parser = subparsers.add_parser('archive', help='Move settled transactions to the archive collection')
+    archive_parser.add_argument('--older-than', type=float, help='Only transactions last updated N seconds ago')
+    archive_parser.add_argument('--batch-size', type=int, help='Transactions moved per batch')
+    archive_parser.add_argument('--max-batches', type=int, help='Stop after N batches (the next run resumes)')
+    archive_parser.set_defaults(func=_archive)
+
+    migrate_parser = subparsers.add_parser('migrate-timestamps',
+                                           help='Convert string timestamps of stored transactions to UTC dates')
+    migrate_parser.add_argument('--batch-size', type=int, help='Transactions converted per batch')
+    migrate_parser.set_defaults(func=_migrate_timestamps)
+
+    export_parser = subparsers.add_parser('export', help='Stream transactions as NDJSON or CSV')
+    export_parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    export_parser.add_argument('--since', help='First creation day (YYYY-MM-DD, UTC)')
+    export_parser.add_argument('--until', help='Last creation day (YYYY-MM-DD, UTC), inclusive')
+    export_parser.add_argument('--source', help='Only this metadata.source')
+    export_parser.add_argument('--status', help='Only this payment_status or status (paid, expired, ...)')
+    export_parser.add_argument('--batch-size', type=int, help='Transactions per cursor batch')
+    export_parser.add_argument('--output', help='File to write (default: stdout)')
+    export_parser.set_defaults(func=_export)
+
+    rollups_parser = subparsers.add_parser('rollups', help='Sales per day and pizza from daily_rollups')
+    rollups_parser.add_argument('--since', help='First day (YYYY-MM-DD)')
+    rollups_parser.add_argument('--until', help='Last day (YYYY-MM-DD), inclusive')
+    rollups_parser.add_argument('--rebuild', action='store_true',
+                                help='Recompute daily_rollups from payment_transactions in one aggregation pass')
+    rollups_parser.set_defaults(func=_rollups)
+
+    startup_parser = subparsers.add_parser('startup-report', help='Profile cold-start imports (-X importtime)')
+    startup_parser.add_argument('--budget-ms', type=float, help='Cold-start budget of the Mongo-only path')
+    startup_parser.add_argument('--runs', type=int, default=3, help='Fresh interpreters per scenario (best is kept)')
+    startup_parser.add_argument('--json', action='store_true', help='Print the full report as JSON')
+    startup_parser.set_defaults(func=_startup_report)
+
+    standin_parser = subparsers.add_parser('stripe-standin', help='Run a local Stripe API stand-in (set STRIPE_API_BASE)')
+    standin_parser.add_argument('--host', default='127.0.0.1')
+    standin_parser.add_argument('--port', type=int, default=12111)
+    standin_parser.add_argument('--webhook-url', default='http://localhost:3000/api/webhook/stripe',
+                                help='Where to post signed checkout.session.completed events ("" = none)')
+    standin_parser.add_argument('--webhook-secret', help='Signing secret (default: STRIPE_WEBHOOK_SECRET)')
+    standin_parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay added to every API call')
+    standin_parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random extra delay, up to N ms')
+    standin_parser.add_argument('--error-rate', type=float, default=0.0, help='Share of API calls failed with a 500')
+    standin_parser.add_argument('--no-retry', action='store_true',
+                                help='Mark injected errors Stripe-Should-Retry: false')
+    standin_parser.add_argument('--seed', type=int, help='Seed for reproducible latency and errors')
+    standin_parser.set_defaults(func=_stripe_standin)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    if not getattr(args, 'func', None):
+        parser.print_help()
+        return 1
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
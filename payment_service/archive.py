@@ -0,0 +1,101 @@
+"""
+Archival of settled transactions out of ``payment_transactions``.
+
+Paid orders, expired or canceled sessions and free test pizzas never change
+again, yet they keep every index of the hot collection growing.
+``archive_settled`` moves those last updated more than ``archive_age``
+seconds ago into ``payment_transactions_archive``, one batch at a time:
+``insert_many`` into the archive, then ``delete_many`` of the same ``_id``
+from the hot collection. The archive has its own unique ``session_id``
+index and duplicate-key errors are ignored, so a run interrupted between
+the two steps is simply picked up by the next one; there is no checkpoint
+to keep. The server runs it every ``archive_interval`` seconds; it can also
+be run by hand with ``python3 -m payment_service archive``.
+
+Status checks fall back to the archive when a session is not in the hot
+collection (``find_archived``); daily rollups and exports read both.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from pymongo.errors import BulkWriteError
+
+from . import db
+from .db import ARCHIVE_COLLECTION, only_duplicate_keys
+from .timestamps import utc_now
+
+logger = logging.getLogger(__name__)
+
+# One clause per settled state, each matching an index that ends with updated_at
+SETTLED = (
+    {'payment_status': 'paid'},
+    {'status': {'$in': ['expired', 'canceled']}},
+    {'test_mode': True},
+)
+
+
+def settled_before(cutoff):
+    """Query for settled transactions last updated before ``cutoff``
+
+    The cutoff is repeated in every ``$or`` clause so that each one is an
+    index range scan of its own; with the cutoff outside the ``$or``, no
+    single index covers the query and MongoDB scans the collection.
+    """
+    return {'$or': [{**clause, 'updated_at': {'$lt': cutoff}} for clause in SETTLED]}
+
+
+async def find_archived(session_id):
+    """A transaction moved to the archive, or None"""
+    return await db.get_pool().collection(ARCHIVE_COLLECTION).find_one({'session_id': session_id})
+
+
+async def _copy(archive, documents):
+    try:
+        await archive.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        # Copied by a run that stopped before its delete
+        if not only_duplicate_keys(e):
+            raise
+
+
+async def archive_settled(settings, older_than=None, batch_size=None, max_batches=None):
+    """Move settled transactions older than ``older_than`` seconds to the archive; returns counters"""
+    older_than = settings.archive_age if older_than is None else older_than
+    batch_size = batch_size or settings.archive_batch_size
+    transactions = db.get_pool().transactions
+    archive = db.get_pool().collection(ARCHIVE_COLLECTION)
+    cutoff = utc_now() - timedelta(seconds=older_than)
+    query = settled_before(cutoff)
+    stats = {'archived': 0, 'batches': 0}
+
+    started = time.monotonic()
+    while max_batches is None or stats['batches'] < max_batches:
+        batch = await transactions.find_all(query, limit=batch_size)
+        if not batch:
+            break
+        await _copy(archive, batch)
+        await transactions.delete_many({'_id': {'$in': [document['_id'] for document in batch]}})
+        stats['archived'] += len(batch)
+        stats['batches'] += 1
+        # Let status checks and webhooks in between batches
+        await asyncio.sleep(0)
+
+    elapsed = time.monotonic() - started
+    stats['elapsed_seconds'] = round(elapsed, 3)
+    stats['documents_per_second'] = round(stats['archived'] / elapsed, 1) if elapsed else 0.0
+    logger.info('Archived %(archived)d settled transactions in %(batches)d batches '
+                'at %(documents_per_second).1f documents/s', stats)
+    return stats
+
+
+async def run_periodically(settings):
+    """Background archival loop for the server process"""
+    while True:
+        await asyncio.sleep(settings.archive_interval)
+        try:
+            await archive_settled(settings)
+        except Exception:
+            logger.exception('Transaction archival failed')
@@ -0,0 +1,148 @@
+"""
+Circuit breaker around the Stripe API calls of one payment process.
+
+``CircuitBreaker.call`` runs a Stripe call and records its outcome in a
+window of the last ``breaker_window`` calls. A call counts as failed when
+Stripe is unreachable, times out or answers 5xx
+(``stripe_client.is_outage``), or when it takes longer than
+``breaker_slow_call`` seconds (its result is still returned). A 4xx
+answer, such as an unknown session id, is about the request, not about
+Stripe: it is raised without being recorded, so bad requests cannot open
+the breaker. Once at least ``breaker_min_calls`` calls are in the window
+and ``breaker_failure_rate`` of them failed, the breaker opens: calls are
+refused at once with ``CircuitOpen`` instead of tying up the process
+behind a slow Stripe. After ``breaker_open_seconds`` it goes half-open and
+lets ``breaker_half_open_probes`` calls through; the first probe to
+succeed closes it with an empty window, a failed probe opens it again.
+
+While it is open, status checks answer from the last state recorded in
+``payment_transactions``, marked ``"stale": true`` (see
+``handlers.check_payment_status``). Each process has its own breaker; the
+server sums them in the ``stats`` and ``metrics`` actions.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_breaker = None
+
+
+class CircuitOpen(Exception):
+    """Stripe calls are suspended by the circuit breaker"""
+
+
+class CircuitBreaker:
+    def __init__(self, settings, name='stripe'):
+        self.settings = settings
+        self.name = name
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=settings.breaker_window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self.counters = {'calls': 0, 'failures': 0, 'slow': 0, 'rejected': 0, 'opened': 0, 'stale_served': 0}
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._probes = 0
+        self.counters['opened'] += 1
+        logger.warning('Circuit breaker %s opened', self.name)
+
+    def _admit(self):
+        if self.state == OPEN:
+            if time.monotonic() - self._opened_at < self.settings.breaker_open_seconds:
+                return False
+            self.state = HALF_OPEN
+            logger.info('Circuit breaker %s half-open, probing', self.name)
+        if self.state == HALF_OPEN:
+            if self._probes >= self.settings.breaker_half_open_probes:
+                return False
+            self._probes += 1
+        return True
+
+    def _release(self, probe):
+        if probe:
+            self._probes = max(self._probes - 1, 0)
+
+    def _record(self, failed, probe):
+        if probe:
+            self._probes = max(self._probes - 1, 0)
+            if self.state != HALF_OPEN:
+                # Another probe already settled it
+                return
+            if failed:
+                self._open()
+            else:
+                self.state = CLOSED
+                self._outcomes.clear()
+                logger.info('Circuit breaker %s closed', self.name)
+            return
+
+        self._outcomes.append(failed)
+        if self.state != CLOSED or len(self._outcomes) < self.settings.breaker_min_calls:
+            return
+        if sum(self._outcomes) >= self.settings.breaker_failure_rate * len(self._outcomes):
+            self._open()
+
+    async def call(self, function, *args):
+        """``await function(*args)`` unless the breaker is open (then ``CircuitOpen``)"""
+        if not self._admit():
+            self.counters['rejected'] += 1
+            raise CircuitOpen('Stripe is unavailable, please retry shortly')
+
+        probe = self.state == HALF_OPEN
+        self.counters['calls'] += 1
+        started = time.monotonic()
+        try:
+            result = await function(*args)
+        except asyncio.CancelledError:
+            # Says nothing about Stripe: just give the probe slot back
+            self._release(probe)
+            raise
+        except Exception as e:
+            from .stripe_client import is_outage
+
+            if not is_outage(e):
+                self._release(probe)
+                raise
+            self.counters['failures'] += 1
+            self._record(True, probe)
+            raise
+        slow = time.monotonic() - started > self.settings.breaker_slow_call
+        if slow:
+            self.counters['slow'] += 1
+        self._record(slow, probe)
+        return result
+
+    def served_stale(self):
+        self.counters['stale_served'] += 1
+
+    def stats(self):
+        return {'state': self.state, **self.counters}
+
+
+def get_breaker(settings):
+    """Process-wide breaker for Stripe calls"""
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(settings)
+    return _breaker
+
+
+def merge_stats(exports):
+    """Sum the breaker counters of several processes, with the number in each state"""
+    merged = {'states': {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}}
+    for export in exports:
+        merged['states'][export['state']] += 1
+        for key, value in export.items():
+            if key != 'state':
+                merged[key] = merged.get(key, 0) + value
+    return merged
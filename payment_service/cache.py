@@ -0,0 +1,65 @@
+"""
+In-memory cache of payment status responses.
+
+A session that reached a terminal state (``paid``, ``expired``,
+``canceled``) never changes again, so its response is kept until evicted
+and served without asking Stripe. Other responses are reused for
+``status_cache_ttl`` seconds, which absorbs the success page's 2s polling
+from several tabs without delaying a payment by more than one TTL.
+"""
+
+import time
+from collections import OrderedDict
+
+TERMINAL_PAYMENT_STATUSES = {'paid'}
+TERMINAL_STATUSES = {'expired', 'canceled'}
+
+_cache = None
+
+
+def is_terminal(record):
+    """True if a transaction document or status response is in a final state"""
+    return (record.get('payment_status') in TERMINAL_PAYMENT_STATUSES or
+            record.get('status') in TERMINAL_STATUSES)
+
+
+class StatusCache:
+    def __init__(self, ttl, max_entries, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+
+    def get(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        response, expires_at = entry
+        if expires_at is not None and expires_at <= self._clock():
+            del self._entries[session_id]
+            return None
+        self._entries.move_to_end(session_id)
+        return dict(response)
+
+    def put(self, session_id, response):
+        if is_terminal(response):
+            expires_at = None
+        elif self.ttl > 0:
+            expires_at = self._clock() + self.ttl
+        else:
+            return
+        self._entries[session_id] = (dict(response), expires_at)
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, session_id):
+        self._entries.pop(session_id, None)
+
+
+def get_status_cache(settings):
+    """Process-wide status cache"""
+    global _cache
+    if _cache is None:
+        _cache = StatusCache(settings.status_cache_ttl, settings.status_cache_size)
+    return _cache
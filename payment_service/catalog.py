@@ -0,0 +1,141 @@
+"""
+Pizza catalog: the only source of package names and prices.
+
+SECURITY: amounts are defined on the backend only; the checkout payload
+carries ``package_id``/``quantity`` lines and nothing else is trusted.
+``price_cart`` validates those lines and prices them from the catalog.
+
+``catalog.json`` is loaded once into an immutable mapping of ``Package``
+entries priced in integer cents, so validating a ``package_id`` is one dict
+lookup and no float rounding creeps into totals. The file is re-read at
+most every ``catalog_check_interval`` seconds and swapped in when its
+SHA-256 changes, so a menu change takes effect without restarting the
+payment workers; an interval of 0 or less loads it once and never again.
+A file that fails to parse is logged and ignored; the previous catalog
+stays in service.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json')
+MAX_CART_LINES = 20
+MAX_QUANTITY = 20
+
+_catalog = None
+
+
+@dataclass(frozen=True)
+class Package:
+    package_id: str
+    name: str
+    amount_cents: int
+    is_test: bool = False
+
+    @property
+    def amount(self):
+        """Price in euros, as the checkout API has always returned it"""
+        return self.amount_cents / 100
+
+
+@dataclass(frozen=True)
+class CartLine:
+    package: Package
+    quantity: int
+
+    @property
+    def amount_cents(self):
+        return self.package.amount_cents * self.quantity
+
+
+def parse_catalog(data):
+    """Build the immutable ``package_id -> Package`` table from catalog JSON bytes"""
+    document = json.loads(data)
+    packages = {}
+    for package_id, entry in document['packages'].items():
+        amount_cents = entry['amount_cents']
+        if not isinstance(amount_cents, int) or amount_cents < 0:
+            raise ValueError(f'Invalid amount_cents for {package_id}: {amount_cents!r}')
+        packages[package_id] = Package(package_id, entry['name'], amount_cents, bool(entry.get('is_test', False)))
+    return document.get('version'), MappingProxyType(packages)
+
+
+class Catalog:
+    def __init__(self, path=DEFAULT_CATALOG_PATH, check_interval=5.0, clock=time.monotonic):
+        self.path = path
+        self.check_interval = check_interval
+        self._clock = clock
+        self.digest = None
+        self.version = None
+        self.packages = MappingProxyType({})
+        self.reload()
+        self._next_check = clock() + check_interval
+
+    def reload(self):
+        """Re-read the file; returns True when a new catalog was swapped in"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == self.digest:
+            return False
+        version, packages = parse_catalog(data)
+        self.version, self.packages, self.digest = version, packages, digest
+        logger.info('Loaded pizza catalog v%s (%d packages)', version, len(packages))
+        return True
+
+    def _maybe_reload(self):
+        if self.check_interval <= 0:
+            return
+        now = self._clock()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            self.reload()
+        except (OSError, ValueError, KeyError) as e:
+            logger.error('Keeping catalog v%s, could not reload %s: %s', self.version, self.path, e)
+
+    def get(self, package_id):
+        """The ``Package`` for ``package_id``, or None if it is not on the menu"""
+        self._maybe_reload()
+        return self.packages.get(package_id)
+
+    def price_cart(self, items):
+        """``CartLine`` per package for ``[{"package_id", "quantity"}]``; raises ValueError if invalid"""
+        if not isinstance(items, list) or not items or len(items) > MAX_CART_LINES:
+            raise ValueError(f'Invalid cart: 1 to {MAX_CART_LINES} items expected')
+        packages, quantities = {}, {}
+        for item in items:
+            package_id = item.get('package_id') if isinstance(item, dict) else None
+            quantity = item.get('quantity', 1) if isinstance(item, dict) else None
+            package = self.get(package_id)
+            if package is None:
+                raise ValueError(f'Invalid package: {package_id}')
+            if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+                raise ValueError(f'Invalid quantity for {package_id}: {quantity!r}')
+            # Same pizza listed twice: one line
+            packages[package_id] = package
+            quantities[package_id] = quantities.get(package_id, 0) + quantity
+
+        lines = tuple(CartLine(packages[package_id], quantity) for package_id, quantity in quantities.items())
+        for line in lines:
+            if line.quantity > MAX_QUANTITY:
+                raise ValueError(f'Invalid quantity for {line.package.package_id}: at most {MAX_QUANTITY}')
+            if line.package.is_test and (len(lines) > 1 or line.quantity > 1):
+                raise ValueError(f'{line.package.package_id} must be ordered alone, once')
+        return lines
+
+
+def get_catalog(settings):
+    """Process-wide catalog"""
+    global _catalog
+    if _catalog is None:
+        _catalog = Catalog(settings.catalog_path, settings.catalog_check_interval)
+    return _catalog
@@ -0,0 +1,166 @@
+"""
+Configuration of the payment service, read from the environment.
+
+The service runs as its own PM2 app, so it does not inherit the variables
+Next.js loads from ``.env``. ``load_settings`` therefore reads that file too,
+without overriding anything already exported in the environment.
+"""
+
+import os
+from dataclasses import dataclass
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ENV_FILE = os.path.join(PROJECT_DIR, '.env')
+
+
+def load_env_file(path=DEFAULT_ENV_FILE):
+    """Load ``KEY=value`` lines from a dotenv file into ``os.environ``"""
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                os.environ.setdefault(key.strip(), value.strip().strip('"').strip("'"))
+    except FileNotFoundError:
+        pass
+
+
+def _int_env(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _float_env(name, default):
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+@dataclass(frozen=True)
+class Settings:
+    production: bool
+    stripe_api_key: str
+    mongo_url: str
+    database_name: str
+    socket_path: str
+    # 'mongo', or 'memory' for tests and benchmarks (single process, nothing persisted)
+    storage: str
+    mongo_min_pool_size: int
+    mongo_max_pool_size: int
+    mongo_timeout_ms: int
+    status_cache_ttl: float
+    status_cache_size: int
+    webhook_queue_path: str
+    webhook_batch_size: int
+    webhook_poll_interval: float
+    webhook_retry_delay: float
+    webhook_dedupe_size: int
+    stream_max_wait: float
+    # New transactions: 'sync' insert, or write-behind via a 'journal' or fire-and-forget 'async' buffer
+    transaction_durability: str
+    transaction_journal_path: str
+    transaction_batch_size: int
+    transaction_flush_interval: float
+    transaction_replay_age: float
+    catalog_path: str
+    catalog_check_interval: float
+    # Pending transaction sweeps (0 interval = no background sweep)
+    reconcile_interval: float
+    reconcile_age: float
+    reconcile_concurrency: int
+    reconcile_batch_size: int
+    reconcile_max_rate: float
+    # Settled transactions moved to the archive collection (0 interval = no background archival)
+    archive_interval: float
+    archive_age: float
+    archive_batch_size: int
+    # Transactions per cursor batch (and written chunk) of an export
+    export_batch_size: int
+    # Keep-alive connections to Stripe per process; api_base overrides the SDK's (local stand-in)
+    stripe_api_base: str
+    stripe_pool_size: int
+    stripe_timeout: float
+    # Stripe circuit breaker: trips when failed or slow calls reach failure_rate of the last window calls
+    breaker_window: int
+    breaker_min_calls: int
+    breaker_failure_rate: float
+    breaker_slow_call: float
+    breaker_open_seconds: float
+    breaker_half_open_probes: int
+    # Worker pool (0 workers = run handlers inside the server process)
+    workers: int
+    worker_concurrency: int
+    worker_max_requests: int
+    queue_size: int
+    # Crashed worker restarts: backoff doubling per consecutive crash of a slot, up to max_delay;
+    # crash_limit crashes within crash_window seconds with no worker left refuse requests at once
+    worker_restart_delay: float
+    worker_restart_max_delay: float
+    worker_crash_limit: int
+    worker_crash_window: float
+    # Local HTTP listener for GET /metrics on 127.0.0.1 (0 = disabled)
+    metrics_port: int
+    # Import-time budget (ms) of a worker's Mongo-only path, see startup.py
+    cold_start_budget_ms: float
+
+
+def load_settings():
+    """Build the service settings from the environment"""
+    load_env_file()
+    return Settings(
+        production=os.environ.get('NODE_ENV') == 'production',
+        stripe_api_key=os.environ.get('STRIPE_API_KEY', ''),
+        mongo_url=os.environ.get('MONGO_URL', 'mongodb://localhost:27017'),
+        database_name=os.environ.get('PAYMENT_DB_NAME', 'getyoursite'),
+        socket_path=os.environ.get('PAYMENT_SERVICE_SOCKET', '/tmp/getyoursite-payments.sock'),
+        storage=os.environ.get('PAYMENT_STORAGE', 'mongo'),
+        mongo_min_pool_size=_int_env('MONGO_MIN_POOL_SIZE', 2),
+        mongo_max_pool_size=_int_env('MONGO_MAX_POOL_SIZE', 20),
+        mongo_timeout_ms=_int_env('MONGO_TIMEOUT_MS', 5000),
+        status_cache_ttl=_float_env('PAYMENT_STATUS_CACHE_TTL', 2.0),
+        status_cache_size=_int_env('PAYMENT_STATUS_CACHE_SIZE', 10000),
+        webhook_queue_path=os.environ.get('PAYMENT_WEBHOOK_QUEUE', os.path.join(PROJECT_DIR, 'data', 'webhook-queue.db')),
+        webhook_batch_size=_int_env('PAYMENT_WEBHOOK_BATCH_SIZE', 100),
+        webhook_poll_interval=_float_env('PAYMENT_WEBHOOK_POLL_INTERVAL', 0.2),
+        webhook_retry_delay=_float_env('PAYMENT_WEBHOOK_RETRY_DELAY', 5.0),
+        webhook_dedupe_size=_int_env('PAYMENT_WEBHOOK_DEDUPE_SIZE', 10000),
+        stream_max_wait=_float_env('PAYMENT_STREAM_MAX_WAIT', 60.0),
+        transaction_durability=os.environ.get('PAYMENT_TRANSACTION_DURABILITY', 'sync'),
+        transaction_journal_path=os.environ.get(
+            'PAYMENT_TRANSACTION_JOURNAL', os.path.join(PROJECT_DIR, 'data', 'transaction-journal.db')
+        ),
+        transaction_batch_size=_int_env('PAYMENT_TRANSACTION_BATCH_SIZE', 100),
+        transaction_flush_interval=_float_env('PAYMENT_TRANSACTION_FLUSH_INTERVAL', 0.05),
+        transaction_replay_age=_float_env('PAYMENT_TRANSACTION_REPLAY_AGE', 30.0),
+        catalog_path=os.environ.get('PAYMENT_CATALOG', os.path.join(PROJECT_DIR, 'payment_service', 'catalog.json')),
+        catalog_check_interval=_float_env('PAYMENT_CATALOG_CHECK_INTERVAL', 5.0),
+        reconcile_interval=_float_env('PAYMENT_RECONCILE_INTERVAL', 900.0),
+        reconcile_age=_float_env('PAYMENT_RECONCILE_AGE', 3600.0),
+        reconcile_concurrency=_int_env('PAYMENT_RECONCILE_CONCURRENCY', 8),
+        reconcile_batch_size=_int_env('PAYMENT_RECONCILE_BATCH_SIZE', 100),
+        reconcile_max_rate=_float_env('PAYMENT_RECONCILE_MAX_RATE', 10.0),
+        archive_interval=_float_env('PAYMENT_ARCHIVE_INTERVAL', 86400.0),
+        archive_age=_float_env('PAYMENT_ARCHIVE_AGE', 90 * 86400.0),
+        archive_batch_size=_int_env('PAYMENT_ARCHIVE_BATCH_SIZE', 500),
+        export_batch_size=_int_env('PAYMENT_EXPORT_BATCH_SIZE', 500),
+        stripe_api_base=os.environ.get('STRIPE_API_BASE', ''),
+        stripe_pool_size=_int_env('PAYMENT_STRIPE_POOL_SIZE', 10),
+        stripe_timeout=_float_env('PAYMENT_STRIPE_TIMEOUT', 30.0),
+        breaker_window=_int_env('PAYMENT_BREAKER_WINDOW', 20),
+        breaker_min_calls=_int_env('PAYMENT_BREAKER_MIN_CALLS', 10),
+        breaker_failure_rate=_float_env('PAYMENT_BREAKER_FAILURE_RATE', 0.5),
+        breaker_slow_call=_float_env('PAYMENT_BREAKER_SLOW_CALL', 5.0),
+        breaker_open_seconds=_float_env('PAYMENT_BREAKER_OPEN_SECONDS', 30.0),
+        breaker_half_open_probes=_int_env('PAYMENT_BREAKER_HALF_OPEN_PROBES', 1),
+        workers=_int_env('PAYMENT_WORKERS', os.cpu_count() or 1),
+        worker_concurrency=_int_env('PAYMENT_WORKER_CONCURRENCY', 32),
+        worker_max_requests=_int_env('PAYMENT_WORKER_MAX_REQUESTS', 1000),
+        queue_size=_int_env('PAYMENT_QUEUE_SIZE', 256),
+        worker_restart_delay=_float_env('PAYMENT_WORKER_RESTART_DELAY', 0.5),
+        worker_restart_max_delay=_float_env('PAYMENT_WORKER_RESTART_MAX_DELAY', 30.0),
+        worker_crash_limit=_int_env('PAYMENT_WORKER_CRASH_LIMIT', 5),
+        worker_crash_window=_float_env('PAYMENT_WORKER_CRASH_WINDOW', 60.0),
+        metrics_port=_int_env('PAYMENT_METRICS_PORT', 9187),
+        cold_start_budget_ms=_float_env('PAYMENT_COLD_START_BUDGET_MS', 300.0),
+    )
@@ -0,0 +1,186 @@
+"""
+Process-wide MongoDB connection pool for the payment handlers.
+
+Each payment process (the server, or every pool worker) connects once at
+startup and keeps ``mongo_min_pool_size`` connections open, so a handler
+only borrows a socket from the pool instead of paying a TCP handshake and
+server selection on every request.
+
+``PAYMENT_STORAGE=memory`` swaps MongoDB for the in-memory ``MemoryPool``
+(see ``memory_store``), for tests and benchmarks.
+
+Handlers run on an event loop, so collections are handed out wrapped in
+``AsyncCollection``: every pymongo call runs on a thread pool sized to the
+connection pool and is awaited, and a slow query never blocks a Stripe call
+or another request in flight on the same loop.
+"""
+
+import asyncio
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+TRANSACTIONS_COLLECTION = 'payment_transactions'
+ARCHIVE_COLLECTION = 'payment_transactions_archive'
+LEDGER_COLLECTION = 'payment_webhook_events'
+ROLLUPS_COLLECTION = 'daily_rollups'
+
+DUPLICATE_KEY_ERROR = 11000
+
+_pool = None
+
+
+def only_duplicate_keys(error):
+    """True if a ``BulkWriteError`` only reports documents that already exist (an idempotent retry)"""
+    return all(err['code'] == DUPLICATE_KEY_ERROR for err in error.details.get('writeErrors', []))
+
+
+class AsyncCollection:
+    """Awaitable facade over a pymongo collection"""
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self._executor = executor
+
+    async def _run(self, method, *args, **kwargs):
+        if self._executor is None:
+            # In-memory backend: nothing to wait on, run inline
+            return method(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(method, *args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return await self._run(self.collection.find_one, *args, **kwargs)
+
+    async def find_all(self, *args, **kwargs):
+        """``find`` materialised as a list; only for small, bounded results"""
+        return await self._run(lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def iter_batches(self, filter, batch_size, **kwargs):
+        """Stream ``find`` results as lists of up to ``batch_size`` documents
+
+        The server-side cursor is consumed one batch at a time on the
+        executor, so memory stays bounded whatever the size of the result.
+        """
+        cursor = self.collection.find(filter, batch_size=batch_size, **kwargs)
+        try:
+            while True:
+                batch = await self._run(lambda: list(itertools.islice(cursor, batch_size)))
+                if not batch:
+                    break
+                yield batch
+        finally:
+            cursor.close()
+
+    async def aggregate_all(self, *args, **kwargs):
+        """``aggregate`` materialised as a list"""
+        return await self._run(lambda: list(self.collection.aggregate(*args, **kwargs)))
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run(self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self._run(self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run(self.collection.update_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._run(self.collection.update_many, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self._run(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._run(self.collection.delete_many, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._run(self.collection.bulk_write, *args, **kwargs)
+
+
+class MongoPool:
+    def __init__(self, settings):
+        self.settings = settings
+        self.client = MongoClient(
+            settings.mongo_url,
+            minPoolSize=settings.mongo_min_pool_size,
+            maxPoolSize=settings.mongo_max_pool_size,
+            serverSelectionTimeoutMS=settings.mongo_timeout_ms,
+            # Timestamps come back as aware UTC datetimes, like the ones the handlers write
+            tz_aware=True,
+        )
+        self.database = self.client[settings.database_name]
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.mongo_max_pool_size,
+            thread_name_prefix='mongo',
+        )
+
+    def collection(self, name):
+        return AsyncCollection(self.database[name], self.executor)
+
+    @property
+    def transactions(self):
+        return self.collection(TRANSACTIONS_COLLECTION)
+
+    def ping(self):
+        """Health check: True when the server answers a ping"""
+        try:
+            self.client.admin.command('ping')
+            return True
+        except PyMongoError:
+            return False
+
+    def warm_up(self):
+        """Open ``mongo_min_pool_size`` connections now rather than on first use"""
+        size = max(self.settings.mongo_min_pool_size, 1)
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            results = list(executor.map(lambda _: self.ping(), range(size)))
+        return all(results)
+
+    async def ping_async(self):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.ping)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+
+def init_pool(settings):
+    """Connect the process-wide pool; called once when a payment process starts"""
+    global _pool
+    if _pool is None and settings.storage == 'memory':
+        from .memory_store import MemoryPool
+
+        _pool = MemoryPool(settings)
+        logger.info('Using in-memory payment storage, nothing is persisted')
+    elif _pool is None:
+        from .metrics import get_metrics
+
+        _pool = MongoPool(settings)
+        with get_metrics().time('process.mongo_connect'):
+            ready = _pool.warm_up()
+        if ready:
+            logger.info('MongoDB pool ready (%d-%d connections)',
+                        settings.mongo_min_pool_size, settings.mongo_max_pool_size)
+        else:
+            logger.warning('MongoDB ping failed at startup, connections will be retried on demand')
+    return _pool
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError('Storage pool not initialised, call init_pool() first')
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
@@ -0,0 +1,65 @@
+"""
+Push notification of payment status changes.
+
+``StatusBus`` lives in the server process. The webhook consumer publishes
+every update it applies, and status responses passing through the server
+publish final states. ``watch_status`` backs the ``watch`` action used by
+the ``/api/payments/stream/{sessionId}`` SSE route: it answers as soon as
+the session reaches a final state, and only falls back to one Stripe
+lookup if nothing arrives before the deadline.
+"""
+
+import asyncio
+from collections import defaultdict
+
+from .handlers import stored_status
+
+
+class StatusBus:
+    def __init__(self):
+        self._waiters = defaultdict(set)
+
+    def subscribe(self, session_id):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[session_id].add(future)
+        return future
+
+    def unsubscribe(self, session_id, future):
+        waiters = self._waiters.get(session_id)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[session_id]
+
+    def publish(self, session_id, update):
+        for future in self._waiters.get(session_id, ()):
+            if not future.done():
+                future.set_result(update)
+
+    def watchers(self):
+        return sum(len(w) for w in self._waiters.values())
+
+
+async def watch_status(bus, payload, settings, lookup):
+    """Wait for a session to reach a final state; ``lookup`` is the Stripe-backed fallback"""
+    session_id = payload.get('session_id')
+    if not session_id:
+        return {'error': 'Session ID required'}
+    timeout = settings.stream_max_wait
+    if payload.get('timeout_ms'):
+        timeout = min(payload['timeout_ms'] / 1000, timeout)
+
+    # Subscribe before reading MongoDB so an update landing in between is not missed
+    waiter = bus.subscribe(session_id)
+    try:
+        current = await stored_status(session_id)
+        if current is not None:
+            return current
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return await lookup(session_id)
+        current = await stored_status(session_id)
+        return current if current is not None else await lookup(session_id)
+    finally:
+        bus.unsubscribe(session_id, waiter)
@@ -0,0 +1,408 @@
+"""
+Payment handlers for Lucky Pizza.
+
+These are the ``create_checkout``, ``check_payment_status`` and
+``handle_stripe_webhook`` coroutines that used to be inlined in the Next.js
+routes. Each one takes the request payload and returns the JSON-serialisable
+response the routes already parse. Errors are raised and turned into
+``{'error': ...}`` by the server.
+
+The Stripe integration is imported inside the functions that call Stripe:
+the free test pizza and test-mode status checks only need MongoDB, and a
+freshly spawned worker can serve them before the Stripe SDK is loaded.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+from uuid import uuid4
+
+from . import db
+from .archive import find_archived
+from .breaker import CircuitOpen, get_breaker
+from .cache import get_status_cache, is_terminal
+from .catalog import get_catalog
+from .metrics import get_metrics, label_package, stage, timed_request
+from .protocol import BODY
+from .rollups import record_paid
+from .timestamps import utc_now
+from .write_behind import get_transaction_writer
+
+logger = logging.getLogger(__name__)
+
+# package_id of a transaction holding several pizzas (see its items)
+CART_PACKAGE_ID = 'cart'
+
+
+def import_stripe(settings):
+    """Load the Stripe integration and its HTTP client ahead of the first paid checkout"""
+    try:
+        with get_metrics().time('process.stripe_import'):
+            from .stripe_client import get_stripe_checkout
+            get_stripe_checkout(settings)
+    except ImportError as e:
+        logger.warning('Stripe integration unavailable: %s', e)
+
+
+async def create_checkout(payload, settings):
+    """Create one Stripe checkout session for a cart and record its pending transaction"""
+    if not settings.stripe_api_key:
+        raise Exception('STRIPE_API_KEY not found')
+
+    origin_url = payload['origin_url']
+    metadata = payload.get('metadata', {})
+    # A cart of {package_id, quantity} lines, or the single package_id of the original API
+    items = payload.get('items') or [{'package_id': payload.get('package_id'), 'quantity': 1}]
+
+    # Validate and price every line from the catalog
+    with stage('catalog'):
+        lines = get_catalog(settings).price_cart(items)
+    package_id = lines[0].package.package_id if len(lines) == 1 else CART_PACKAGE_ID
+    label_package(package_id)
+
+    amount_cents = sum(line.amount_cents for line in lines)
+    amount = amount_cents / 100
+    is_test_free = len(lines) == 1 and lines[0].package.is_test and amount_cents == 0
+    if len(lines) == 1 and lines[0].quantity == 1:
+        pizza_name = lines[0].package.name
+    else:
+        pizza_name = ', '.join(f'{line.quantity} × {line.package.name}' for line in lines)
+    transaction_items = [
+        {
+            'package_id': line.package.package_id,
+            'pizza_name': line.package.name,
+            'quantity': line.quantity,
+            'unit_amount_cents': line.package.amount_cents,
+            'amount_cents': line.amount_cents,
+        }
+        for line in lines
+    ]
+
+    # Build success and cancel URLs
+    success_url = f'{origin_url}/pizza/success?session_id={{CHECKOUT_SESSION_ID}}'
+    cancel_url = f'{origin_url}/pizza'
+
+    # Add pizza info to metadata
+    metadata.update({
+        'package_id': package_id,
+        'pizza_name': pizza_name,
+        'items': ','.join(f'{line.package.package_id}:{line.quantity}' for line in lines),
+        'source': 'lucky_pizza_lannilis',
+        'created_at': utc_now().isoformat(),
+        'is_test_free': is_test_free
+    })
+
+    # Handle free pizza test case
+    if is_test_free:
+        fake_session_id = f'cs_test_free_{str(uuid4())[:8]}'
+
+        # Save transaction immediately as completed
+        transaction_data = {
+            'session_id': fake_session_id,
+            'package_id': package_id,
+            'pizza_name': pizza_name,
+            'items': transaction_items,
+            'amount': 0.00,
+            'amount_cents': 0,
+            'currency': 'EUR',
+            'payment_status': 'completed_test',
+            'status': 'test_success',
+            'metadata': metadata,
+            'created_at': utc_now(),
+            'updated_at': utc_now(),
+            'test_mode': True,
+            'notes': 'Pizza gratuite de test - aucun paiement requis'
+        }
+        with stage('insert_one'):
+            await db.get_pool().transactions.insert_one(transaction_data)
+
+        return {
+            'session_id': fake_session_id,
+            'url': success_url.replace('{CHECKOUT_SESSION_ID}', fake_session_id),
+            'amount': 0.00,
+            'currency': 'EUR',
+            'pizza_name': pizza_name,
+            'status': 'test_success',
+            'message': 'Pizza gratuite - commande confirmée automatiquement!'
+        }
+
+    # Normal Stripe checkout for paid pizzas
+    from emergentintegrations.payments.stripe.checkout import CheckoutSessionRequest
+    from .stripe_client import get_stripe_checkout
+
+    webhook_url = f'{origin_url}/api/webhook/stripe'
+    stripe_checkout = get_stripe_checkout(settings, webhook_url)
+    checkout_request = CheckoutSessionRequest(
+        amount=amount,
+        currency='eur',
+        success_url=success_url,
+        cancel_url=cancel_url,
+        metadata=metadata
+    )
+    with stage('stripe_session'):
+        session = await get_breaker(settings).call(stripe_checkout.create_checkout_session, checkout_request)
+
+    transaction_data = {
+        'session_id': session.session_id,
+        'package_id': package_id,
+        'pizza_name': pizza_name,
+        'items': transaction_items,
+        'amount': amount,
+        'amount_cents': amount_cents,
+        'currency': 'EUR',
+        'payment_status': 'pending',
+        'status': 'initiated',
+        'metadata': metadata,
+        'created_at': utc_now(),
+        'updated_at': utc_now()
+    }
+    # Inserted now, or buffered for a batched write-behind flush (write_behind.py)
+    await get_transaction_writer(settings).submit(transaction_data)
+
+    return {
+        'url': session.url,
+        'session_id': session.session_id,
+        'amount': amount,
+        'currency': 'EUR',
+        'pizza_name': pizza_name,
+        'items': transaction_items
+    }
+
+
+def _test_status(transaction):
+    """Status response for a free test pizza, which never goes through Stripe"""
+    return {
+        'session_id': transaction['session_id'],
+        'status': transaction.get('status', 'test_success'),
+        'payment_status': transaction.get('payment_status', 'completed_test'),
+        'amount_total': transaction.get('amount', 0),
+        'currency': transaction.get('currency', 'EUR'),
+        'pizza_name': transaction.get('pizza_name', ''),
+        'is_test': True,
+        'message': 'Pizza gratuite de test - commande confirmée!'
+    }
+
+
+def _status_from_transaction(transaction):
+    """Status response for a transaction already in a terminal state"""
+    status = transaction.get('status')
+    if transaction.get('payment_status') == 'paid' and status not in ('complete', 'test_success'):
+        # Webhook updates only record payment_status; a paid Checkout Session is complete
+        status = 'complete'
+    return {
+        'session_id': transaction['session_id'],
+        'status': status,
+        'payment_status': transaction.get('payment_status'),
+        'amount_total': transaction.get('amount_cents', int(round(transaction.get('amount', 0) * 100))),
+        'currency': transaction.get('currency', 'EUR').upper(),
+        'metadata': transaction.get('metadata', {})
+    }
+
+
+def status_update(transaction, checkout_status):
+    """``$set`` fields syncing a transaction with its Stripe status, or None if unchanged"""
+    # Update transaction status if payment completed and not already processed
+    if (checkout_status.payment_status == 'paid' and
+            transaction.get('payment_status') != 'paid'):
+        return {
+            'payment_status': checkout_status.payment_status,
+            'status': checkout_status.status,
+            'updated_at': utc_now(),
+            'completed_at': utc_now()
+        }
+
+    if (checkout_status.status in ['expired', 'canceled'] and
+            transaction.get('status') not in ['expired', 'canceled']):
+        return {
+            'payment_status': checkout_status.payment_status,
+            'status': checkout_status.status,
+            'updated_at': utc_now()
+        }
+    return None
+
+
+async def check_payment_status(payload, settings):
+    """Return the Stripe status of a session, syncing it into MongoDB
+
+    Sessions already in a terminal state are answered from the cache or
+    from MongoDB without calling Stripe. While the Stripe circuit breaker
+    is open, open sessions get their last recorded state, marked stale.
+    """
+    if not settings.stripe_api_key:
+        raise Exception('STRIPE_API_KEY not found')
+
+    session_id = payload['session_id']
+    status_cache = get_status_cache(settings)
+    with stage('cache'):
+        cached = status_cache.get(session_id)
+    if cached is not None:
+        return cached
+
+    # Check MongoDB first in case it's a test transaction
+    transactions_collection = db.get_pool().transactions
+    with stage('find_one'):
+        transaction = await transactions_collection.find_one({'session_id': session_id})
+    if transaction is None:
+        with stage('archive_find_one'):
+            transaction = await find_archived(session_id)
+    if transaction:
+        label_package(transaction.get('package_id'))
+
+    # Handle test free pizza sessions
+    if transaction and transaction.get('test_mode') == True:
+        return _test_status(transaction)
+
+    if transaction and is_terminal(transaction):
+        response = _status_from_transaction(transaction)
+        status_cache.put(session_id, response)
+        return response
+
+    from .stripe_client import get_stripe_checkout
+
+    breaker = get_breaker(settings)
+    try:
+        with stage('stripe_status'):
+            checkout_status = await breaker.call(get_stripe_checkout(settings).get_checkout_status, session_id)
+    except CircuitOpen:
+        if not transaction:
+            raise
+        # Not cached: the next poll after the breaker closes asks Stripe again
+        breaker.served_stale()
+        return {**_status_from_transaction(transaction), 'stale': True}
+
+    update_data = status_update(transaction, checkout_status) if transaction else None
+    if update_data:
+        with stage('update_one'):
+            await transactions_collection.update_one(
+                {'session_id': session_id},
+                {'$set': update_data}
+            )
+        logger.info('Transaction %s updated to %s', session_id, checkout_status.payment_status)
+        if update_data['payment_status'] == 'paid':
+            with stage('rollup'):
+                await record_paid([session_id])
+
+    response = {
+        'session_id': session_id,
+        'status': checkout_status.status,
+        'payment_status': checkout_status.payment_status,
+        'amount_total': checkout_status.amount_total,
+        'currency': checkout_status.currency.upper(),
+        'metadata': checkout_status.metadata
+    }
+    status_cache.put(session_id, response)
+    return response
+
+
+async def stored_status(session_id):
+    """Final status of a session as recorded in MongoDB, or None if it is still open"""
+    transaction = await db.get_pool().transactions.find_one({'session_id': session_id})
+    if transaction is None:
+        transaction = await find_archived(session_id)
+    if transaction is None:
+        return None
+    if transaction.get('test_mode') == True:
+        return _test_status(transaction)
+    if is_terminal(transaction):
+        return _status_from_transaction(transaction)
+    return None
+
+
+async def handle_stripe_webhook(payload, settings):
+    """Verify a Stripe webhook and queue it for the transaction update
+
+    The event is applied to MongoDB later, in batches, by the
+    ``WebhookConsumer`` running in the server process.
+    """
+    if not settings.stripe_api_key:
+        raise Exception('STRIPE_API_KEY not found')
+
+    from .stripe_client import get_stripe_checkout
+    from .webhook_queue import get_webhook_queue
+
+    # Raw request bytes, carried as the frame body: the signature covers them exactly
+    webhook_body = payload['body']
+    signature = payload['signature']
+
+    with stage('verify'):
+        webhook_response = await get_stripe_checkout(settings).handle_webhook(
+            webhook_body,
+            {'Stripe-Signature': signature}
+        )
+
+    event = {
+        'event_id': webhook_response.event_id,
+        'event_type': webhook_response.event_type,
+        'session_id': webhook_response.session_id,
+        'payment_status': webhook_response.payment_status,
+        # ISO string: the event is queued as JSON, see webhook_queue
+        'received_at': utc_now().isoformat()
+    }
+    with stage('enqueue'):
+        await asyncio.to_thread(get_webhook_queue(settings).append, event, webhook_body)
+
+    return {
+        'received': True,
+        'event_type': webhook_response.event_type,
+        'session_id': webhook_response.session_id
+    }
+
+
+async def health(payload, settings):
+    """Report whether this process can reach MongoDB"""
+    return {'mongo': await db.get_pool().ping_async()}
+
+
+async def process_stats(payload, settings):
+    """Counters kept by this process (collected from every worker by ``stats``)"""
+    stats = {
+        'pid': os.getpid(),
+        'stripe': None,
+        'breaker': get_breaker(settings).stats(),
+        'transactions': get_transaction_writer(settings).stats(),
+    }
+    # Only report the Stripe client if something loaded it; never load it for this.
+    # A worker imports it in a thread at start-up: it can be in sys.modules half-initialised
+    stripe_client = sys.modules.get('payment_service.stripe_client')
+    if hasattr(stripe_client, 'connection_stats'):
+        stats['stripe'] = stripe_client.connection_stats()
+    return stats
+
+
+async def process_metrics(payload, settings):
+    """Raw latency histograms of this process (merged across workers by ``metrics``)"""
+    return {'pid': os.getpid(), 'histograms': get_metrics().export(), 'breaker': get_breaker(settings).stats()}
+
+
+HANDLERS = {
+    'checkout': create_checkout,
+    'status': check_payment_status,
+    'webhook': handle_stripe_webhook,
+    'health': health,
+    'process_stats': process_stats,
+    'process_metrics': process_metrics,
+}
+
+
+async def dispatch(request, settings):
+    """Run one request through its handler and return the response dict"""
+    action = request.get('action')
+    handler = HANDLERS.get(action)
+    if handler is None:
+        return {'error': f'Unknown action: {action}'}
+
+    payload = request.get('payload') or {}
+    # A raw frame body (the webhook payload) reaches the handler as payload['body']
+    if BODY in request:
+        payload = {**payload, BODY: request[BODY]}
+
+    if action.startswith('process_'):
+        return await handler(payload, settings)
+
+    try:
+        with timed_request(action):
+            return await handler(payload, settings)
+    except Exception as e:
+        logger.exception('Payment action %s failed', action)
+        return {'error': str(e)}
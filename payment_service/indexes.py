@@ -0,0 +1,88 @@
+"""
+Index bootstrap for the payment collections.
+
+Status polls and webhooks look transactions up by ``session_id``; sweeps
+and reports filter on ``status``/``payment_status`` over time, archival on
+each settled state (``test_mode`` included) by ``updated_at``, and exports
+walk ``created_at`` in order; the webhook ledger relies on a unique
+``event_id``, the archive on a unique ``session_id`` (status fallback,
+resumable archival) and the daily rollups on a unique ``(date, package_id,
+source)``. The indexes below are created at startup (``create_index`` is a
+no-op when they already exist). In production a missing index is fatal:
+the service refuses to start rather than fall back to collection scans.
+"""
+
+import logging
+
+from pymongo import ASCENDING
+from pymongo.errors import PyMongoError
+
+from .db import ARCHIVE_COLLECTION, LEDGER_COLLECTION, ROLLUPS_COLLECTION, TRANSACTIONS_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+# Stripe retries a webhook for up to three days; keep ledger entries well past that
+LEDGER_RETENTION_SECONDS = 30 * 24 * 3600
+
+INDEXES = {
+    TRANSACTIONS_COLLECTION: [
+        {'keys': [('session_id', ASCENDING)], 'name': 'session_id_unique', 'unique': True},
+        {'keys': [('status', ASCENDING), ('created_at', ASCENDING)], 'name': 'status_created_at'},
+        {'keys': [('payment_status', ASCENDING), ('updated_at', ASCENDING)], 'name': 'payment_status_updated_at'},
+        {'keys': [('status', ASCENDING), ('updated_at', ASCENDING)], 'name': 'status_updated_at'},
+        # Only the free test pizzas carry test_mode
+        {'keys': [('test_mode', ASCENDING), ('updated_at', ASCENDING)], 'name': 'test_mode_updated_at',
+         'partialFilterExpression': {'test_mode': True}},
+        {'keys': [('created_at', ASCENDING)], 'name': 'created_at'},
+    ],
+    ARCHIVE_COLLECTION: [
+        {'keys': [('session_id', ASCENDING)], 'name': 'session_id_unique', 'unique': True},
+        {'keys': [('created_at', ASCENDING)], 'name': 'created_at'},
+    ],
+    ROLLUPS_COLLECTION: [
+        {'keys': [('date', ASCENDING), ('package_id', ASCENDING), ('source', ASCENDING)],
+         'name': 'date_package_source_unique', 'unique': True},
+    ],
+    LEDGER_COLLECTION: [
+        {'keys': [('event_id', ASCENDING)], 'name': 'event_id_unique', 'unique': True},
+        {'keys': [('recorded_at', ASCENDING)], 'name': 'recorded_at_ttl',
+         'expireAfterSeconds': LEDGER_RETENTION_SECONDS},
+    ],
+}
+
+
+class MissingIndexError(RuntimeError):
+    """Raised in production when a required index cannot be ensured"""
+
+
+def _ensure(collection, specs):
+    for spec in specs:
+        options = {k: v for k, v in spec.items() if k != 'keys'}
+        try:
+            collection.create_index(spec['keys'], **options)
+        except PyMongoError as e:
+            logger.error('Could not create index %s on %s: %s', spec['name'], collection.name, e)
+
+    try:
+        existing = collection.index_information()
+    except PyMongoError as e:
+        # MongoDB unreachable: count them all missing, production refuses to start
+        logger.error('Could not list the indexes of %s: %s', collection.name, e)
+        existing = {}
+    return [f'{collection.name}.{spec["name"]}' for spec in specs if spec['name'] not in existing]
+
+
+def ensure_indexes(pool, settings):
+    """Create the payment indexes; raise ``MissingIndexError`` in production if any is missing"""
+    missing = []
+    for name, specs in INDEXES.items():
+        missing += _ensure(pool.database[name], specs)
+
+    if missing:
+        message = f'Missing indexes: {", ".join(missing)}'
+        if settings.production:
+            raise MissingIndexError(message)
+        logger.warning(message)
+    else:
+        logger.info('Payment indexes are in place')
+    return missing
@@ -0,0 +1,88 @@
+"""
+Idempotency ledger for Stripe webhook events.
+
+Stripe delivers webhooks at least once, so the same ``event_id`` can come
+back several times. The ``WebhookConsumer`` filters every batch through
+``EventLedger`` before writing anything: duplicates of recent events are
+dropped by an O(1) lookup in a bounded in-memory LRU, older ones by a
+single ``$in`` read on the ledger collection, whose ``event_id`` index is
+unique. Applied events are recorded once their transaction update is
+written, so a crash in between replays the (idempotent) update rather
+than losing it.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from pymongo.errors import BulkWriteError
+
+from .db import LEDGER_COLLECTION, only_duplicate_keys
+
+
+class EventLedger:
+    def __init__(self, pool, max_recent):
+        self.collection = pool.collection(LEDGER_COLLECTION)
+        self.max_recent = max_recent
+        self._recent = OrderedDict()
+        self.seen = 0
+        self.duplicates_memory = 0
+        self.duplicates_ledger = 0
+
+    def _remember(self, event_id):
+        self._recent[event_id] = True
+        self._recent.move_to_end(event_id)
+        while len(self._recent) > self.max_recent:
+            self._recent.popitem(last=False)
+
+    async def filter_new(self, events):
+        """Drop events that were already applied, or repeated within ``events``"""
+        self.seen += len(events)
+        candidates = {}
+        for event in events:
+            event_id = event['event_id']
+            if event_id in self._recent or event_id in candidates:
+                self.duplicates_memory += 1
+            else:
+                candidates[event_id] = event
+        if not candidates:
+            return []
+
+        known = await self.collection.find_all({'event_id': {'$in': list(candidates)}}, {'event_id': 1})
+        for doc in known:
+            self.duplicates_ledger += 1
+            self._remember(doc['event_id'])
+            del candidates[doc['event_id']]
+        return list(candidates.values())
+
+    async def record(self, events):
+        """Mark events as applied"""
+        if not events:
+            return
+        recorded_at = datetime.now(timezone.utc)
+        documents = [
+            {
+                'event_id': e['event_id'],
+                'event_type': e['event_type'],
+                'session_id': e['session_id'],
+                'recorded_at': recorded_at
+            }
+            for e in events
+        ]
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Another consumer recorded some of them first; anything else is a real failure
+            if not only_duplicate_keys(e):
+                raise
+        for e in events:
+            self._remember(e['event_id'])
+
+    def stats(self):
+        duplicates = self.duplicates_memory + self.duplicates_ledger
+        return {
+            'seen': self.seen,
+            'duplicates': duplicates,
+            'duplicates_memory': self.duplicates_memory,
+            'duplicates_ledger': self.duplicates_ledger,
+            'hit_rate': duplicates / self.seen if self.seen else 0.0,
+        }
@@ -0,0 +1,358 @@
+"""
+In-memory storage backend (``PAYMENT_STORAGE=memory``).
+
+``MemoryPool`` stands in for ``MongoPool`` in tests and benchmarks: same
+``collection``/``transactions``/``database`` surface, same pymongo call
+semantics for the subset the payment code uses (``find_one``, ``find``,
+``insert_one``/``insert_many``, ``update_one``/``update_many``/
+``find_one_and_update`` with ``$set``/``$inc``/``$setOnInsert``/``$unset``
+and upserts, ``$type`` for strings and dates, ``delete_many``,
+``bulk_write`` of ``UpdateOne``, unique indexes raising
+``DuplicateKeyError``/``BulkWriteError``). Documents are copied in and
+out, so callers can't mutate stored state. Aggregation pipelines (the
+rollup rebuild) are not supported.
+
+Calls run inline on the event loop (no executor), which keeps database
+noise out of handler profiles. Data lives in one process only: the server
+runs the handlers itself instead of using the worker pool.
+"""
+
+import copy
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+from .db import DUPLICATE_KEY_ERROR, TRANSACTIONS_COLLECTION, AsyncCollection
+
+_MISSING = object()
+_BSON_TYPES = {'string': str, 'date': datetime}
+
+
+def _get(document, path):
+    for part in path.split('.'):
+        if not isinstance(document, dict) or part not in document:
+            return _MISSING
+        document = document[part]
+    return document
+
+
+def _set(document, path, value):
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def _unset(document, path):
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(last, None)
+
+
+def _compare(value, operator, operand):
+    if operator == '$eq':
+        return value is not _MISSING and value == operand
+    if operator == '$ne':
+        return value is _MISSING or value != operand
+    if operator == '$in':
+        return value is not _MISSING and value in operand
+    if operator == '$nin':
+        return value is _MISSING or value not in operand
+    if operator == '$exists':
+        return (value is not _MISSING) == bool(operand)
+    if operator == '$type':
+        return isinstance(value, _BSON_TYPES[operand])
+    if value is _MISSING or value is None:
+        return False
+    try:
+        if operator == '$lt':
+            return value < operand
+        if operator == '$lte':
+            return value <= operand
+        if operator == '$gt':
+            return value > operand
+        if operator == '$gte':
+            return value >= operand
+    except TypeError:
+        # MongoDB never matches range queries across types
+        return False
+    raise ValueError(f'Unsupported query operator: {operator}')
+
+
+def matches(document, filter):
+    """Whether ``document`` satisfies a MongoDB query ``filter``"""
+    for key, condition in (filter or {}).items():
+        if key == '$and':
+            if not all(matches(document, f) for f in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(document, f) for f in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            value = _get(document, key)
+            if not all(_compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif not _compare(_get(document, key), '$eq', condition):
+            return False
+    return True
+
+
+def _project(document, projection):
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, 1)
+    include_id = projection.get('_id', 1)
+    fields = {k: v for k, v in projection.items() if k != '_id'}
+    if any(fields.values()):
+        projected = {k: document[k] for k in fields if fields[k] and k in document}
+        if include_id and '_id' in document:
+            projected['_id'] = document['_id']
+        return projected
+    for k in fields:
+        document.pop(k, None)
+    if not include_id:
+        document.pop('_id', None)
+    return document
+
+
+class _Cursor:
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._documents)
+
+    def close(self):
+        self._documents = iter(())
+
+
+class MemoryCollection:
+    """The pymongo ``Collection`` subset used by the payment service, held in a dict"""
+
+    def __init__(self, name):
+        self.name = name
+        self._documents = {}
+        self._indexes = {'_id_': {'key': [('_id', 1)], 'unique': True}}
+        # Single-field unique indexes double as hash lookups: field -> value -> _id
+        self._unique = {'_id': {}}
+
+    # Indexes
+
+    def create_index(self, keys, name=None, unique=False, **options):
+        name = name or '_'.join(f'{field}_{direction}' for field, direction in keys)
+        self._indexes[name] = {'key': list(keys), 'unique': unique, **options}
+        if unique and len(keys) == 1 and keys[0][0] not in self._unique:
+            field = keys[0][0]
+            lookup = {}
+            for _id, document in self._documents.items():
+                value = _get(document, field)
+                if value is not _MISSING:
+                    lookup[value] = _id
+            self._unique[field] = lookup
+        return name
+
+    def index_information(self):
+        return copy.deepcopy(self._indexes)
+
+    def _check_unique(self, document, ignore_id=None):
+        for field, lookup in self._unique.items():
+            value = _get(document, field)
+            if value is not _MISSING and lookup.get(value, ignore_id) != ignore_id:
+                raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} dup key: '
+                                        f'{{ {field}: {value!r} }}', DUPLICATE_KEY_ERROR)
+
+    def _index(self, document):
+        for field, lookup in self._unique.items():
+            value = _get(document, field)
+            if value is not _MISSING:
+                lookup[value] = document['_id']
+
+    def _unindex(self, document):
+        for field, lookup in self._unique.items():
+            value = _get(document, field)
+            if value is not _MISSING and lookup.get(value) == document['_id']:
+                del lookup[value]
+
+    # Reads
+
+    def _candidates(self, filter):
+        for field, lookup in self._unique.items():
+            value = (filter or {}).get(field, _MISSING)
+            if value is not _MISSING and not isinstance(value, dict):
+                _id = lookup.get(value)
+                return [self._documents[_id]] if _id is not None else []
+        return list(self._documents.values())
+
+    def _match(self, filter):
+        return [d for d in self._candidates(filter) if matches(d, filter)]
+
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, batch_size=None):
+        documents = self._match(filter)
+        for field, direction in reversed(sort or []):
+            present = [d for d in documents if _get(d, field) not in (_MISSING, None)]
+            absent = [d for d in documents if _get(d, field) in (_MISSING, None)]
+            present.sort(key=lambda d: _get(d, field), reverse=direction < 0)
+            # Missing/null sort first ascending, last descending, as in MongoDB
+            documents = absent + present if direction > 0 else present + absent
+        documents = documents[skip:]
+        if limit:
+            documents = documents[:limit]
+        return _Cursor(_project(d, projection) for d in documents)
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        return next(self.find(filter, projection, limit=1, **kwargs), None)
+
+    def count_documents(self, filter):
+        return len(self._match(filter))
+
+    # Writes
+
+    def insert_one(self, document):
+        document.setdefault('_id', ObjectId())
+        stored = copy.deepcopy(document)
+        self._check_unique(stored)
+        self._documents[stored['_id']] = stored
+        self._index(stored)
+        return InsertOneResult(document['_id'], acknowledged=True)
+
+    def insert_many(self, documents, ordered=True):
+        inserted, errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted.append(self.insert_one(document).inserted_id)
+            except DuplicateKeyError as e:
+                errors.append({'index': index, 'code': DUPLICATE_KEY_ERROR, 'errmsg': str(e), 'op': document})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted), 'nUpserted': 0,
+                                  'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []})
+        return InsertManyResult(inserted, acknowledged=True)
+
+    def _apply(self, document, update, inserting=False):
+        for operator, fields in update.items():
+            if operator == '$set' or (operator == '$setOnInsert' and inserting):
+                for path, value in fields.items():
+                    _set(document, path, copy.deepcopy(value))
+            elif operator == '$inc':
+                for path, amount in fields.items():
+                    current = _get(document, path)
+                    _set(document, path, (0 if current is _MISSING else current) + amount)
+            elif operator == '$unset':
+                for path in fields:
+                    _unset(document, path)
+            elif operator != '$setOnInsert':
+                raise ValueError(f'Unsupported update operator: {operator}')
+
+    def update_one(self, filter, update, upsert=False):
+        matched = self._match(filter)[:1]
+        if matched:
+            document = matched[0]
+            updated = copy.deepcopy(document)
+            self._apply(updated, update)
+            self._check_unique(updated, ignore_id=document['_id'])
+            self._unindex(document)
+            modified = updated != document
+            self._documents[document['_id']] = updated
+            self._index(updated)
+            return UpdateResult({'n': 1, 'nModified': int(modified), 'ok': 1.0}, acknowledged=True)
+        if not upsert:
+            return UpdateResult({'n': 0, 'nModified': 0, 'ok': 1.0}, acknowledged=True)
+
+        document = {k: copy.deepcopy(v) for k, v in filter.items()
+                    if not k.startswith('$') and not (isinstance(v, dict) and any(o.startswith('$') for o in v))}
+        self._apply(document, update, inserting=True)
+        _id = self.insert_one(document).inserted_id
+        return UpdateResult({'n': 1, 'nModified': 0, 'upserted': _id, 'ok': 1.0}, acknowledged=True)
+
+    def update_many(self, filter, update):
+        matched = modified = 0
+        for document in self._match(filter):
+            result = self.update_one({'_id': document['_id']}, update)
+            matched += result.matched_count
+            modified += result.modified_count
+        return UpdateResult({'n': matched, 'nModified': modified, 'ok': 1.0}, acknowledged=True)
+
+    def delete_many(self, filter):
+        deleted = self._match(filter)
+        for document in deleted:
+            self._unindex(document)
+            del self._documents[document['_id']]
+        return DeleteResult({'n': len(deleted), 'ok': 1.0}, acknowledged=True)
+
+    def find_one_and_update(self, filter, update, projection=None, return_document=ReturnDocument.BEFORE):
+        matched = self._match(filter)[:1]
+        if not matched:
+            return None
+        before = _project(matched[0], projection)
+        self.update_one({'_id': matched[0]['_id']}, update)
+        if return_document == ReturnDocument.AFTER:
+            return _project(self._documents[matched[0]['_id']], projection)
+        return before
+
+    def bulk_write(self, requests, ordered=True):
+        result = {'writeErrors': [], 'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0,
+                  'nRemoved': 0, 'upserted': []}
+        for index, request in enumerate(requests):
+            if not isinstance(request, UpdateOne):
+                raise ValueError(f'Unsupported bulk operation: {type(request).__name__}')
+            try:
+                # pymongo keeps the operation's arguments on these attributes
+                outcome = self.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+            except DuplicateKeyError as e:
+                result['writeErrors'].append({'index': index, 'code': DUPLICATE_KEY_ERROR, 'errmsg': str(e)})
+                if ordered:
+                    break
+                continue
+            if 'upserted' in outcome.raw_result:
+                result['nUpserted'] += 1
+                result['upserted'].append({'index': index, '_id': outcome.upserted_id})
+            else:
+                result['nMatched'] += outcome.matched_count
+                result['nModified'] += outcome.modified_count
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, acknowledged=True)
+
+
+class _MemoryDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = MemoryCollection(name)
+        return collection
+
+
+class MemoryPool:
+    def __init__(self, settings):
+        self.settings = settings
+        self.database = _MemoryDatabase()
+
+    def collection(self, name):
+        return AsyncCollection(self.database[name], None)
+
+    @property
+    def transactions(self):
+        return self.collection(TRANSACTIONS_COLLECTION)
+
+    def ping(self):
+        return True
+
+    def warm_up(self):
+        return True
+
+    async def ping_async(self):
+        return True
+
+    def close(self):
+        self.database.clear()
+
@@ -0,0 +1,241 @@
+"""
+Per-stage latency histograms for the payment handlers.
+
+``dispatch`` wraps every request in ``timed_request``; handlers mark their
+steps (catalog lookup, Stripe call, MongoDB read or write, ...) with
+``stage`` and the durations are recorded under ``<action>.<stage>`` once
+the request ends, labelled with its ``package_id`` when one is known, along
+with ``<action>.total`` (``<action>.failed`` when it raised). Process-level
+costs (worker start-up, MongoDB connect, Stripe SDK import) are recorded
+under ``process.*``. Durations go into ``Histogram``, an HDR-style
+log-linear histogram: 32 linear sub-buckets per power of two of
+microseconds, so any value is reported within ~3% whatever its magnitude,
+in constant memory and with counts that merge exactly across processes.
+
+Every process keeps its own ``Metrics``; the server collects the raw
+histograms from its workers, merges them and serves p50/p90/p99 per stage
+and per package on ``GET /metrics`` (local HTTP listener, see
+``serve_metrics``) and through the ``metrics`` action.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+PERCENTILES = (50, 90, 99)
+
+_metrics = None
+_current_timer = ContextVar('payment_request_timer', default=None)
+
+
+def _bucket(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def _bucket_high(index):
+    """Highest value that falls in bucket ``index``"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+
+class Histogram:
+    """Log-linear histogram of microsecond durations"""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, micros):
+        micros = max(int(micros), 0)
+        index = _bucket(micros)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += micros
+        self.max = max(self.max, micros)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        rank = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(_bucket_high(index), self.max)
+        return self.max
+
+    def summary(self):
+        summary = {'count': self.count}
+        for percent in PERCENTILES:
+            summary[f'p{percent}_ms'] = round(self.percentile(percent) / 1000, 2)
+        summary['max_ms'] = round(self.max / 1000, 2)
+        summary['mean_ms'] = round(self.total / self.count / 1000, 2) if self.count else 0.0
+        return summary
+
+    def export(self):
+        return {'counts': self.counts, 'count': self.count, 'total': self.total, 'max': self.max}
+
+    def merge(self, exported):
+        for index, count in exported['counts'].items():
+            index = int(index)
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += exported['count']
+        self.total += exported['total']
+        self.max = max(self.max, exported['max'])
+
+
+class Metrics:
+    """Histograms keyed by ``(stage, package_id)``; ``package_id`` None is the all-packages view"""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, stage, seconds, package_id=None):
+        micros = seconds * 1_000_000
+        keys = [(stage, None)] if package_id is None else [(stage, None), (stage, package_id)]
+        for key in keys:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(micros)
+
+    @contextmanager
+    def time(self, stage, package_id=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, package_id)
+
+    def export(self):
+        """Raw histograms, JSON-serialisable, for merging in another process"""
+        return [
+            {'stage': stage, 'package_id': package_id, 'histogram': histogram.export()}
+            for (stage, package_id), histogram in self.histograms.items()
+        ]
+
+    def merge(self, exported):
+        for entry in exported:
+            key = (entry['stage'], entry['package_id'])
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.merge(entry['histogram'])
+
+    def summary(self):
+        stages, packages = {}, {}
+        ordered = sorted(self.histograms.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+        for (stage, package_id), histogram in ordered:
+            if package_id is None:
+                stages[stage] = histogram.summary()
+            else:
+                packages.setdefault(package_id, {})[stage] = histogram.summary()
+        return {'stages': stages, 'packages': packages}
+
+
+class RequestTimer:
+    """Stage timings of one request, recorded together when it finishes"""
+
+    def __init__(self, action, metrics=None):
+        self.action = action
+        self.metrics = metrics or get_metrics()
+        self.package_id = None
+        self.failed = False
+        self.stages = []
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - started))
+
+    def finish(self):
+        self.stages.append(('failed' if self.failed else 'total', time.perf_counter() - self.started))
+        for name, seconds in self.stages:
+            self.metrics.record(f'{self.action}.{name}', seconds, self.package_id)
+
+
+def get_metrics():
+    """Process-wide metrics registry"""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+@contextmanager
+def timed_request(action):
+    """Collect the stages of one request and record them when it ends"""
+    timer = RequestTimer(action)
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    except BaseException:
+        timer.failed = True
+        raise
+    finally:
+        _current_timer.reset(token)
+        timer.finish()
+
+
+@contextmanager
+def stage(name):
+    """Time one step of the current request (a no-op outside ``timed_request``)"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def label_package(package_id):
+    """Attach the current request's timings to ``package_id``"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.package_id = package_id
+
+
+async def _handle_http(reader, writer, collect):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', json.dumps(await collect()).encode()
+        else:
+            status, body = '404 Not Found', b'{"error": "Not found"}'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        logger.exception('Metrics request failed')
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host, port, collect):
+    """Local HTTP listener answering ``GET /metrics`` with ``await collect()`` as JSON"""
+    server = await asyncio.start_server(lambda r, w: _handle_http(r, w, collect), host, port)
+    logger.info('Payment metrics on http://%s:%d/metrics', host, port)
+    return server
@@ -0,0 +1,241 @@
+"""
+Supervised pool of payment worker processes.
+
+The server process owns N ``python3 -m payment_service worker`` children and
+talks to each of them over its stdin/stdout pipes. Every request goes to the
+least-loaded worker; each worker runs up to ``worker_concurrency`` requests at
+once on its own event loop. Requests that find every worker busy wait in a
+queue bounded by ``queue_size`` and are refused beyond that, so a burst of
+status polls can never fork more interpreters than the pool size.
+
+A worker is recycled once it has been given ``worker_max_requests`` requests:
+its replacement is started straight away, it stops receiving work, and it is
+told to exit when its last in-flight request completes. Workers that die are
+respawned and their in-flight requests fail with an error.
+
+Each worker runs in a slot. A slot whose worker keeps dying, or cannot be
+started at all, is restarted after an exponential backoff from
+``worker_restart_delay`` up to ``worker_restart_max_delay`` seconds; the
+backoff resets once one of its workers answers a request. Once
+``worker_crash_limit`` workers died within ``worker_crash_window``
+seconds and no worker is left, queued and new requests are refused at
+once instead of waiting for a restart that is likely to crash again.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import time
+from collections import deque
+
+from .config import PROJECT_DIR
+from .protocol import MAX_MESSAGE_BYTES, encode, read_message
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceBusy(Exception):
+    """Raised when the pool queue is full"""
+
+
+class _Worker:
+    def __init__(self, process, slot):
+        self.process = process
+        self.slot = slot
+        self.pending = {}
+        self.in_flight = 0
+        self.dispatched = 0
+        self.retiring = False
+
+
+class WorkerPool:
+    def __init__(self, settings):
+        self.settings = settings
+        self._workers = []
+        self._ids = itertools.count(1)
+        self._waiting = 0
+        self._capacity = asyncio.Condition()
+        self._closing = False
+        self._closed = asyncio.Event()
+        self._readers = set()
+        # Consecutive crashes per slot, and the recent crash times of the whole pool
+        self._failures = [0] * settings.workers
+        self._crashes = deque()
+
+    async def start(self):
+        for slot in range(self.settings.workers):
+            self._workers.append(await self._spawn(slot))
+        logger.info('Started %d payment workers', len(self._workers))
+
+    async def close(self):
+        self._closing = True
+        self._closed.set()
+        for worker in list(self._workers):
+            self._stop(worker)
+        await asyncio.gather(*(w.process.wait() for w in self._workers), return_exceptions=True)
+        # Slots backing off wake up and give up
+        await asyncio.gather(*self._readers, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'workers': [
+                {'pid': w.process.pid, 'in_flight': w.in_flight, 'dispatched': w.dispatched, 'retiring': w.retiring}
+                for w in self._workers
+            ],
+            'queued': self._waiting,
+            'recent_crashes': self._recent_crashes(),
+        }
+
+    async def broadcast(self, request):
+        """Send a request to every live worker, outside the queue; returns their responses"""
+        workers = [w for w in self._workers if not w.process.stdin.is_closing()]
+        return await asyncio.gather(*(self._send(w, request) for w in workers), return_exceptions=True)
+
+    async def submit(self, request):
+        """Send a request to the least-loaded worker and return its response"""
+        if self._waiting >= self.settings.queue_size:
+            raise ServiceBusy('Payment service busy, please retry')
+
+        self._waiting += 1
+        try:
+            async with self._capacity:
+                await self._capacity.wait_for(lambda: self._pick() is not None or self._crash_looping())
+                worker = self._pick()
+                if worker is None:
+                    raise ServiceBusy('Payment workers keep crashing, please retry')
+                worker.in_flight += 1
+                worker.dispatched += 1
+                if worker.dispatched >= self.settings.worker_max_requests:
+                    self._retire(worker)
+        finally:
+            self._waiting -= 1
+
+        try:
+            return await self._send(worker, request)
+        finally:
+            worker.in_flight -= 1
+            if worker.retiring and worker.in_flight == 0:
+                self._stop(worker)
+            async with self._capacity:
+                self._capacity.notify()
+
+    def _pick(self):
+        candidates = [
+            w for w in self._workers
+            if not w.retiring and w.in_flight < self.settings.worker_concurrency
+        ]
+        return min(candidates, key=lambda w: w.in_flight, default=None)
+
+    def _recent_crashes(self):
+        horizon = time.monotonic() - self.settings.worker_crash_window
+        while self._crashes and self._crashes[0] < horizon:
+            self._crashes.popleft()
+        return len(self._crashes)
+
+    def _crash_looping(self):
+        """Too many recent crashes and no worker left to serve requests"""
+        return (self._recent_crashes() >= self.settings.worker_crash_limit
+                and not any(not w.retiring for w in self._workers))
+
+    async def _send(self, worker, request):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        worker.pending[request_id] = future
+        worker.process.stdin.write(encode({'id': request_id, **request}))
+        await worker.process.stdin.drain()
+        return await future
+
+    async def _spawn(self, slot):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'payment_service', 'worker',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=PROJECT_DIR,
+            limit=MAX_MESSAGE_BYTES,
+            # Lets the worker time its own start-up, interpreter included
+            env={**os.environ, 'PAYMENT_WORKER_SPAWNED_AT': repr(time.time())},
+        )
+        worker = _Worker(process, slot)
+        reader = asyncio.create_task(self._read_responses(worker))
+        self._readers.add(reader)
+        reader.add_done_callback(self._readers.discard)
+        return worker
+
+    async def _respawn(self, slot, crashed):
+        """Start a worker in ``slot``, backing off while the slot keeps failing; returns it, or None once closing"""
+        while not self._closing:
+            if crashed:
+                delay = min(self.settings.worker_restart_delay * 2 ** (self._failures[slot] - 1),
+                            self.settings.worker_restart_max_delay)
+                try:
+                    await asyncio.wait_for(self._closed.wait(), delay)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                worker = await self._spawn(slot)
+            except Exception:
+                logger.exception('Could not start payment worker slot %d, retrying', slot)
+                self._failures[slot] += 1
+                crashed = True
+                continue
+            self._workers.append(worker)
+            if self._closing:
+                self._stop(worker)
+            async with self._capacity:
+                self._capacity.notify_all()
+            return worker
+        return None
+
+    def _retire(self, worker):
+        worker.retiring = True
+        asyncio.create_task(self._replace(worker))
+
+    async def _replace(self, worker):
+        replacement = await self._respawn(worker.slot, crashed=False)
+        if replacement is not None:
+            logger.info('Recycling payment worker %d, replaced by %d', worker.process.pid, replacement.process.pid)
+
+    def _stop(self, worker):
+        if not worker.process.stdin.is_closing():
+            worker.process.stdin.close()
+
+    async def _read_responses(self, worker):
+        try:
+            while True:
+                message = await read_message(worker.process.stdout)
+                if message is None:
+                    break
+                # Answering requests: the slot is healthy again
+                self._failures[worker.slot] = 0
+                future = worker.pending.pop(message['id'], None)
+                if future is not None and not future.done():
+                    future.set_result(message['response'])
+        except Exception:
+            logger.exception('Lost the response stream of payment worker %d', worker.process.pid)
+        finally:
+            await self._on_exit(worker)
+
+    async def _on_exit(self, worker):
+        await worker.process.wait()
+        for future in worker.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Payment worker exited'))
+        worker.pending.clear()
+
+        if worker in self._workers:
+            self._workers.remove(worker)
+        crashed = not worker.retiring and not self._closing
+        if crashed:
+            self._failures[worker.slot] += 1
+            self._crashes.append(time.monotonic())
+            logger.warning('Payment worker %d exited with %s, respawning slot %d (crash %d in a row)',
+                           worker.process.pid, worker.process.returncode, worker.slot, self._failures[worker.slot])
+
+        # Waiting requests may now have to be refused
+        async with self._capacity:
+            self._capacity.notify_all()
+        if crashed:
+            await self._respawn(worker.slot, crashed=True)
@@ -0,0 +1,64 @@
+"""
+Wire format shared by the Unix socket server and the worker pipes.
+
+Every message is one length-prefixed frame::
+
+    header length (uint32, big-endian) | body length (uint32, big-endian)
+    JSON header | raw body
+
+The JSON header is the message itself. The raw body is optional and carries
+bytes that must reach the other side untouched, without JSON escaping or
+any text decoding: the Stripe webhook payload, whose signature covers its
+exact bytes, and the chunks of a streamed export. On either side it is the
+message's ``body`` key, as ``bytes``.
+"""
+
+import asyncio
+import json
+import struct
+
+# Stripe webhook payloads stay well under this, but they are not tiny
+MAX_MESSAGE_BYTES = 1024 * 1024
+
+BODY = 'body'
+FRAME_PREFIX = struct.Struct('>II')
+
+
+def encode(message):
+    """Serialise one message for the wire; a ``bytes`` body travels raw after the header"""
+    body = message.get(BODY)
+    if isinstance(body, (bytes, bytearray)):
+        message = {key: value for key, value in message.items() if key != BODY}
+    else:
+        body = b''
+    header = json.dumps(message).encode()
+    return FRAME_PREFIX.pack(len(header), len(body)) + header + body
+
+
+async def read_message(reader):
+    """Read the next message from a stream, or ``None`` at end of stream
+
+    Raises ``ValueError`` for a truncated, oversized or undecodable frame;
+    the stream cannot be resynchronised after that.
+    """
+    try:
+        prefix = await reader.readexactly(FRAME_PREFIX.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ValueError('Truncated frame') from e
+    header_length, body_length = FRAME_PREFIX.unpack(prefix)
+    if header_length + body_length > MAX_MESSAGE_BYTES:
+        raise ValueError(f'Frame of {header_length + body_length} bytes exceeds {MAX_MESSAGE_BYTES}')
+    try:
+        header = await reader.readexactly(header_length)
+        body = await reader.readexactly(body_length)
+    except asyncio.IncompleteReadError as e:
+        raise ValueError('Truncated frame') from e
+
+    message = json.loads(header)
+    if not isinstance(message, dict):
+        raise ValueError('Frame header is not a JSON object')
+    if body_length:
+        message[BODY] = body
+    return message
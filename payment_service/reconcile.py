@@ -0,0 +1,100 @@
+"""
+Reconciliation of pending transactions with Stripe.
+
+A transaction created by ``create_checkout`` stays ``pending`` until a
+webhook lands or the customer's browser polls its status. Abandoned
+sessions never get either. ``reconcile_pending`` streams pending
+transactions older than a cutoff from a server-side cursor, looks each
+batch up on Stripe concurrently (bounded by a semaphore, optionally
+rate-limited) and writes the changes back with one ``bulk_write`` per
+batch. Lookups go through the Stripe circuit breaker; the sweep stops
+early once it opens and the next one picks up the rest. The server runs it
+every ``reconcile_interval`` seconds; it can also be run by hand with
+``python3 -m payment_service reconcile``.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from pymongo import UpdateOne
+
+from . import db
+from .breaker import CircuitOpen, get_breaker
+from .handlers import status_update
+from .rollups import record_paid
+from .timestamps import utc_now
+
+logger = logging.getLogger(__name__)
+
+
+async def reconcile_pending(settings, older_than=None, concurrency=None, batch_size=None, max_rate=None):
+    """Sync pending transactions with Stripe; returns counters and sessions/s"""
+    older_than = settings.reconcile_age if older_than is None else older_than
+    concurrency = concurrency or settings.reconcile_concurrency
+    batch_size = batch_size or settings.reconcile_batch_size
+    max_rate = settings.reconcile_max_rate if max_rate is None else max_rate
+
+    from .stripe_client import get_stripe_checkout
+
+    transactions = db.get_pool().transactions
+    stripe_checkout = get_stripe_checkout(settings)
+    breaker = get_breaker(settings)
+    semaphore = asyncio.Semaphore(concurrency)
+    cutoff = utc_now() - timedelta(seconds=older_than)
+    stats = {'processed': 0, 'updated': 0, 'failed': 0, 'skipped': 0}
+
+    async def lookup(transaction):
+        async with semaphore:
+            try:
+                checkout_status = await breaker.call(stripe_checkout.get_checkout_status, transaction['session_id'])
+            except CircuitOpen:
+                stats['skipped'] += 1
+                return None
+            except Exception as e:
+                logger.warning('Reconcile lookup failed for %s: %s', transaction['session_id'], e)
+                stats['failed'] += 1
+                return None
+        update_data = status_update(transaction, checkout_status)
+        if update_data is None:
+            return None
+        if update_data['payment_status'] == 'paid':
+            paid.append(transaction['session_id'])
+        return UpdateOne({'session_id': transaction['session_id']}, {'$set': update_data})
+
+    started = time.monotonic()
+    query = {'status': 'initiated', 'payment_status': 'pending', 'created_at': {'$lt': cutoff}}
+    async for batch in transactions.iter_batches(query, batch_size, projection={'_id': 0}):
+        batch_started = time.monotonic()
+        paid = []
+        updates = [u for u in await asyncio.gather(*(lookup(t) for t in batch)) if u is not None]
+        if updates:
+            await transactions.bulk_write(updates, ordered=False)
+            await record_paid(paid)
+        stats['processed'] += len(batch)
+        stats['updated'] += len(updates)
+        if stats['skipped']:
+            logger.warning('Stripe circuit breaker open, stopping the reconcile sweep')
+            break
+
+        if max_rate:
+            # Pace the sweep so it never exceeds max_rate Stripe lookups per second
+            await asyncio.sleep(max(0.0, len(batch) / max_rate - (time.monotonic() - batch_started)))
+
+    elapsed = time.monotonic() - started
+    stats['elapsed_seconds'] = round(elapsed, 3)
+    stats['sessions_per_second'] = round(stats['processed'] / elapsed, 1) if elapsed else 0.0
+    logger.info('Reconciled %(processed)d pending transactions (%(updated)d updated, %(failed)d failed, '
+                '%(skipped)d skipped) at %(sessions_per_second).1f sessions/s', stats)
+    return stats
+
+
+async def run_periodically(settings):
+    """Background sweep loop for the server process"""
+    while True:
+        await asyncio.sleep(settings.reconcile_interval)
+        try:
+            await reconcile_pending(settings)
+        except Exception:
+            logger.exception('Reconciliation sweep failed')
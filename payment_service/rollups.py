@@ -0,0 +1,169 @@
+"""
+Daily sales rollups, maintained as transactions get paid.
+
+``daily_rollups`` holds one document per ``(date, package_id, source)``
+with the number of paid ``orders`` containing that pizza, the pizzas sold
+(``quantity``) and their ``amount_cents``, so a sales report reads one
+document per day and pizza instead of scanning ``payment_transactions``.
+A cart transaction counts under each of its ``items``.
+
+Every path that can mark a transaction ``paid`` (webhook consumer, status
+check, reconcile sweep) calls ``record_paid`` afterwards. It claims each
+transaction with a ``find_one_and_update`` that sets ``rolled_up`` only if
+it is paid and not yet counted, so whichever path gets there first adds it
+to the rollup with one ``$inc`` upsert and the others do nothing. The
+claim comes before the ``$inc``: a crash in between under-counts that one
+order until the next ``rebuild_rollups``, it never counts it twice.
+
+``rebuild_rollups`` recomputes the whole collection from the transactions,
+archived ones included, in one aggregation pass (``$unionWith``,
+``$group`` then ``$out``). Run it when webhooks are quiet: an order
+counted incrementally while it runs may be counted twice.
+"""
+
+import logging
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from . import db
+from .db import ARCHIVE_COLLECTION, ROLLUPS_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOURCE = 'unknown'
+
+
+def _day(value):
+    """``YYYY-MM-DD`` of an ISO timestamp string or a datetime"""
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    return str(value)[:10]
+
+
+def transaction_items(transaction):
+    """Cart lines of a transaction; single-pizza transactions from before carts are one line"""
+    return transaction.get('items') or [{
+        'package_id': transaction.get('package_id'),
+        'pizza_name': transaction.get('pizza_name', ''),
+        'quantity': 1,
+        'amount_cents': transaction.get('amount_cents', 0),
+    }]
+
+
+def _increments(transaction):
+    paid_at = transaction.get('completed_at') or transaction.get('updated_at') or transaction['created_at']
+    source = (transaction.get('metadata') or {}).get('source') or DEFAULT_SOURCE
+    return [
+        UpdateOne(
+            {'date': _day(paid_at), 'package_id': item['package_id'], 'source': source},
+            {
+                '$inc': {'orders': 1, 'quantity': item['quantity'], 'amount_cents': item['amount_cents']},
+                '$setOnInsert': {'pizza_name': item['pizza_name']},
+            },
+            upsert=True,
+        )
+        for item in transaction_items(transaction)
+    ]
+
+
+async def record_paid(session_ids):
+    """Count newly paid transactions into ``daily_rollups``; returns how many were counted"""
+    transactions = db.get_pool().transactions
+    increments, counted = [], 0
+    for session_id in dict.fromkeys(session_ids):
+        claimed = await transactions.find_one_and_update(
+            {'session_id': session_id, 'payment_status': 'paid', 'rolled_up': {'$exists': False}},
+            {'$set': {'rolled_up': True}},
+            projection={'_id': 0, 'metadata': 1, 'package_id': 1, 'pizza_name': 1, 'amount_cents': 1, 'items': 1,
+                        'completed_at': 1, 'updated_at': 1, 'created_at': 1},
+        )
+        if claimed is not None:
+            counted += 1
+            increments += _increments(claimed)
+    if increments:
+        await db.get_pool().collection(ROLLUPS_COLLECTION).bulk_write(increments, ordered=False)
+    return counted
+
+
+def _day_expression(field):
+    # ISO strings and BSON dates (rendered as ISO by $toString) both start with YYYY-MM-DD
+    return {'$substrCP': [{'$toString': field}, 0, 10]}
+
+
+PAID = {'payment_status': 'paid', 'test_mode': {'$ne': True}}
+
+REBUILD_PIPELINE = [
+    {'$match': PAID},
+    {'$unionWith': {'coll': ARCHIVE_COLLECTION, 'pipeline': [{'$match': PAID}]}},
+    # Same fallback as transaction_items for transactions from before carts
+    {'$set': {'items': {'$ifNull': ['$items', [{
+        'package_id': '$package_id',
+        'pizza_name': '$pizza_name',
+        'quantity': 1,
+        'amount_cents': {'$ifNull': ['$amount_cents', 0]},
+    }]]}}},
+    {'$unwind': '$items'},
+    {'$group': {
+        '_id': {
+            'date': _day_expression({'$ifNull': ['$completed_at', {'$ifNull': ['$updated_at', '$created_at']}]}),
+            'package_id': '$items.package_id',
+            'source': {'$ifNull': ['$metadata.source', DEFAULT_SOURCE]},
+        },
+        'orders': {'$sum': 1},
+        'quantity': {'$sum': '$items.quantity'},
+        'amount_cents': {'$sum': '$items.amount_cents'},
+        'pizza_name': {'$first': '$items.pizza_name'},
+    }},
+    {'$project': {
+        '_id': 0,
+        'date': '$_id.date',
+        'package_id': '$_id.package_id',
+        'source': '$_id.source',
+        'orders': 1,
+        'quantity': 1,
+        'amount_cents': 1,
+        'pizza_name': 1,
+    }},
+    {'$out': ROLLUPS_COLLECTION},
+]
+
+
+async def rebuild_rollups():
+    """Recompute ``daily_rollups`` from every paid transaction; returns days and pizzas counted"""
+    transactions = db.get_pool().transactions
+    # Mark first, so orders paid from now on are counted by record_paid, not twice
+    marked = await transactions.update_many(
+        {'payment_status': 'paid', 'rolled_up': {'$exists': False}},
+        {'$set': {'rolled_up': True}},
+    )
+    await transactions.aggregate_all(REBUILD_PIPELINE)
+    rollups = await db.get_pool().collection(ROLLUPS_COLLECTION).find_all({}, {'_id': 0, 'date': 1, 'quantity': 1})
+    stats = {
+        'rollups': len(rollups),
+        'days': len({r['date'] for r in rollups}),
+        'pizzas': sum(r['quantity'] for r in rollups),
+        'newly_marked': marked.modified_count,
+    }
+    logger.info('Rebuilt %(rollups)d daily rollups over %(days)d days (%(pizzas)d pizzas)', stats)
+    return stats
+
+
+async def sales_report(since=None, until=None):
+    """Paid pizzas and revenue per day and package between two ``YYYY-MM-DD`` dates (inclusive)"""
+    query = {}
+    if since or until:
+        query['date'] = {}
+        if since:
+            query['date']['$gte'] = since
+        if until:
+            query['date']['$lte'] = until
+    rollups = await db.get_pool().collection(ROLLUPS_COLLECTION).find_all(
+        query, {'_id': 0}, sort=[('date', 1), ('package_id', 1), ('source', 1)]
+    )
+    return {
+        'rows': rollups,
+        # A cart is one order under each of its pizzas: only quantities add up
+        'pizzas': sum(r.get('quantity', r['orders']) for r in rollups),
+        'amount_cents': sum(r['amount_cents'] for r in rollups),
+    }
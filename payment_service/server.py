@@ -0,0 +1,258 @@
+"""
+Unix socket server for the payment handlers.
+
+Protocol: length-prefixed frames (see ``protocol``), each request a
+``{"action": ..., "payload": {...}}`` header with an optional raw body (the
+webhook payload). Each request gets exactly one message back: the handler's
+result, or ``{"error": "..."}`` when it raised. A connection may carry
+several requests. The ``export`` action is streamed instead: one message
+per batch with the formatted rows as its raw body, then
+``{"done": true, ...}`` (or ``{"error": ...}``).
+
+With ``PAYMENT_WORKERS`` > 0 the requests are forwarded to a ``WorkerPool``;
+with 0 they run inside the server process. Concurrent status checks for the
+same session are coalesced here, before dispatch, so they share one lookup
+whichever worker would have served them. The ``watch`` action (payment
+status push for the SSE route) is also served here, from the ``StatusBus``
+fed by the webhook consumer. A watching client sends nothing while it
+waits; when it hangs up (the browser left the page) the watch is
+cancelled, so it never falls back to a Stripe lookup for nobody.
+"""
+
+import asyncio
+import logging
+import os
+from dataclasses import replace
+
+from . import db
+from .archive import run_periodically as run_archival
+from .breaker import merge_stats as merge_breaker_stats
+from .cache import is_terminal
+from .catalog import get_catalog
+from .config import load_settings
+from .events import StatusBus, watch_status
+from .export import export_transactions
+from .handlers import dispatch, process_metrics, process_stats
+from .indexes import ensure_indexes
+from .metrics import Metrics, get_metrics, serve_metrics
+from .pool import ServiceBusy, WorkerPool
+from .protocol import MAX_MESSAGE_BYTES, encode, read_message
+from .reconcile import run_periodically
+from .singleflight import SingleFlight
+from .webhook_queue import WebhookConsumer
+from .write_behind import DURABILITY_LEVELS, close_transaction_writer, replay_journal, run_replay
+
+logger = logging.getLogger(__name__)
+
+# Actions whose end-to-end latency is recorded as service.<action>
+TIMED_ACTIONS = ('checkout', 'status', 'webhook')
+# Actions answered with several messages, served by the server process itself
+STREAMED_ACTIONS = ('export',)
+# Long waits cancelled when the client hangs up
+CANCELLABLE_ACTIONS = ('watch',)
+
+
+async def _run_until_hangup(reader, request, run):
+    """``await run(request)``, or None if the client disconnects first"""
+    task = asyncio.ensure_future(run(request))
+    # The client sends nothing before the response: anything read (EOF included) means it gave up
+    hangup = asyncio.ensure_future(reader.read(1))
+    try:
+        await asyncio.wait({task, hangup}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        hangup.cancel()
+    if task.done():
+        return task.result()
+    task.cancel()
+    # Let it unsubscribe before the connection closes
+    await asyncio.gather(task, return_exceptions=True)
+    return None
+
+
+async def _handle_connection(reader, writer, run, stream):
+    try:
+        while True:
+            try:
+                request = await read_message(reader)
+            except ValueError as e:
+                # Framing is lost: answer once and drop the connection
+                logger.warning('Invalid request frame: %s', e)
+                writer.write(encode({'error': 'Invalid request'}))
+                await writer.drain()
+                break
+            if request is None:
+                break
+            if request.get('action') in STREAMED_ACTIONS:
+                await stream(request, writer)
+                continue
+
+            try:
+                if request.get('action') in CANCELLABLE_ACTIONS:
+                    response = await _run_until_hangup(reader, request, run)
+                    if response is None:
+                        logger.info('Client left, %s cancelled', request.get('action'))
+                        break
+                else:
+                    response = await run(request)
+            except ServiceBusy as e:
+                response = {'error': str(e)}
+            except ConnectionError:
+                logger.exception('Payment action %s lost its worker', request.get('action'))
+                response = {'error': 'Payment worker unavailable'}
+
+            writer.write(encode(response))
+            await writer.drain()
+    except (ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(settings=None):
+    """Listen on the configured Unix socket until cancelled"""
+    settings = settings or load_settings()
+    if settings.storage == 'memory':
+        if settings.production:
+            raise RuntimeError('PAYMENT_STORAGE=memory is for tests and benchmarks, not production')
+        if settings.workers:
+            # Workers would each get their own empty store
+            logger.warning('In-memory storage: handling requests in the server process, without workers')
+            settings = replace(settings, workers=0)
+
+    if settings.transaction_durability not in DURABILITY_LEVELS:
+        raise ValueError(f'PAYMENT_TRANSACTION_DURABILITY must be one of {", ".join(DURABILITY_LEVELS)}')
+
+    ensure_indexes(db.init_pool(settings), settings)
+    # Transactions journalled by a previous run that never reached MongoDB
+    replayed = await replay_journal(settings)
+    if replayed:
+        logger.warning('Replayed %d journalled transactions', replayed)
+    bus = StatusBus()
+    consumer = WebhookConsumer(settings, bus)
+    background = [asyncio.create_task(consumer.run())]
+    if settings.transaction_durability == 'journal':
+        background.append(asyncio.create_task(run_replay(settings)))
+    if settings.reconcile_interval > 0:
+        background.append(asyncio.create_task(run_periodically(settings)))
+    if settings.archive_interval > 0:
+        background.append(asyncio.create_task(run_archival(settings)))
+
+    pool = None
+    if settings.workers > 0:
+        pool = WorkerPool(settings)
+        await pool.start()
+        forward = pool.submit
+    else:
+        get_catalog(settings)
+
+        async def forward(request):
+            return await dispatch(request, settings)
+
+    status_flights = SingleFlight()
+
+    async def stats():
+        processes = [await process_stats({}, settings)]
+        if pool is not None:
+            responses = await pool.broadcast({'action': 'process_stats'})
+            processes += [r for r in responses if isinstance(r, dict) and 'pid' in r]
+        return {
+            'processes': processes,
+            'pool': pool.stats() if pool is not None else None,
+            'stripe_breaker': merge_breaker_stats([p['breaker'] for p in processes]),
+            'status_coalescing': {'calls': status_flights.calls, 'shared': status_flights.shared},
+            'webhooks': consumer.stats(),
+            'stream_watchers': bus.watchers(),
+        }
+
+    async def collect_metrics():
+        merged = Metrics()
+        exports = [await process_metrics({}, settings)]
+        if pool is not None:
+            exports += await pool.broadcast({'action': 'process_metrics'})
+        exports = [e for e in exports if isinstance(e, dict) and 'histograms' in e]
+        for export in exports:
+            merged.merge(export['histograms'])
+        breaker = merge_breaker_stats([e['breaker'] for e in exports])
+        return {'processes': len(exports), 'stripe_breaker': breaker, **merged.summary()}
+
+    async def lookup_status(session_id):
+        request = {'action': 'status', 'payload': {'session_id': session_id}}
+        response = await status_flights.do(session_id, lambda: forward(request))
+        if is_terminal(response):
+            bus.publish(session_id, response)
+        return response
+
+    async def run(request):
+        action = request.get('action')
+        payload = request.get('payload') or {}
+        if action == 'stats':
+            return await stats()
+        if action == 'metrics':
+            return await collect_metrics()
+        if action == 'watch':
+            return await watch_status(bus, payload, settings, lookup_status)
+        if action not in TIMED_ACTIONS:
+            return await forward(request)
+        # End to end inside the service, waiting for a worker included
+        with get_metrics().time(f'service.{action}'):
+            if action == 'status' and payload.get('session_id'):
+                return await lookup_status(payload['session_id'])
+            return await forward(request)
+
+    async def stream(request, writer):
+        payload = request.get('payload') or {}
+
+        async def send(text):
+            if text:
+                writer.write(encode({'body': text.encode()}))
+                await writer.drain()
+
+        try:
+            stats = await export_transactions(
+                settings, send,
+                format=payload.get('format', 'ndjson'),
+                since=payload.get('since'),
+                until=payload.get('until'),
+                source=payload.get('source'),
+                status=payload.get('status'),
+            )
+            logger.info('Exported %(rows)d transactions at %(rows_per_second).1f rows/s', stats)
+            message = {'done': True, **stats}
+        except (ConnectionResetError, BrokenPipeError):
+            raise
+        except Exception as e:
+            logger.exception('Transaction export failed')
+            message = {'error': str(e)}
+        writer.write(encode(message))
+        await writer.drain()
+
+    if os.path.exists(settings.socket_path):
+        os.unlink(settings.socket_path)
+
+    server = await asyncio.start_unix_server(
+        lambda r, w: _handle_connection(r, w, run, stream),
+        path=settings.socket_path,
+        limit=MAX_MESSAGE_BYTES,
+    )
+    os.chmod(settings.socket_path, 0o660)
+    logger.info('Payment service listening on %s', settings.socket_path)
+
+    metrics_server = None
+    if settings.metrics_port:
+        metrics_server = await serve_metrics('127.0.0.1', settings.metrics_port, collect_metrics)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        for task in background:
+            task.cancel()
+        if pool is not None:
+            await pool.close()
+        await close_transaction_writer()
+        db.close_pool()
@@ -0,0 +1,34 @@
+"""
+Request coalescing: at most one call in flight per key.
+
+Used by the server for status checks keyed by ``session_id``. When a
+customer has the success page open in two tabs, or refreshes during the
+polling loop, the concurrent requests share a single Stripe and MongoDB
+lookup and all receive the same result (or the same exception).
+"""
+
+import asyncio
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        """Await ``fn()``, or the call already running for ``key``"""
+        future = self._calls.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.shared += 1
+        # A waiter giving up must not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
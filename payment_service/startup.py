@@ -0,0 +1,69 @@
+"""
+Cold-start report for the payment processes.
+
+Each scenario imports the modules one kind of process needs in a fresh
+interpreter run with ``-X importtime``, and the report sums the import
+times it prints. ``python3 -m payment_service startup-report`` prints the
+totals with the slowest modules and exits non-zero when the Mongo-only
+path (what a freshly spawned worker loads before it can answer a test-mode
+request) exceeds ``PAYMENT_COLD_START_BUDGET_MS`` or pulls in the Stripe
+integration.
+"""
+
+import os
+import subprocess
+import sys
+
+from .config import PROJECT_DIR
+
+STRIPE_MODULE = 'emergentintegrations'
+
+SCENARIOS = {
+    'mongo': 'import payment_service.worker',
+    'stripe': 'import payment_service.worker; import payment_service.stripe_client',
+    'server': 'import payment_service.server',
+}
+
+
+def parse_importtime(output):
+    """``[(module, self_us, cumulative_us, depth)]`` from ``-X importtime`` stderr"""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+def profile(code):
+    """Import times for ``code`` run in a fresh interpreter"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=PROJECT_DIR, env=os.environ.copy(), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    rows = parse_importtime(result.stderr)
+    return {
+        # Top-level entries include the interpreter's own startup imports
+        'total_ms': round(sum(cumulative for _, _, cumulative, depth in rows if depth == 0) / 1000, 1),
+        'modules': len(rows),
+        'stripe_loaded': any(name.split('.')[0] == STRIPE_MODULE for name, _, _, _ in rows),
+        'slowest': [
+            (name, round(self_us / 1000, 1))
+            for name, self_us, _, _ in sorted(rows, key=lambda row: row[1], reverse=True)[:10]
+        ],
+    }
+
+
+def startup_report(budget_ms, runs=3):
+    """Best-of-``runs`` profile per scenario, with the budget verdict for the Mongo-only path"""
+    report = {}
+    for scenario, code in SCENARIOS.items():
+        report[scenario] = min((profile(code) for _ in range(runs)), key=lambda p: p['total_ms'])
+    mongo = report['mongo']
+    report['budget_ms'] = budget_ms
+    report['within_budget'] = mongo['total_ms'] <= budget_ms and not mongo['stripe_loaded']
+    return report
@@ -0,0 +1,124 @@
+"""
+Long-lived Stripe client for one payment process.
+
+``StripeCheckout`` calls Stripe through the ``stripe`` SDK, which sends its
+requests through ``stripe.default_http_client``. Each process installs a
+single ``RequestsClient`` there, backed by a ``requests.Session`` whose
+adapter keeps up to ``stripe_pool_size`` connections alive, so the TCP and
+TLS handshake is paid once per connection rather than once per checkout or
+status lookup. The adapter counts requests and new connections (with the
+time spent connecting) so reuse shows up in the service ``stats``.
+
+This module loads the Stripe SDK; the handlers import it only on the paths
+that call Stripe.
+"""
+
+import threading
+import time
+
+import requests
+import stripe
+from emergentintegrations.payments.stripe.checkout import StripeCheckout
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_lock = threading.Lock()
+_counters = {'requests': 0, 'connections': 0, 'connect_seconds': 0.0}
+_pool_size = None
+_checkout = None
+
+
+def _record(requests_sent=0, connect_seconds=None):
+    with _lock:
+        _counters['requests'] += requests_sent
+        if connect_seconds is not None:
+            _counters['connections'] += 1
+            _counters['connect_seconds'] += connect_seconds
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record(connect_seconds=time.perf_counter() - started)
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record(connect_seconds=time.perf_counter() - started)
+
+
+class _CountingHTTPPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _CountingHTTPPool, 'https': _CountingHTTPSPool}
+
+    def send(self, request, **kwargs):
+        _record(requests_sent=1)
+        return super().send(request, **kwargs)
+
+
+def install_http_client(settings):
+    """Point the Stripe SDK at this process's keep-alive session (once)"""
+    global _pool_size
+    with _lock:
+        if _pool_size is not None:
+            return
+        _pool_size = settings.stripe_pool_size
+
+    # pool_block=False: a burst beyond the pool opens extra connections instead of waiting
+    adapter = _KeepAliveAdapter(pool_connections=2, pool_maxsize=settings.stripe_pool_size, max_retries=0)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if settings.stripe_api_base:
+        stripe.api_base = settings.stripe_api_base
+    stripe.default_http_client = stripe.RequestsClient(timeout=settings.stripe_timeout, session=session)
+
+
+def get_stripe_checkout(settings, webhook_url=None):
+    """``StripeCheckout`` on the shared client; the process-wide one when no webhook URL is given"""
+    global _checkout
+    install_http_client(settings)
+    if webhook_url is not None:
+        # Cheap to build: the connections live in the shared session, not in StripeCheckout
+        return StripeCheckout(api_key=settings.stripe_api_key, webhook_url=webhook_url)
+    if _checkout is None:
+        _checkout = StripeCheckout(api_key=settings.stripe_api_key)
+    return _checkout
+
+
+def is_outage(error):
+    """Whether a failed Stripe call means Stripe is unreachable or failing, rather than refusing the request"""
+    if isinstance(error, stripe.APIConnectionError):
+        return True
+    if isinstance(error, stripe.StripeError):
+        return (error.http_status or 0) >= 500
+    # Timeouts and socket errors raised around the SDK
+    return isinstance(error, OSError)
+
+
+def connection_stats():
+    """Requests sent to Stripe by this process and how many needed a new connection"""
+    with _lock:
+        counters = dict(_counters)
+    reused = counters['requests'] - counters['connections']
+    return {
+        'pool_size': _pool_size,
+        'requests': counters['requests'],
+        'connections': counters['connections'],
+        'reused': max(reused, 0),
+        'reuse_rate': max(reused, 0) / counters['requests'] if counters['requests'] else 0.0,
+        'connect_ms_total': round(counters['connect_seconds'] * 1000, 1),
+    }
@@ -0,0 +1,276 @@
+"""
+Local stand-in for the parts of the Stripe API the payment service uses.
+
+``python3 -m payment_service stripe-standin`` answers checkout session
+creation (``POST /v1/checkout/sessions``) and retrieval
+(``GET /v1/checkout/sessions/<id>``) in Stripe's wire format, so the real
+SDK talks to it once ``STRIPE_API_BASE`` points here. Opening a session's
+``url`` pays it: the session becomes ``complete``/``paid``, the customer is
+redirected to ``success_url`` and a ``checkout.session.completed`` webhook
+signed with ``STRIPE_WEBHOOK_SECRET`` is posted to the webhook URL.
+
+Every API call can be delayed (``latency_ms`` plus up to ``jitter_ms``) and
+failed at random with ``error_rate`` (with ``retry_errors=False`` the
+failures carry ``Stripe-Should-Retry: false`` so the SDK gives up at once),
+which is enough to benchmark
+checkout, status and webhook throughput without a network. Counters are
+served on ``GET /_standin/stats``. Sessions live in memory only.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+SESSIONS_PATH = '/v1/checkout/sessions'
+PAY_PATH = '/pay/'
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """``Stripe-Signature`` header value for ``payload`` (bytes)"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signed = f'{timestamp}.'.encode() + payload
+    digest = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={digest}'
+
+
+def parse_form(body):
+    """Decode Stripe's bracketed form encoding into nested dicts and lists"""
+    result = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = key.replace(']', '').split('[')
+        target = result
+        for part, following in zip(parts, parts[1:]):
+            default = [] if following.isdigit() else {}
+            if isinstance(target, list):
+                index = int(part)
+                while len(target) <= index:
+                    target.append(default)
+                target = target[index]
+            else:
+                target = target.setdefault(part, default)
+        if isinstance(target, list):
+            target.append(value)
+        else:
+            target[parts[-1]] = value
+    return result
+
+
+def _error(status, error_type, message, code=None):
+    error = {'type': error_type, 'message': message}
+    if code:
+        error['code'] = code
+    return status, {'error': error}
+
+
+class StripeStandIn:
+    def __init__(self, base_url, webhook_url, webhook_secret, latency_ms=0.0, jitter_ms=0.0,
+                 error_rate=0.0, retry_errors=True, seed=None):
+        self.base_url = base_url.rstrip('/')
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.retry_errors = retry_errors
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._deliveries = ThreadPoolExecutor(max_workers=4)
+        self.counters = {
+            'sessions_created': 0, 'sessions_retrieved': 0, 'payments': 0,
+            'webhooks_sent': 0, 'webhooks_failed': 0, 'injected_errors': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def inject_fault(self):
+        """Apply the configured delay; returns an error response when a failure is drawn"""
+        with self._lock:
+            delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+            failed = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay / 1000)
+        if failed:
+            self._count('injected_errors')
+            return _error(500, 'api_error', 'Injected failure from the Stripe stand-in')
+        return None
+
+    def create_session(self, params):
+        line_items = params.get('line_items') or []
+        amount_total = sum(
+            int(item.get('price_data', {}).get('unit_amount', 0)) * int(item.get('quantity', 1))
+            for item in line_items
+        )
+        currency = next((item['price_data'].get('currency') for item in line_items if 'price_data' in item), 'eur')
+        session_id = f'cs_test_{uuid.uuid4().hex}'
+        session = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'url': f'{self.base_url}{PAY_PATH}{session_id}',
+            'status': 'open',
+            'payment_status': 'unpaid',
+            'mode': params.get('mode', 'payment'),
+            'amount_total': amount_total,
+            'currency': currency,
+            'metadata': params.get('metadata') or {},
+            'success_url': params.get('success_url'),
+            'cancel_url': params.get('cancel_url'),
+            'created': int(time.time()),
+        }
+        with self._lock:
+            self._sessions[session_id] = session
+        self._count('sessions_created')
+        return 200, session
+
+    def retrieve_session(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            return _error(404, 'invalid_request_error', f"No such checkout.session: '{session_id}'",
+                          'resource_missing')
+        self._count('sessions_retrieved')
+        return 200, dict(session)
+
+    def pay(self, session_id):
+        """Mark a session paid and queue its webhook; returns the redirect target"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            first_payment = session['payment_status'] != 'paid'
+            session.update(status='complete', payment_status='paid')
+            event_session = dict(session)
+        if first_payment:
+            self._count('payments')
+            self._deliveries.submit(self._deliver, 'checkout.session.completed', event_session)
+        return (event_session['success_url'] or self.base_url).replace('{CHECKOUT_SESSION_ID}', session_id)
+
+    def build_event(self, event_type, session):
+        """Webhook body for ``session`` and its ``Stripe-Signature`` header"""
+        payload = json.dumps({
+            'id': f'evt_{uuid.uuid4().hex}',
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'data': {'object': session},
+        }).encode()
+        return payload, sign_payload(payload, self.webhook_secret)
+
+    def _deliver(self, event_type, session):
+        if not self.webhook_url:
+            return
+        payload, signature = self.build_event(event_type, session)
+        request = urllib.request.Request(self.webhook_url, data=payload, method='POST', headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': signature,
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=10):
+                pass
+            self._count('webhooks_sent')
+        except Exception as e:
+            self._count('webhooks_failed')
+            logger.warning('Webhook delivery for %s failed: %s', session['id'], e)
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, 'sessions': len(self._sessions)}
+
+    def close(self):
+        self._deliveries.shutdown(wait=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'StripeStandIn/1.0'
+    # Headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    @property
+    def standin(self):
+        return self.server.standin
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        if status >= 500:
+            self.send_header('Stripe-Should-Retry', 'true' if self.standin.retry_errors else 'false')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode() if length else ''
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self._read_body()
+        if path == SESSIONS_PATH:
+            self._send_json(*(self.standin.inject_fault() or self.standin.create_session(parse_form(body))))
+        elif path.startswith(PAY_PATH):
+            self._pay(path[len(PAY_PATH):])
+        else:
+            self._send_json(*_error(404, 'invalid_request_error', f'Unrecognized request URL (POST: {path})'))
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path.startswith(SESSIONS_PATH + '/'):
+            session_id = path[len(SESSIONS_PATH) + 1:]
+            self._send_json(*(self.standin.inject_fault() or self.standin.retrieve_session(session_id)))
+        elif path.startswith(PAY_PATH):
+            self._pay(path[len(PAY_PATH):])
+        elif path == '/_standin/stats':
+            self._send_json(200, self.standin.stats())
+        else:
+            self._send_json(*_error(404, 'invalid_request_error', f'Unrecognized request URL (GET: {path})'))
+
+    def _pay(self, session_id):
+        location = self.standin.pay(session_id)
+        if location is None:
+            self._send_json(*_error(404, 'invalid_request_error', f"No such checkout.session: '{session_id}'"))
+            return
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
+
+
+def make_server(host, port, webhook_url, webhook_secret, **options):
+    """Bound stand-in HTTP server (``port=0`` picks a free port); ``server.standin`` holds its state"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.standin = StripeStandIn(f'http://{host}:{server.server_port}', webhook_url, webhook_secret, **options)
+    return server
+
+
+def run_standin(host, port, webhook_url, webhook_secret, **options):
+    """Serve the stand-in until interrupted"""
+    server = make_server(host, port, webhook_url, webhook_secret, **options)
+    logger.info('Stripe stand-in listening on http://%s:%d (webhooks to %s)', host, server.server_port,
+                webhook_url or 'nowhere')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.standin.close()
+        logger.info('Stripe stand-in stopped: %s', json.dumps(server.standin.stats()))
@@ -0,0 +1,106 @@
+"""
+UTC timestamps for payment transactions, and the migration of old ones.
+
+``created_at``, ``updated_at`` and ``completed_at`` are written as
+timezone-aware UTC datetimes (``utc_now``), which MongoDB stores as BSON
+dates: 8 bytes, ordered, so sweeps, archival and exports run index range
+scans on them with ``datetime`` bounds. Transactions written before that
+hold ``datetime.now().isoformat()`` strings in the host's local time, which
+a date range never matches. ``migrate_timestamps`` converts them in place,
+one batch of ``_id``-ordered documents at a time (one unordered
+``bulk_write`` per batch), in ``payment_transactions`` and its archive. It
+only touches string values, so it can be interrupted and run again. Run it
+with ``python3 -m payment_service migrate-timestamps`` on a host with the
+same time zone as the one that wrote the strings.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+from . import db
+from .db import ARCHIVE_COLLECTION, TRANSACTIONS_COLLECTION
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FIELDS = ('created_at', 'updated_at', 'completed_at')
+LEGACY_TIMESTAMPS = {'$or': [{field: {'$type': 'string'}} for field in TIMESTAMP_FIELDS]}
+
+
+def utc_now():
+    """Current time as an aware UTC datetime (a BSON date once stored)"""
+    return datetime.now(timezone.utc)
+
+
+def utc_day(day):
+    """Midnight UTC starting a ``YYYY-MM-DD`` day"""
+    return datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+
+
+def format_utc(value):
+    """ISO 8601 text of a stored timestamp; other values are returned unchanged"""
+    if not isinstance(value, datetime):
+        return value
+    if value.tzinfo is None:
+        # BSON dates are UTC; naive only when read without tz_aware
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat()
+
+
+def parse_legacy(value):
+    """UTC datetime of an ISO string; naive ones were written in the host's local time"""
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+
+async def _migrate_collection(collection, batch_size, stats):
+    last_id = None
+    while True:
+        query = LEGACY_TIMESTAMPS if last_id is None else {'_id': {'$gt': last_id}, **LEGACY_TIMESTAMPS}
+        batch = await collection.find_all(
+            query, {field: 1 for field in TIMESTAMP_FIELDS}, sort=[('_id', 1)], limit=batch_size
+        )
+        if not batch:
+            return
+        last_id = batch[-1]['_id']
+
+        updates = []
+        for document in batch:
+            converted = {}
+            for field in TIMESTAMP_FIELDS:
+                if not isinstance(document.get(field), str):
+                    continue
+                try:
+                    converted[field] = parse_legacy(document[field])
+                except ValueError:
+                    # Left as is; the _id cursor moves past it
+                    logger.warning('Unparseable %s %r on %s', field, document[field], document['_id'])
+                    stats['invalid'] += 1
+            if converted:
+                updates.append(UpdateOne({'_id': document['_id']}, {'$set': converted}))
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+        stats['converted'] += len(updates)
+        stats['batches'] += 1
+        # Let live requests in between batches
+        await asyncio.sleep(0)
+
+
+async def migrate_timestamps(settings, batch_size=None):
+    """Convert string timestamps to UTC datetimes in both transaction collections; returns counters"""
+    batch_size = batch_size or settings.archive_batch_size
+    pool = db.get_pool()
+    stats = {'converted': 0, 'invalid': 0, 'batches': 0}
+
+    started = time.monotonic()
+    for name in (TRANSACTIONS_COLLECTION, ARCHIVE_COLLECTION):
+        await _migrate_collection(pool.collection(name), batch_size, stats)
+
+    elapsed = time.monotonic() - started
+    stats['elapsed_seconds'] = round(elapsed, 3)
+    stats['documents_per_second'] = round(stats['converted'] / elapsed, 1) if elapsed else 0.0
+    logger.info('Converted the timestamps of %(converted)d transactions in %(batches)d batches '
+                '(%(invalid)d unparseable) at %(documents_per_second).1f documents/s', stats)
+    return stats
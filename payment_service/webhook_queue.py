@@ -0,0 +1,169 @@
+"""
+Durable ingestion queue for Stripe webhooks.
+
+The webhook handler only verifies the signature, appends the event to a
+local SQLite database in WAL mode and acknowledges, so Stripe gets its 200
+without waiting on MongoDB. ``WebhookConsumer`` runs in the server process,
+drains the queue in batches and applies each batch to
+``payment_transactions`` with a single ordered ``bulk_write`` (then counts
+newly paid orders into the daily rollups, see ``rollups``). Events are
+removed from the queue only once their batch is written, so a crash or a
+MongoDB outage delays them instead of losing them. Redelivered events are
+filtered out by the ``EventLedger`` before anything is written.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from . import db
+from .cache import get_status_cache
+from .ledger import EventLedger
+from .metrics import get_metrics
+from .rollups import record_paid
+from .write_behind import get_transaction_writer, replay_journal
+
+logger = logging.getLogger(__name__)
+
+_queue = None
+
+
+class WebhookQueue:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS webhook_events ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' received_at REAL NOT NULL,'
+            ' event TEXT NOT NULL,'
+            ' body BLOB NOT NULL)'
+        )
+
+    def append(self, event, body):
+        """Persist one verified event with its raw body"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO webhook_events (received_at, event, body) VALUES (?, ?, ?)',
+                (time.time(), json.dumps(event), body),
+            )
+
+    def peek(self, limit):
+        """Oldest ``limit`` events as ``(id, event)`` pairs, left in the queue"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, event FROM webhook_events ORDER BY id LIMIT ?', (limit,)
+            ).fetchall()
+        return [(row_id, json.loads(event)) for row_id, event in rows]
+
+    def ack(self, ids):
+        with self._lock:
+            self._conn.executemany('DELETE FROM webhook_events WHERE id = ?', [(i,) for i in ids])
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM webhook_events').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_webhook_queue(settings):
+    """Process-wide handle on the webhook queue"""
+    global _queue
+    if _queue is None:
+        _queue = WebhookQueue(settings.webhook_queue_path)
+    return _queue
+
+
+def _update_for(event):
+    received_at = datetime.fromisoformat(event['received_at'])
+    update_data = {
+        'payment_status': event['payment_status'],
+        'event_type': event['event_type'],
+        'event_id': event['event_id'],
+        'updated_at': received_at
+    }
+    # Add completion time if payment successful
+    if event['payment_status'] == 'paid':
+        update_data['completed_at'] = received_at
+    return UpdateOne({'session_id': event['session_id']}, {'$set': update_data})
+
+
+class WebhookConsumer:
+    def __init__(self, settings, bus=None):
+        self.settings = settings
+        self.bus = bus
+        self.queue = get_webhook_queue(settings)
+        self.ledger = EventLedger(db.get_pool(), settings.webhook_dedupe_size)
+        self.applied = 0
+
+    async def run(self):
+        """Drain the queue forever"""
+        while True:
+            try:
+                drained = await self.drain_once()
+            except Exception:
+                logger.exception('Webhook batch failed, will retry')
+                await asyncio.sleep(self.settings.webhook_retry_delay)
+                continue
+            if not drained:
+                await asyncio.sleep(self.settings.webhook_poll_interval)
+
+    async def drain_once(self):
+        """Apply one batch; returns the number of events taken off the queue"""
+        batch = await asyncio.to_thread(self.queue.peek, self.settings.webhook_batch_size)
+        if not batch:
+            return 0
+
+        metrics = get_metrics()
+        with metrics.time('webhook_batch.dedupe'):
+            events = await self.ledger.filter_new([event for _, event in batch])
+        updates = [_update_for(e) for e in events if e.get('session_id')]
+        if updates:
+            # Write-behind transactions must exist before their events are applied
+            session_ids = [e['session_id'] for e in events if e.get('session_id')]
+            with metrics.time('webhook_batch.transactions'):
+                await replay_journal(self.settings, session_ids=session_ids)
+                await get_transaction_writer(self.settings).flush()
+            with metrics.time('webhook_batch.bulk_write'):
+                await db.get_pool().transactions.bulk_write(updates, ordered=True)
+            paid = [e['session_id'] for e in events if e.get('session_id') and e['payment_status'] == 'paid']
+            with metrics.time('webhook_batch.rollups'):
+                await record_paid(paid)
+        with metrics.time('webhook_batch.ledger'):
+            await self.ledger.record(events)
+
+        await asyncio.to_thread(self.queue.ack, [row_id for row_id, _ in batch])
+        status_cache = get_status_cache(self.settings)
+        for event in events:
+            if event.get('session_id'):
+                status_cache.invalidate(event['session_id'])
+                if self.bus is not None:
+                    self.bus.publish(event['session_id'], {
+                        'payment_status': event['payment_status'],
+                        'event_type': event['event_type']
+                    })
+                logger.info('Webhook processed: %s for %s', event['event_type'], event['session_id'])
+        self.applied += len(events)
+        return len(batch)
+
+    def stats(self):
+        return {
+            'applied': self.applied,
+            'queue_depth': self.queue.depth(),
+            'dedupe': self.ledger.stats(),
+        }
@@ -0,0 +1,61 @@
+"""
+Payment worker process, started by ``WorkerPool``.
+
+Reads ``{"id": ..., "action": ..., "payload": ...}`` frames from stdin
+(raw webhook bodies included, see ``protocol``), runs them concurrently
+and writes ``{"id": ..., "response": ...}`` back on stdout. Stdout is
+reserved for the protocol; logs go to stderr. The worker exits once stdin
+is closed and its in-flight requests have completed.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+from . import db
+from .catalog import get_catalog
+from .handlers import dispatch, import_stripe
+from .metrics import get_metrics
+from .protocol import MAX_MESSAGE_BYTES, encode, read_message
+from .write_behind import close_transaction_writer
+
+
+async def _open_stdio():
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=MAX_MESSAGE_BYTES)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def run_worker(settings):
+    db.init_pool(settings)
+    get_catalog(settings)
+    reader, writer = await _open_stdio()
+    tasks = set()
+    spawned_at = os.environ.get('PAYMENT_WORKER_SPAWNED_AT')
+    if spawned_at:
+        get_metrics().record('process.worker_startup', time.time() - float(spawned_at))
+    # Serve Mongo-only requests right away; the Stripe SDK loads meanwhile
+    stripe_import = asyncio.create_task(asyncio.to_thread(import_stripe, settings))
+
+    async def handle(message):
+        response = await dispatch(message, settings)
+        writer.write(encode({'id': message['id'], 'response': response}))
+        await writer.drain()
+
+    while True:
+        message = await read_message(reader)
+        if message is None:
+            break
+        task = asyncio.create_task(handle(message))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    await stripe_import
+    await close_transaction_writer()
+    db.close_pool()
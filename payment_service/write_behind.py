@@ -0,0 +1,250 @@
+"""
+Write-behind persistence for new payment transactions.
+
+With ``PAYMENT_TRANSACTION_DURABILITY=sync`` (the default) ``create_checkout``
+waits for ``insert_one`` before returning the Stripe URL. The two other
+levels hand the pending transaction to the process's ``TransactionWriter``
+and return at once; a background task flushes the buffer with one
+unordered ``insert_many`` per batch:
+
+``journal``
+    the document is first appended to a local SQLite journal (WAL, shared
+    by the server and its workers) and removed once MongoDB has it. The
+    server replays what is left at start-up, and periodically replays
+    entries older than ``transaction_replay_age`` so a crashed worker's
+    buffer is not lost. The webhook consumer flushes a session's journal
+    entry before applying its events.
+``async``
+    fire-and-forget: the buffer only lives in memory and a crash loses it.
+
+Replays are idempotent: ``session_id`` is unique, so duplicate-key errors
+from a second insert of the same transaction are ignored. Until a
+transaction is flushed a status check finds nothing in MongoDB and answers
+from Stripe; a webhook applied in that window only reaches the transaction
+through the next status check or reconcile sweep (``async`` mode only, the
+journal is flushed first in ``journal`` mode). The free test pizza is always
+written synchronously, since its status is read back from MongoDB.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+from . import db
+from .metrics import get_metrics, stage
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_LEVELS = ('sync', 'journal', 'async')
+
+_writer = None
+_journal = None
+
+
+class TransactionJournal:
+    def __init__(self, path):
+        # Only journal mode needs SQLite: keep it off the worker's start-up path
+        import sqlite3
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS pending_transactions ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' written_at REAL NOT NULL,'
+            ' session_id TEXT NOT NULL,'
+            ' document TEXT NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS pending_transactions_session_id ON pending_transactions (session_id)'
+        )
+
+    def append(self, document):
+        """Persist one transaction; returns its journal id"""
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO pending_transactions (written_at, session_id, document) VALUES (?, ?, ?)',
+                (time.time(), document['session_id'], json_util.dumps(document)),
+            )
+            return cursor.lastrowid
+
+    def entries(self, older_than=None, session_ids=None, limit=1000):
+        """Oldest entries as ``(id, document)``, optionally only stale ones or those of ``session_ids``"""
+        query, params = 'SELECT id, document FROM pending_transactions', []
+        if session_ids is not None:
+            query += f' WHERE session_id IN ({",".join("?" * len(session_ids))})'
+            params += list(session_ids)
+        elif older_than is not None:
+            query += ' WHERE written_at < ?'
+            params.append(time.time() - older_than)
+        query += ' ORDER BY id LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [(row_id, json_util.loads(document)) for row_id, document in rows]
+
+    def delete(self, ids):
+        with self._lock:
+            self._conn.executemany('DELETE FROM pending_transactions WHERE id = ?', [(i,) for i in ids])
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM pending_transactions').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_transaction_journal(settings):
+    """Process-wide journal handle, or None unless the durability level is ``journal``"""
+    global _journal
+    if settings.transaction_durability != 'journal':
+        return None
+    if _journal is None:
+        _journal = TransactionJournal(settings.transaction_journal_path)
+    return _journal
+
+
+async def insert_transactions(documents):
+    """``insert_many`` that tolerates transactions MongoDB already has"""
+    if not documents:
+        return
+    try:
+        with get_metrics().time('transaction_flush.insert_many'):
+            await db.get_pool().transactions.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if not db.only_duplicate_keys(e):
+            raise
+
+
+async def replay_journal(settings, older_than=None, session_ids=None):
+    """Write journalled transactions to MongoDB and drop them from the journal; returns the count"""
+    journal = get_transaction_journal(settings)
+    if journal is None:
+        return 0
+    replayed = 0
+    while True:
+        entries = await asyncio.to_thread(
+            journal.entries, older_than, session_ids, settings.transaction_batch_size
+        )
+        if not entries:
+            return replayed
+        await insert_transactions([document for _, document in entries])
+        await asyncio.to_thread(journal.delete, [row_id for row_id, _ in entries])
+        replayed += len(entries)
+        if session_ids is not None:
+            return replayed
+
+
+async def run_replay(settings):
+    """Server loop recovering the journal entries of workers that died before flushing"""
+    interval = settings.transaction_replay_age
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            replayed = await replay_journal(settings, older_than=interval)
+            if replayed:
+                logger.warning('Replayed %d stale journalled transactions', replayed)
+        except Exception:
+            logger.exception('Transaction journal replay failed')
+
+
+class TransactionWriter:
+    def __init__(self, settings):
+        self.settings = settings
+        self.durability = settings.transaction_durability
+        self.journal = get_transaction_journal(settings)
+        self._buffer = []
+        # The flusher task and the webhook consumer both flush; one at a time
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+        self.flushed = 0
+
+    async def submit(self, document):
+        """Persist a new transaction according to the durability level"""
+        if self.durability == 'sync':
+            with stage('insert_one'):
+                await db.get_pool().transactions.insert_one(document)
+            return
+
+        row_id = None
+        if self.journal is not None:
+            with stage('journal'):
+                row_id = await asyncio.to_thread(self.journal.append, document)
+        self._buffer.append((row_id, document))
+        if len(self._buffer) >= self.settings.transaction_batch_size:
+            self._wake.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.settings.transaction_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Transaction flush failed, will retry')
+                await asyncio.sleep(self.settings.webhook_retry_delay)
+
+    async def flush(self):
+        """Write out everything buffered so far"""
+        async with self._flush_lock:
+            while self._buffer:
+                batch = self._buffer[:self.settings.transaction_batch_size]
+                await insert_transactions([document for _, document in batch])
+                del self._buffer[:len(batch)]
+                row_ids = [row_id for row_id, _ in batch if row_id is not None]
+                if row_ids:
+                    await asyncio.to_thread(self.journal.delete, row_ids)
+                self.flushed += len(batch)
+
+    async def close(self):
+        if self._task is not None:
+            # A flush cut short keeps its batch buffered; the one below redoes it
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Could not flush %d buffered transactions at shutdown', len(self._buffer))
+
+    def stats(self):
+        return {
+            'durability': self.durability,
+            'buffered': len(self._buffer),
+            'flushed': self.flushed,
+        }
+
+
+def get_transaction_writer(settings):
+    """Process-wide transaction writer"""
+    global _writer
+    if _writer is None:
+        _writer = TransactionWriter(settings)
+    return _writer
+
+
+async def close_transaction_writer():
+    """Flush and drop the writer (process shutdown)"""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        await writer.close()
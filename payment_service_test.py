@@ -0,0 +1,1372 @@
+#!/usr/bin/env python3
+"""
+Lucky Pizza Payment Service In-Process Test Suite
+Runs the payment handlers against the in-memory storage backend and the
+local Stripe stand-in: no Next.js, MongoDB or network needed
+"""
+
+import asyncio
+import csv
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from pymongo import MongoClient, uri_parser
+from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
+
+from payment_service import breaker, cache, catalog, db, write_behind
+from payment_service.archive import archive_settled, settled_before
+from payment_service.catalog import get_catalog
+from payment_service.export import CSV_FIELDS, export_transactions
+from payment_service.config import load_settings
+from payment_service.events import StatusBus, watch_status
+from payment_service.handlers import dispatch
+from payment_service.indexes import INDEXES, MissingIndexError, ensure_indexes
+from payment_service.pool import ServiceBusy, WorkerPool
+from payment_service.protocol import encode, read_message
+from payment_service.reconcile import reconcile_pending
+from payment_service.rollups import REBUILD_PIPELINE, record_paid
+from payment_service.server import _handle_connection
+from payment_service.singleflight import SingleFlight
+from payment_service.stripe_standin import make_server, sign_payload
+from payment_service.timestamps import migrate_timestamps
+from payment_service.webhook_queue import WebhookConsumer
+from payment_service.write_behind import TransactionWriter, replay_journal
+
+class PaymentServiceTester:
+    def __init__(self, with_workers=False):
+        # Worker pool tests start real worker processes: opt-in, they take seconds
+        self.with_workers = with_workers
+        self.test_results = []
+        self.failed_tests = []
+        self.workdir = tempfile.mkdtemp(prefix='payment-service-test-')
+
+        settings = load_settings()
+        webhook_secret = os.environ.setdefault('STRIPE_WEBHOOK_SECRET', 'whsec_standin')
+        self.standin_server = make_server('127.0.0.1', 0, '', webhook_secret)
+        self.standin = self.standin_server.standin
+        threading.Thread(target=self.standin_server.serve_forever, daemon=True).start()
+
+        self.settings = replace(
+            settings,
+            storage='memory',
+            stripe_api_key='sk_test_standin',
+            stripe_api_base=self.standin.base_url,
+            webhook_queue_path=os.path.join(self.workdir, 'webhook-queue.db'),
+            status_cache_ttl=0.0,
+            workers=0,
+        )
+        self.loop = asyncio.new_event_loop()
+        self.pool = db.init_pool(self.settings)
+        ensure_indexes(self.pool, self.settings)
+        self.consumer = WebhookConsumer(self.settings)
+        # Only the tests that need a real MongoDB connect to one (see mongo_database)
+        self.mongo_client = None
+
+    def log_test(self, test_name, status, message="", details=None):
+        """Log test results"""
+        result = {
+            "test": test_name,
+            "status": status,
+            "message": message,
+            "timestamp": datetime.now().isoformat(),
+            "details": details
+        }
+        self.test_results.append(result)
+
+        status_icon = "✅" if status == "PASS" else "❌" if status == "FAIL" else "⚠️"
+        print(f"{status_icon} {test_name}: {message}")
+
+        if status == "FAIL":
+            self.failed_tests.append(test_name)
+            if details:
+                print(f"   Details: {details}")
+
+    def call(self, action, payload):
+        """Run one request through the service dispatcher"""
+        return self.loop.run_until_complete(dispatch({'action': action, 'payload': payload}, self.settings))
+
+    def stored(self, session_id):
+        return self.loop.run_until_complete(self.pool.transactions.find_one({'session_id': session_id}))
+
+    def drain_webhooks(self):
+        return self.loop.run_until_complete(self.consumer.drain_once())
+
+    def mongo_database(self):
+        """A scratch database on the MongoDB of MONGO_URL, or None when none is reachable"""
+        if self.mongo_client is None:
+            try:
+                host, port = uri_parser.parse_uri(self.settings.mongo_url)['nodelist'][0]
+                # Refused at once when nothing listens, where server selection would wait
+                socket.create_connection((host, port), timeout=0.2).close()
+                self.mongo_client = MongoClient(self.settings.mongo_url, serverSelectionTimeoutMS=2000, tz_aware=True)
+                self.mongo_client.admin.command('ping')
+            except (OSError, PyMongoError, ValueError):
+                self.mongo_client = False
+        if not self.mongo_client:
+            return None
+        return self.mongo_client[f'payment_service_test_{os.getpid()}']
+
+    def checkout(self, package_id):
+        return self.call('checkout', {
+            'package_id': package_id,
+            'origin_url': 'http://localhost:3000',
+            'metadata': {'customer_name': 'Test Client', 'customer_email': 'test@email.fr'}
+        })
+
+    def deliver_payment(self, session_id):
+        """Pay a stand-in session and send its webhook through the service"""
+        self.standin.pay(session_id)
+        _, session = self.standin.retrieve_session(session_id)
+        body, signature = self.standin.build_event('checkout.session.completed', session)
+        return body, signature, self.call('webhook', {'body': body, 'signature': signature})
+
+    def test_checkout_valid_package(self):
+        """Test checkout creates a Stripe session and a pending transaction"""
+        try:
+            data = self.checkout('margherita')
+            transaction = self.stored(data.get('session_id'))
+            required_fields = ['session_id', 'package_id', 'amount', 'amount_cents', 'currency', 'payment_status']
+
+            if 'error' in data or not data['url'].startswith(self.standin.base_url):
+                self.log_test("Checkout Valid Package", "FAIL", "Unexpected checkout response", data)
+                return False
+            if not transaction or not all(field in transaction for field in required_fields):
+                self.log_test("Checkout Valid Package", "FAIL", "Transaction missing or incomplete", transaction)
+                return False
+            if transaction['payment_status'] != 'pending' or transaction['amount_cents'] != 1290:
+                self.log_test("Checkout Valid Package", "FAIL", "Wrong transaction state", transaction)
+                return False
+
+            self.log_test("Checkout Valid Package", "PASS", "Session created, transaction pending at 12.90 EUR")
+            return True
+
+        except Exception as e:
+            self.log_test("Checkout Valid Package", "FAIL", f"Checkout failed: {str(e)}")
+            return False
+
+    def test_checkout_invalid_package(self):
+        """Test checkout rejects unknown packages"""
+        try:
+            data = self.checkout('invalid_pizza')
+            if 'Invalid package' in data.get('error', ''):
+                self.log_test("Checkout Invalid Package", "PASS", "Unknown package rejected")
+                return True
+            self.log_test("Checkout Invalid Package", "FAIL", "Unknown package accepted", data)
+            return False
+
+        except Exception as e:
+            self.log_test("Checkout Invalid Package", "FAIL", f"Checkout failed: {str(e)}")
+            return False
+
+    def test_cart_checkout(self):
+        """Test a cart becomes one Stripe session and one transaction priced from the catalog"""
+        try:
+            catalog = get_catalog(self.settings)
+            data = self.call('checkout', {
+                'items': [
+                    {'package_id': 'margherita', 'quantity': 2},
+                    {'package_id': 'diavola', 'quantity': 1},
+                    {'package_id': 'margherita', 'quantity': 1},
+                ],
+                'origin_url': 'http://localhost:3000',
+                'metadata': {'customer_name': 'Famille Test'}
+            })
+            expected = 3 * catalog.get('margherita').amount_cents + catalog.get('diavola').amount_cents
+            transaction = self.stored(data.get('session_id'))
+            _, session = self.standin.retrieve_session(data.get('session_id'))
+
+            if 'error' in data or session.get('amount_total') != expected:
+                self.log_test("Cart Checkout", "FAIL", "Wrong Stripe session", {'data': data, 'session': session})
+                return False
+            lines = [(item['package_id'], item['quantity'], item['amount_cents']) for item in transaction['items']]
+            if transaction['amount_cents'] != expected or lines != [
+                    ('margherita', 3, 3 * catalog.get('margherita').amount_cents),
+                    ('diavola', 1, catalog.get('diavola').amount_cents)]:
+                self.log_test("Cart Checkout", "FAIL", "Wrong cart transaction", transaction)
+                return False
+
+            rejected = [
+                self.call('checkout', {'items': items, 'origin_url': 'http://localhost:3000'}).get('error', '')
+                for items in (
+                    [{'package_id': 'margherita', 'quantity': 0}],
+                    [{'package_id': 'margherita', 'quantity': '2'}],
+                    [{'package_id': 'test_free', 'quantity': 1}, {'package_id': 'diavola', 'quantity': 1}],
+                    [{'package_id': 'margherita', 'quantity': 1}, {'package_id': 'invalid_pizza', 'quantity': 1}],
+                )
+            ]
+            if not all(rejected):
+                self.log_test("Cart Checkout", "FAIL", "Invalid cart accepted", rejected)
+                return False
+
+            self.log_test("Cart Checkout", "PASS", f"4 pizzas in one session and one transaction ({expected / 100:.2f} EUR)")
+            return True
+
+        except Exception as e:
+            self.log_test("Cart Checkout", "FAIL", f"Cart checkout failed: {str(e)}")
+            return False
+
+    def test_amounts_from_catalog(self):
+        """Test every package is charged its catalog price, whatever the client sends"""
+        try:
+            wrong = {}
+            for package_id, package in get_catalog(self.settings).packages.items():
+                if package.is_test:
+                    continue
+                data = self.call('checkout', {
+                    'package_id': package_id,
+                    'origin_url': 'http://localhost:3000',
+                    'amount': 0.01,
+                    'metadata': {}
+                })
+                _, session = self.standin.retrieve_session(data['session_id'])
+                if session['amount_total'] != package.amount_cents:
+                    wrong[package_id] = session['amount_total']
+
+            if wrong:
+                self.log_test("Amounts From Catalog", "FAIL", "Stripe sessions with wrong amounts", wrong)
+                return False
+            self.log_test("Amounts From Catalog", "PASS", "All packages charged at their catalog price")
+            return True
+
+        except Exception as e:
+            self.log_test("Amounts From Catalog", "FAIL", f"Checkout failed: {str(e)}")
+            return False
+
+    def test_free_pizza_without_stripe(self):
+        """Test the free test pizza is confirmed without any Stripe call"""
+        try:
+            before = self.standin.stats()
+            data = self.checkout('test_free')
+            status = self.call('status', {'session_id': data.get('session_id')})
+            after = self.standin.stats()
+
+            if data.get('status') != 'test_success' or status.get('status') != 'test_success':
+                self.log_test("Free Test Pizza", "FAIL", "Unexpected test pizza responses", [data, status])
+                return False
+            if after['sessions_created'] != before['sessions_created'] or \
+                    after['sessions_retrieved'] != before['sessions_retrieved']:
+                self.log_test("Free Test Pizza", "FAIL", "Stripe was called for the test pizza", after)
+                return False
+
+            self.log_test("Free Test Pizza", "PASS", "Confirmed and reported without calling Stripe")
+            return True
+
+        except Exception as e:
+            self.log_test("Free Test Pizza", "FAIL", f"Test pizza failed: {str(e)}")
+            return False
+
+    def test_status_open_session(self):
+        """Test the status of a session nobody has paid yet"""
+        try:
+            session_id = self.checkout('diavola')['session_id']
+            status = self.call('status', {'session_id': session_id})
+            if status.get('status') == 'open' and status.get('payment_status') == 'unpaid':
+                self.log_test("Status Open Session", "PASS", "Unpaid session reported open")
+                return True
+            self.log_test("Status Open Session", "FAIL", "Unexpected status", status)
+            return False
+
+        except Exception as e:
+            self.log_test("Status Open Session", "FAIL", f"Status check failed: {str(e)}")
+            return False
+
+    def test_webhook_marks_paid(self):
+        """Test a signed webhook is queued, applied and reflected in the status"""
+        try:
+            session_id = self.checkout('prosciutto')['session_id']
+            _, _, result = self.deliver_payment(session_id)
+            self.drain_webhooks()
+            transaction = self.stored(session_id)
+            status = self.call('status', {'session_id': session_id})
+
+            if not result.get('received'):
+                self.log_test("Webhook Marks Paid", "FAIL", "Webhook rejected", result)
+                return False
+            if transaction.get('payment_status') != 'paid' or 'completed_at' not in transaction:
+                self.log_test("Webhook Marks Paid", "FAIL", "Transaction not updated", transaction)
+                return False
+            if status.get('payment_status') != 'paid':
+                self.log_test("Webhook Marks Paid", "FAIL", "Status not paid", status)
+                return False
+
+            self.log_test("Webhook Marks Paid", "PASS", "Webhook applied, transaction and status paid")
+            return True
+
+        except Exception as e:
+            self.log_test("Webhook Marks Paid", "FAIL", f"Webhook flow failed: {str(e)}")
+            return False
+
+    def test_webhook_redelivery(self):
+        """Test a redelivered webhook is dropped by the event ledger"""
+        try:
+            session_id = self.checkout('vegetariana')['session_id']
+            body, signature, _ = self.deliver_payment(session_id)
+            self.drain_webhooks()
+            duplicates = self.consumer.ledger.stats()['duplicates']
+
+            self.call('webhook', {'body': body, 'signature': signature})
+            self.drain_webhooks()
+
+            if self.consumer.ledger.stats()['duplicates'] != duplicates + 1:
+                self.log_test("Webhook Redelivery", "FAIL", "Redelivery not detected", self.consumer.ledger.stats())
+                return False
+            self.log_test("Webhook Redelivery", "PASS", "Redelivered event dropped before any write")
+            return True
+
+        except Exception as e:
+            self.log_test("Webhook Redelivery", "FAIL", f"Webhook flow failed: {str(e)}")
+            return False
+
+    def test_daily_rollup_counts_once(self):
+        """Test a paid order is added to the daily rollup once, by status check or webhook"""
+        try:
+            rollups = self.pool.database['daily_rollups']
+            key = {'date': datetime.now(timezone.utc).date().isoformat(), 'package_id': 'diavola',
+                   'source': 'lucky_pizza_lannilis'}
+            before = rollups.find_one(key) or {'orders': 0, 'amount_cents': 0}
+
+            # The status check sees the payment first, then the webhook lands
+            session_id = self.checkout('diavola')['session_id']
+            self.standin.pay(session_id)
+            self.call('status', {'session_id': session_id})
+            _, session = self.standin.retrieve_session(session_id)
+            body, signature = self.standin.build_event('checkout.session.completed', session)
+            self.call('webhook', {'body': body, 'signature': signature})
+            self.drain_webhooks()
+            after = rollups.find_one(key) or {'orders': 0, 'amount_cents': 0}
+
+            amount_cents = get_catalog(self.settings).get('diavola').amount_cents
+            if (after['orders'] - before['orders'], after['amount_cents'] - before['amount_cents']) != (1, amount_cents):
+                self.log_test("Daily Rollup Counts Once", "FAIL", "Wrong rollup increment",
+                              {'before': before, 'after': after})
+                return False
+            if not self.stored(session_id).get('rolled_up'):
+                self.log_test("Daily Rollup Counts Once", "FAIL", "Transaction not marked as counted")
+                return False
+
+            self.log_test("Daily Rollup Counts Once", "PASS", "One order added once to today's diavola rollup")
+            return True
+
+        except Exception as e:
+            self.log_test("Daily Rollup Counts Once", "FAIL", f"Rollup check failed: {str(e)}")
+            return False
+
+    def test_rebuild_matches_incremental_rollups(self):
+        """Test the rebuild aggregation gives the rollups record_paid built (needs a real MongoDB)"""
+        database = self.mongo_database()
+        if database is None:
+            self.log_test("Rebuild Matches Rollups", "SKIP", f"No MongoDB at {self.settings.mongo_url}")
+            return True
+        try:
+            def paid_at(day, hour):
+                return datetime(2023, 1, day, hour, 0, tzinfo=timezone.utc)
+
+            line = {'package_id': 'margherita', 'pizza_name': 'Pizza Margherita'}
+            fixture = [
+                {'session_id': 'cs_test_rebuild_cart', 'payment_status': 'paid', 'completed_at': paid_at(2, 12),
+                 'metadata': {'source': 'lucky_pizza_lannilis'}, 'items': [
+                     {**line, 'quantity': 2, 'amount_cents': 2580},
+                     {'package_id': 'diavola', 'pizza_name': 'Pizza Diavola', 'quantity': 1, 'amount_cents': 1590},
+                 ]},
+                {'session_id': 'cs_test_rebuild_single', 'payment_status': 'paid', 'completed_at': paid_at(2, 23),
+                 'metadata': {'source': 'lucky_pizza_lannilis'}, 'items': [{**line, 'quantity': 1, 'amount_cents': 1290}]},
+                # Before carts and UTC dates: one line from package_id, day from the string
+                {'session_id': 'cs_test_rebuild_legacy', 'payment_status': 'paid', 'package_id': 'diavola',
+                 'pizza_name': 'Pizza Diavola', 'amount_cents': 1590, 'updated_at': '2023-01-03T09:30:00',
+                 'created_at': '2023-01-03T09:00:00', 'metadata': {}},
+                {'session_id': 'cs_test_rebuild_unpaid', 'payment_status': 'pending', 'completed_at': paid_at(3, 8),
+                 'metadata': {}, 'items': [{**line, 'quantity': 1, 'amount_cents': 1290}]},
+                {'session_id': 'cs_test_rebuild_free', 'payment_status': 'completed_test', 'test_mode': True,
+                 'completed_at': paid_at(3, 8), 'metadata': {}, 'package_id': 'test_free', 'amount_cents': 0},
+            ]
+
+            self.pool.database[db.TRANSACTIONS_COLLECTION].insert_many([dict(t) for t in fixture])
+            self.loop.run_until_complete(record_paid([t['session_id'] for t in fixture]))
+            incremental = self.pool.database[db.ROLLUPS_COLLECTION].find({'date': {'$gte': '2023-01-01', '$lt': '2023-02-01'}})
+
+            # The rebuild reads both collections: archive part of the fixture
+            database[db.TRANSACTIONS_COLLECTION].insert_many([dict(t) for t in fixture[::2]])
+            database[db.ARCHIVE_COLLECTION].insert_many([dict(t) for t in fixture[1::2]])
+            database[db.TRANSACTIONS_COLLECTION].aggregate(REBUILD_PIPELINE)
+            rebuilt = database[db.ROLLUPS_COLLECTION].find({})
+
+            def rows(rollups):
+                return sorted(
+                    (r['date'], r['package_id'], r['source'], r['orders'], r['quantity'], r['amount_cents'],
+                     r['pizza_name'])
+                    for r in rollups
+                )
+
+            incremental, rebuilt = rows(incremental), rows(rebuilt)
+            if incremental == rebuilt and len(rebuilt) == 3:
+                self.log_test("Rebuild Matches Rollups", "PASS", f"{len(rebuilt)} rollups rebuilt as counted")
+                return True
+            self.log_test("Rebuild Matches Rollups", "FAIL", "Rebuilt rollups differ",
+                          {'incremental': incremental, 'rebuilt': rebuilt})
+            return False
+
+        except Exception as e:
+            self.log_test("Rebuild Matches Rollups", "FAIL", f"Rollup rebuild failed: {str(e)}")
+            return False
+
+    def test_webhook_invalid_signature(self):
+        """Test webhooks with a bad signature are rejected"""
+        try:
+            session_id = self.checkout('napoletana')['session_id']
+            _, session = self.standin.retrieve_session(session_id)
+            body, _ = self.standin.build_event('checkout.session.completed', session)
+            result = self.call('webhook', {'body': body, 'signature': 't=1,v1=deadbeef'})
+
+            if 'error' in result:
+                self.log_test("Webhook Invalid Signature", "PASS", "Forged webhook rejected")
+                return True
+            self.log_test("Webhook Invalid Signature", "FAIL", "Forged webhook accepted", result)
+            return False
+
+        except Exception as e:
+            self.log_test("Webhook Invalid Signature", "FAIL", f"Webhook check failed: {str(e)}")
+            return False
+
+    def test_framed_webhook_bytes(self):
+        """Test webhook bytes cross the socket framing untouched and still verify"""
+        try:
+            session_id = self.checkout('margherita')['session_id']
+            self.standin.pay(session_id)
+            _, session = self.standin.retrieve_session(session_id)
+            # Unescaped UTF-8 with a line break: neither may be re-encoded or split on the way
+            event = {'id': f'evt_framed_{session_id}', 'object': 'event', 'type': 'checkout.session.completed',
+                     'created': int(time.time()),
+                     'data': {'object': {**session, 'metadata': {'customer_name': 'Zoé\nLe Gall'}}}}
+            body = json.dumps(event, ensure_ascii=False, indent=1).encode()
+            signature = sign_payload(body, self.standin.webhook_secret)
+
+            async def roundtrip(data):
+                reader = asyncio.StreamReader()
+                reader.feed_data(data)
+                reader.feed_eof()
+                return await read_message(reader)
+
+            frame = encode({'action': 'webhook', 'payload': {'signature': signature}, 'body': body})
+            request = self.loop.run_until_complete(roundtrip(frame))
+            result = self.loop.run_until_complete(dispatch(request, self.settings))
+            try:
+                self.loop.run_until_complete(roundtrip(frame[:-1]))
+                truncated = 'accepted'
+            except ValueError:
+                truncated = 'rejected'
+
+            if request['body'] == body and result.get('received') and truncated == 'rejected':
+                self.log_test("Framed Webhook Bytes", "PASS", f"{len(body)} raw bytes verified, truncated frame rejected")
+                return True
+            self.log_test("Framed Webhook Bytes", "FAIL", "Frame altered the webhook",
+                          {'result': result, 'same_bytes': request['body'] == body, 'truncated': truncated})
+            return False
+
+        except Exception as e:
+            self.log_test("Framed Webhook Bytes", "FAIL", f"Framing check failed: {str(e)}")
+            return False
+
+    def test_stripe_connection_reuse(self):
+        """Test status lookups share one keep-alive connection to Stripe"""
+        from payment_service import stripe_client
+
+        # A server of its own: the connection count starts from zero
+        server = make_server('127.0.0.1', 0, '', self.standin.webhook_secret)
+        # Short poll: shutdown() waits for it
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        # Installed first, or installing it later would reset api_base
+        stripe_client.install_http_client(self.settings)
+        api_base = stripe_client.stripe.api_base
+        stripe_client.stripe.api_base = server.standin.base_url
+        try:
+            _, session = server.standin.create_session({'line_items': [
+                {'price_data': {'currency': 'eur', 'unit_amount': 1290}, 'quantity': 1}
+            ]})
+            lookups = 20
+            before = stripe_client.connection_stats()
+            responses = [self.call('status', {'session_id': session['id']}) for _ in range(lookups)]
+            after = stripe_client.connection_stats()
+            requests_sent = after['requests'] - before['requests']
+            connections = after['connections'] - before['connections']
+            reused = requests_sent - connections
+
+            if (all(r.get('payment_status') == 'unpaid' for r in responses) and requests_sent == lookups
+                    and connections == 1 and reused == lookups - 1):
+                self.log_test("Stripe Connection Reuse", "PASS", f"{lookups} lookups over 1 connection")
+                return True
+            self.log_test("Stripe Connection Reuse", "FAIL", "Connections not reused",
+                          {'requests': requests_sent, 'connections': connections, 'response': responses[0]})
+            return False
+
+        except Exception as e:
+            self.log_test("Stripe Connection Reuse", "FAIL", f"Connection check failed: {str(e)}")
+            return False
+        finally:
+            stripe_client.stripe.api_base = api_base
+            server.shutdown()
+            server.server_close()
+            server.standin.close()
+
+    def test_webhook_wakes_watch(self):
+        """Test a webhook answers a waiting watch request without asking Stripe"""
+        try:
+            session_id = self.checkout('diavola')['session_id']
+            bus = StatusBus()
+            consumer = WebhookConsumer(self.settings, bus)
+            lookups = []
+
+            async def lookup(session_id):
+                lookups.append(session_id)
+                return await dispatch({'action': 'status', 'payload': {'session_id': session_id}}, self.settings)
+
+            async def scenario():
+                watch = asyncio.create_task(watch_status(
+                    bus, {'session_id': session_id, 'timeout_ms': 5000}, self.settings, lookup
+                ))
+                await asyncio.sleep(0.01)
+                waiting = not watch.done() and bus.watchers() == 1
+
+                self.standin.pay(session_id)
+                _, session = self.standin.retrieve_session(session_id)
+                body, signature = self.standin.build_event('checkout.session.completed', session)
+                await dispatch({'action': 'webhook', 'payload': {'body': body, 'signature': signature}}, self.settings)
+                started = time.monotonic()
+                await consumer.drain_once()
+                return waiting, await watch, time.monotonic() - started
+
+            waiting, response, elapsed = self.loop.run_until_complete(scenario())
+
+            if waiting and response.get('payment_status') == 'paid' and not lookups and bus.watchers() == 0:
+                self.log_test("Webhook Wakes Watch", "PASS", f"Watch answered {elapsed * 1000:.0f}ms after the webhook")
+                return True
+            self.log_test("Webhook Wakes Watch", "FAIL", "Watch not answered by the webhook",
+                          {'waiting': waiting, 'response': response, 'lookups': lookups})
+            return False
+
+        except Exception as e:
+            self.log_test("Webhook Wakes Watch", "FAIL", f"Watch failed: {str(e)}")
+            return False
+
+    def test_watch_cancelled_on_hangup(self):
+        """Test a watch is cancelled when its client hangs up, and answered when it stays"""
+        try:
+            bus = StatusBus()
+            lookups = []
+
+            async def lookup(session_id):
+                lookups.append(session_id)
+                return {'session_id': session_id, 'status': 'open', 'payment_status': 'unpaid'}
+
+            async def run(request):
+                return await watch_status(bus, request['payload'], self.settings, lookup)
+
+            async def scenario():
+                path = os.path.join(self.workdir, 'watch.sock')
+                server = await asyncio.start_unix_server(lambda r, w: _handle_connection(r, w, run, None), path=path)
+                try:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    writer.write(encode({'action': 'watch', 'payload': {'session_id': 'cs_test_left', 'timeout_ms': 100}}))
+                    await writer.drain()
+                    await asyncio.sleep(0.02)
+                    watching = bus.watchers()
+                    # The browser leaves before the deadline
+                    writer.close()
+                    await writer.wait_closed()
+                    await asyncio.sleep(0.15)
+                    left = (watching, bus.watchers(), list(lookups))
+
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    writer.write(encode({'action': 'watch', 'payload': {'session_id': 'cs_test_stayed', 'timeout_ms': 50}}))
+                    await writer.drain()
+                    stayed = await read_message(reader)
+                    writer.close()
+                    await writer.wait_closed()
+                    return left, stayed
+                finally:
+                    server.close()
+                    await server.wait_closed()
+
+            (watching, after, left_lookups), stayed = self.loop.run_until_complete(scenario())
+
+            if (watching == 1 and after == 0 and not left_lookups and stayed.get('session_id') == 'cs_test_stayed'
+                    and lookups == ['cs_test_stayed']):
+                self.log_test("Watch Cancelled On Hangup", "PASS", "Abandoned watch cancelled without a Stripe lookup")
+                return True
+            self.log_test("Watch Cancelled On Hangup", "FAIL", "Abandoned watch kept running",
+                          {'watching': watching, 'after': after, 'lookups': lookups, 'stayed': stayed})
+            return False
+
+        except Exception as e:
+            self.log_test("Watch Cancelled On Hangup", "FAIL", f"Watch check failed: {str(e)}")
+            return False
+
+    def test_worker_pool_dispatch(self):
+        """Test requests go to the least-loaded worker and workers are recycled after max requests"""
+        settings = replace(self.settings, workers=2, worker_concurrency=1, worker_max_requests=2, queue_size=8)
+        storage = os.environ.get('PAYMENT_STORAGE')
+        # Workers load their settings from the environment
+        os.environ['PAYMENT_STORAGE'] = 'memory'
+        pool = WorkerPool(settings)
+        try:
+            async def scenario():
+                await pool.start()
+                started = [w.process for w in pool._workers]
+                request = {'action': 'process_stats'}
+                concurrent = await asyncio.gather(pool.submit(request), pool.submit(request))
+                # Each worker takes its second and last request, then a replacement the third
+                sequential = [await pool.submit(request) for _ in range(3)]
+                exits = await asyncio.gather(*(process.wait() for process in started))
+                return [r['pid'] for r in concurrent], [r['pid'] for r in sequential], exits
+
+            concurrent, sequential, exits = self.loop.run_until_complete(asyncio.wait_for(scenario(), 30))
+            served = Counter(concurrent + sequential)
+
+            if (len(set(concurrent)) == 2 and max(served.values()) == 2 and sequential[-1] not in concurrent
+                    and exits == [0, 0]):
+                self.log_test("Worker Pool Dispatch", "PASS",
+                              "Concurrent requests spread over 2 workers, recycled after 2 requests each")
+                return True
+            self.log_test("Worker Pool Dispatch", "FAIL", "Unexpected dispatch",
+                          {'concurrent': concurrent, 'sequential': sequential, 'exits': exits, 'pool': pool.stats()})
+            return False
+
+        except Exception as e:
+            self.log_test("Worker Pool Dispatch", "FAIL", f"Worker pool failed: {str(e)}")
+            return False
+        finally:
+            self.loop.run_until_complete(pool.close())
+            if storage is None:
+                del os.environ['PAYMENT_STORAGE']
+            else:
+                os.environ['PAYMENT_STORAGE'] = storage
+
+    def test_worker_crash_backoff(self):
+        """Test crashing workers are restarted with backoff, refused quickly, and recover once fixed"""
+        settings = replace(
+            self.settings, workers=2, worker_restart_delay=0.05, worker_restart_max_delay=0.1,
+            worker_crash_limit=4, worker_crash_window=30.0,
+        )
+        environ = {key: os.environ.get(key) for key in ('PAYMENT_STORAGE', 'PAYMENT_CATALOG')}
+        os.environ['PAYMENT_STORAGE'] = 'memory'
+        # Every worker dies at start-up
+        os.environ['PAYMENT_CATALOG'] = os.path.join(self.workdir, 'missing-catalog.json')
+        pool = WorkerPool(settings)
+        spawns = []
+        spawn = pool._spawn
+
+        async def flaky_spawn(slot):
+            spawns.append(slot)
+            if len(spawns) == 3:
+                raise OSError('fork failed')
+            return await spawn(slot)
+
+        pool._spawn = flaky_spawn
+        try:
+            async def scenario():
+                await pool.start()
+                while not pool._crash_looping():
+                    await asyncio.sleep(0.01)
+                started = time.monotonic()
+                try:
+                    await pool.submit({'action': 'health'})
+                    refused = None
+                except ServiceBusy:
+                    refused = time.monotonic() - started
+                failures = list(pool._failures)
+
+                os.environ['PAYMENT_CATALOG'] = catalog.DEFAULT_CATALOG_PATH
+                while True:
+                    # Refused until a restarted slot has a worker again
+                    try:
+                        recovered = await pool.submit({'action': 'health'})
+                        break
+                    except (ServiceBusy, ConnectionError):
+                        await asyncio.sleep(0.05)
+                return refused, failures, recovered, list(pool._failures)
+
+            refused, failures, recovered, healthy = self.loop.run_until_complete(asyncio.wait_for(scenario(), 30))
+            slots = Counter(spawns)
+
+            if (refused is not None and refused < 0.1 and min(failures) >= 1 and sum(failures) >= 4
+                    and slots[0] >= 2 and slots[1] >= 2 and recovered == {'mongo': True} and 0 in healthy):
+                self.log_test("Worker Crash Backoff", "PASS",
+                              f"{len(spawns)} starts over 2 slots, refused in {refused * 1000:.1f}ms, recovered")
+                return True
+            self.log_test("Worker Crash Backoff", "FAIL", "Unexpected restart behaviour",
+                          {'refused': refused, 'failures': failures, 'spawns': spawns, 'recovered': recovered})
+            return False
+
+        except Exception as e:
+            self.log_test("Worker Crash Backoff", "FAIL", f"Worker restarts failed: {str(e)}")
+            return False
+        finally:
+            self.loop.run_until_complete(pool.close())
+            for key, value in environ.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+    def test_status_coalescing(self):
+        """Test concurrent status checks of one session share a single Stripe lookup"""
+        try:
+            session_id = self.checkout('napoletana')['session_id']
+            flights = SingleFlight()
+            request = {'action': 'status', 'payload': {'session_id': session_id}}
+
+            async def scenario():
+                return await asyncio.gather(*(
+                    flights.do(session_id, lambda: dispatch(request, self.settings)) for _ in range(5)
+                ))
+
+            retrieved = self.standin.stats()['sessions_retrieved']
+            self.standin.latency_ms = 50
+            try:
+                responses = self.loop.run_until_complete(scenario())
+            finally:
+                self.standin.latency_ms = 0
+            lookups = self.standin.stats()['sessions_retrieved'] - retrieved
+
+            if (lookups == 1 and flights.calls == 1 and flights.shared == 4
+                    and all(r == responses[0] for r in responses) and responses[0]['payment_status'] == 'unpaid'):
+                self.log_test("Status Coalescing", "PASS", "5 concurrent checks, 1 Stripe lookup")
+                return True
+            self.log_test("Status Coalescing", "FAIL", "Status checks not coalesced",
+                          {'lookups': lookups, 'calls': flights.calls, 'shared': flights.shared, 'response': responses[0]})
+            return False
+
+        except Exception as e:
+            self.log_test("Status Coalescing", "FAIL", f"Coalescing failed: {str(e)}")
+            return False
+
+    def test_status_cache_ttl(self):
+        """Test open sessions are cached for the TTL and paid ones until evicted"""
+        process_cache = cache._cache
+        now = [0.0]
+        cache._cache = cache.StatusCache(2.0, 100, clock=lambda: now[0])
+        try:
+            open_id = self.checkout('margherita')['session_id']
+            paid_id = self.checkout('diavola')['session_id']
+            self.deliver_payment(paid_id)
+            self.drain_webhooks()
+
+            def lookups(session_id, times):
+                retrieved = self.standin.stats()['sessions_retrieved']
+                responses = [self.call('status', {'session_id': session_id}) for _ in range(times)]
+                return self.standin.stats()['sessions_retrieved'] - retrieved, responses[-1]
+
+            within_ttl, _ = lookups(open_id, 3)
+            self.call('status', {'session_id': paid_id})
+            now[0] += 2.5
+            expired, _ = lookups(open_id, 1)
+            paid, paid_response = lookups(paid_id, 3)
+
+            if within_ttl == 1 and expired == 1 and paid == 0 and paid_response['payment_status'] == 'paid':
+                self.log_test("Status Cache TTL", "PASS", "Open session refetched after the TTL, paid one kept")
+                return True
+            self.log_test("Status Cache TTL", "FAIL", "Unexpected Stripe lookups",
+                          {'within_ttl': within_ttl, 'expired': expired, 'paid': paid, 'response': paid_response})
+            return False
+
+        except Exception as e:
+            self.log_test("Status Cache TTL", "FAIL", f"Status cache failed: {str(e)}")
+            return False
+        finally:
+            cache._cache = process_cache
+
+    def test_reconcile_pending(self):
+        """Test the reconcile sweep marks sessions paid on Stripe and leaves open ones pending"""
+        try:
+            paid_id = self.checkout('margherita')['session_id']
+            open_id = self.checkout('napoletana')['session_id']
+            # Paid on Stripe, but the webhook never arrived
+            self.standin.pay(paid_id)
+
+            first = self.loop.run_until_complete(reconcile_pending(self.settings, older_than=0, max_rate=0))
+            paid, pending = self.stored(paid_id), self.stored(open_id)
+            second = self.loop.run_until_complete(reconcile_pending(self.settings, older_than=0, max_rate=0))
+
+            if (paid['payment_status'] == 'paid' and paid.get('completed_at') and pending['payment_status'] == 'pending'
+                    and first['updated'] >= 1 and first['failed'] == 0 and second['updated'] == 0):
+                self.log_test("Reconcile Pending", "PASS",
+                              f"Paid session synced, {first['processed']} pending transactions checked")
+                return True
+            self.log_test("Reconcile Pending", "FAIL", "Unexpected reconcile result",
+                          {'paid': paid, 'pending': pending, 'first': first, 'second': second})
+            return False
+
+        except Exception as e:
+            self.log_test("Reconcile Pending", "FAIL", f"Reconcile failed: {str(e)}")
+            return False
+
+    def test_catalog_hot_reload(self):
+        """Test a changed catalog file is picked up after the check interval, a broken one ignored"""
+        process_catalog = catalog._catalog
+        path = os.path.join(self.workdir, 'catalog.json')
+        with open(catalog.DEFAULT_CATALOG_PATH) as f:
+            document = json.load(f)
+
+        def write(data):
+            with open(path, 'w') as f:
+                f.write(data)
+
+        now = [0.0]
+        try:
+            write(json.dumps(document))
+            catalog._catalog = catalog.Catalog(path, 5.0, clock=lambda: now[0])
+
+            document['version'] += 1
+            document['packages']['margherita']['amount_cents'] = 1390
+            write(json.dumps(document))
+            before = self.checkout('margherita').get('amount')
+            now[0] += 5.0
+            after = self.checkout('margherita').get('amount')
+            write('{"packages": ')
+            now[0] += 5.0
+            broken = self.checkout('margherita').get('amount')
+
+            if before == 12.90 and after == 13.90 and broken == 13.90 and catalog._catalog.version == document['version']:
+                self.log_test("Catalog Hot Reload", "PASS", "New price served after the check, broken file ignored")
+                return True
+            self.log_test("Catalog Hot Reload", "FAIL", "Unexpected catalog prices",
+                          {'before': before, 'after': after, 'broken': broken})
+            return False
+
+        except Exception as e:
+            self.log_test("Catalog Hot Reload", "FAIL", f"Catalog reload failed: {str(e)}")
+            return False
+        finally:
+            catalog._catalog = process_catalog
+
+    def test_catalog_without_reload(self):
+        """Test a check interval of 0 loads the catalog once and never re-reads it"""
+        process_catalog = catalog._catalog
+        path = os.path.join(self.workdir, 'catalog-static.json')
+        with open(catalog.DEFAULT_CATALOG_PATH) as f:
+            document = json.load(f)
+        try:
+            with open(path, 'w') as f:
+                json.dump(document, f)
+            catalog._catalog = catalog.Catalog(path, 0)
+            reloads = []
+            reload = catalog._catalog.reload
+            catalog._catalog.reload = lambda: reloads.append(1) or reload()
+
+            document['packages']['margherita']['amount_cents'] = 1390
+            with open(path, 'w') as f:
+                json.dump(document, f)
+            amounts = [self.checkout('margherita').get('amount') for _ in range(5)]
+
+            if amounts == [12.90] * 5 and not reloads:
+                self.log_test("Catalog Without Reload", "PASS", "5 checkouts priced from the catalog loaded at start")
+                return True
+            self.log_test("Catalog Without Reload", "FAIL", "Catalog re-read with a 0 interval",
+                          {'amounts': amounts, 'reloads': len(reloads)})
+            return False
+
+        except Exception as e:
+            self.log_test("Catalog Without Reload", "FAIL", f"Catalog check failed: {str(e)}")
+            return False
+        finally:
+            catalog._catalog = process_catalog
+
+    def test_breaker_serves_stale_status(self):
+        """Test slow Stripe calls open the breaker and status falls back to MongoDB, marked stale"""
+        process_breaker = breaker._breaker
+        breaker._breaker = breaker.CircuitBreaker(replace(
+            self.settings, breaker_window=2, breaker_min_calls=2, breaker_failure_rate=1.0, breaker_slow_call=0.02,
+            breaker_open_seconds=0.1,
+        ))
+        try:
+            session_id = self.checkout('margherita')['session_id']
+            self.standin.latency_ms = 50
+            try:
+                slow = [self.call('status', {'session_id': session_id}) for _ in range(2)]
+                retrieved = self.standin.stats()['sessions_retrieved']
+                stale = self.call('status', {'session_id': session_id})
+                untouched = self.standin.stats()['sessions_retrieved'] == retrieved
+            finally:
+                self.standin.latency_ms = 0
+            time.sleep(0.1)
+            probed = self.call('status', {'session_id': session_id})
+            counters = self.call('process_stats', {})['breaker']
+
+            if (not any(r.get('stale') for r in slow) and stale.get('stale') and untouched
+                    and stale['payment_status'] == 'pending' and 'stale' not in probed
+                    and counters['state'] == 'closed' and counters['opened'] == 1 and counters['stale_served'] == 1):
+                self.log_test("Breaker Stale Status", "PASS", "Open breaker served the stored status, probe closed it")
+                return True
+            self.log_test("Breaker Stale Status", "FAIL", "Unexpected breaker behaviour",
+                          {'stale': stale, 'probed': probed, 'breaker': counters, 'untouched': untouched})
+            return False
+
+        except Exception as e:
+            self.log_test("Breaker Stale Status", "FAIL", f"Breaker check failed: {str(e)}")
+            return False
+        finally:
+            breaker._breaker = process_breaker
+
+    def test_breaker_ignores_bad_sessions(self):
+        """Test unknown session ids never open the breaker, while Stripe 5xx answers still do"""
+        process_breaker = breaker._breaker
+        breaker._breaker = breaker.CircuitBreaker(replace(
+            self.settings, breaker_window=2, breaker_min_calls=2, breaker_failure_rate=1.0, breaker_open_seconds=30.0
+        ))
+        try:
+            unknown = [self.call('status', {'session_id': f'cs_test_unknown_{i}'}) for i in range(10)]
+            checkout = self.checkout('margherita')
+            after_bad_ids = breaker._breaker.stats()
+
+            self.standin.error_rate, self.standin.retry_errors = 1.0, False
+            try:
+                for _ in range(2):
+                    self.call('status', {'session_id': checkout.get('session_id')})
+            finally:
+                self.standin.error_rate, self.standin.retry_errors = 0.0, True
+
+            if (all('No such checkout.session' in r.get('error', '') for r in unknown) and 'url' in checkout
+                    and after_bad_ids['state'] == 'closed' and after_bad_ids['failures'] == 0
+                    and breaker._breaker.state == 'open'):
+                self.log_test("Breaker Ignores Bad Sessions", "PASS", "10 unknown ids left checkout working, 5xx opened it")
+                return True
+            self.log_test("Breaker Ignores Bad Sessions", "FAIL", "Breaker counted client errors",
+                          {'unknown': unknown[0], 'checkout': checkout, 'after_bad_ids': after_bad_ids,
+                           'breaker': breaker._breaker.stats()})
+            return False
+
+        except Exception as e:
+            self.log_test("Breaker Ignores Bad Sessions", "FAIL", f"Breaker check failed: {str(e)}")
+            return False
+        finally:
+            breaker._breaker = process_breaker
+
+    def test_indexes_without_mongo(self):
+        """Test an unreachable MongoDB only warns in development and refuses to start in production"""
+        class Unreachable:
+            def __init__(self, name):
+                self.name = name
+
+            def create_index(self, *args, **kwargs):
+                raise ServerSelectionTimeoutError('127.0.0.1:27017: [Errno 111] Connection refused')
+
+            index_information = create_index
+
+        unreachable = SimpleNamespace(database={name: Unreachable(name) for name in INDEXES})
+        try:
+            missing = ensure_indexes(unreachable, replace(self.settings, production=False))
+            try:
+                ensure_indexes(unreachable, replace(self.settings, production=True))
+                production = 'started'
+            except MissingIndexError:
+                production = 'refused'
+
+            expected = sum(len(specs) for specs in INDEXES.values())
+            if len(missing) == expected and production == 'refused':
+                self.log_test("Indexes Without Mongo", "PASS", f"{expected} indexes reported missing, production refused")
+                return True
+            self.log_test("Indexes Without Mongo", "FAIL", "Unexpected start-up behaviour",
+                          {'missing': missing, 'production': production})
+            return False
+
+        except Exception as e:
+            self.log_test("Indexes Without Mongo", "FAIL", f"Index check crashed: {str(e)}")
+            return False
+
+    def test_stripe_failure(self):
+        """Test a Stripe outage surfaces as an error and records nothing"""
+        try:
+            before = self.loop.run_until_complete(self.pool.transactions.find_all({}))
+            sessions = self.standin.stats()['sessions']
+            self.standin.error_rate, self.standin.retry_errors = 1.0, False
+            try:
+                data = self.checkout('quattro_formaggi')
+            finally:
+                self.standin.error_rate, self.standin.retry_errors = 0.0, True
+            after = self.loop.run_until_complete(self.pool.transactions.find_all({}))
+
+            if 'error' not in data:
+                self.log_test("Stripe Failure", "FAIL", "Checkout succeeded during a Stripe outage", data)
+                return False
+            if len(after) != len(before) or self.standin.stats()['sessions'] != sessions:
+                self.log_test("Stripe Failure", "FAIL", "Failed checkout left a transaction behind",
+                              [t for t in after if t not in before])
+                return False
+
+            self.log_test("Stripe Failure", "PASS", "Checkout reports the Stripe error, nothing recorded")
+            return True
+
+        except Exception as e:
+            self.log_test("Stripe Failure", "FAIL", f"Checkout failed: {str(e)}")
+            return False
+
+    def test_write_behind_journal_replay(self):
+        """Test journalled transactions survive a lost buffer and replay once"""
+        try:
+            settings = replace(
+                self.settings,
+                transaction_durability='journal',
+                transaction_journal_path=os.path.join(self.workdir, 'transaction-journal.db'),
+                transaction_flush_interval=60.0,
+            )
+            document = {'session_id': 'cs_test_journal', 'package_id': 'margherita', 'payment_status': 'pending'}
+
+            # The writer "crashes" before its flush: only the journal has the transaction
+            writer = TransactionWriter(settings)
+            self.loop.run_until_complete(writer.submit(dict(document)))
+            if self.stored('cs_test_journal') or writer.journal.depth() != 1:
+                self.log_test("Write-Behind Journal Replay", "FAIL", "Transaction not held in the journal")
+                return False
+
+            replayed = self.loop.run_until_complete(replay_journal(settings))
+            writer.journal.append(dict(document))
+            replayed_again = self.loop.run_until_complete(replay_journal(settings))
+            # The writer's own flush of the same transaction is a duplicate too
+            self.loop.run_until_complete(writer.close())
+            transaction = self.stored('cs_test_journal')
+            count = self.pool.database[db.TRANSACTIONS_COLLECTION].count_documents({'session_id': 'cs_test_journal'})
+
+            if (replayed, replayed_again, count) != (1, 1, 1) or writer.journal.depth() != 0:
+                self.log_test("Write-Behind Journal Replay", "FAIL", "Replay not idempotent",
+                              {'replayed': [replayed, replayed_again], 'count': count})
+                return False
+            if transaction['payment_status'] != 'pending':
+                self.log_test("Write-Behind Journal Replay", "FAIL", "Wrong replayed transaction", transaction)
+                return False
+
+            self.log_test("Write-Behind Journal Replay", "PASS", "Journalled transaction replayed exactly once")
+            return True
+
+        except Exception as e:
+            self.log_test("Write-Behind Journal Replay", "FAIL", f"Journal replay failed: {str(e)}")
+            return False
+
+    def test_write_behind_overlapping_flushes(self):
+        """Test two overlapping flushes write every buffered transaction"""
+        original_insert = write_behind.insert_transactions
+
+        delays = [0.05]
+
+        async def slow_insert(documents):
+            # The first batch is slow: another flush and new submissions run meanwhile
+            await asyncio.sleep(delays.pop() if delays else 0.001)
+            await original_insert(documents)
+
+        write_behind.insert_transactions = slow_insert
+        try:
+            settings = replace(self.settings, transaction_durability='async', transaction_flush_interval=60.0)
+            writer = TransactionWriter(settings)
+            session_ids = [f'cs_test_overlap_{name}' for name in 'abcd']
+
+            async def scenario():
+                await writer.submit({'session_id': session_ids[0], 'payment_status': 'pending'})
+                await writer.submit({'session_id': session_ids[1], 'payment_status': 'pending'})
+                first = asyncio.create_task(writer.flush())
+                await asyncio.sleep(0)
+                await writer.submit({'session_id': session_ids[2], 'payment_status': 'pending'})
+                # The webhook consumer flushes while the flusher task is still inserting its batch
+                await writer.flush()
+                await writer.submit({'session_id': session_ids[3], 'payment_status': 'pending'})
+                await first
+                await writer.close()
+
+            self.loop.run_until_complete(scenario())
+            buffered = writer.stats()['buffered']
+            stored = [sid for sid in session_ids if self.stored(sid)]
+
+            if stored == session_ids and buffered == 0 and writer.flushed == 4:
+                self.log_test("Write-Behind Overlapping Flushes", "PASS", "All 4 transactions written once")
+                return True
+            self.log_test("Write-Behind Overlapping Flushes", "FAIL", "Transactions lost between flushes",
+                          {'stored': stored, 'buffered': buffered, 'flushed': writer.flushed})
+            return False
+
+        except Exception as e:
+            self.log_test("Write-Behind Overlapping Flushes", "FAIL", f"Overlapping flushes failed: {str(e)}")
+            return False
+        finally:
+            write_behind.insert_transactions = original_insert
+
+    def test_archive_status_fallback(self):
+        """Test settled transactions move to the archive and their status is still served"""
+        try:
+            old = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+            base = {'package_id': 'margherita', 'pizza_name': 'Pizza Margherita', 'amount': 12.9,
+                    'amount_cents': 1290, 'currency': 'EUR', 'metadata': {}, 'created_at': old, 'updated_at': old}
+            paid = {**base, 'session_id': 'cs_test_archived_paid', 'payment_status': 'paid', 'status': 'complete'}
+            pending = {**base, 'session_id': 'cs_test_archived_pending', 'payment_status': 'pending',
+                       'status': 'initiated'}
+            hot = self.pool.database[db.TRANSACTIONS_COLLECTION]
+            archive = self.pool.database[db.ARCHIVE_COLLECTION]
+            hot.insert_many([dict(paid), dict(pending)])
+            # A previous run copied this one but stopped before deleting it
+            copied = {**base, 'session_id': 'cs_test_archived_expired', 'payment_status': 'unpaid',
+                      'status': 'expired'}
+            hot.insert_one(dict(copied))
+            archive.insert_one(dict(copied))
+            free = {**base, 'session_id': 'cs_test_free_archived', 'payment_status': 'completed_test',
+                    'status': 'test_success', 'test_mode': True}
+            hot.insert_one(dict(free))
+
+            stats = self.loop.run_until_complete(archive_settled(self.settings, older_than=365 * 86400))
+            again = self.loop.run_until_complete(archive_settled(self.settings, older_than=365 * 86400))
+            status = self.call('status', {'session_id': 'cs_test_archived_paid'})
+
+            if (stats['archived'], again['archived']) != (3, 0):
+                self.log_test("Archive Status Fallback", "FAIL", "Wrong archival counts", [stats, again])
+                return False
+            if hot.find_one({'session_id': 'cs_test_archived_paid'}) or not hot.find_one(
+                    {'session_id': 'cs_test_archived_pending'}):
+                self.log_test("Archive Status Fallback", "FAIL", "Wrong documents left in the hot collection")
+                return False
+            archived = {'$in': ['cs_test_archived_paid', 'cs_test_archived_expired', 'cs_test_free_archived']}
+            if archive.count_documents({'session_id': archived}) != 3:
+                self.log_test("Archive Status Fallback", "FAIL", "Archive missing transactions")
+                return False
+            if status.get('payment_status') != 'paid' or status.get('amount_total') != 1290:
+                self.log_test("Archive Status Fallback", "FAIL", "Archived status not served", status)
+                return False
+
+            self.log_test("Archive Status Fallback", "PASS", "Settled transactions archived once, status served")
+            return True
+
+        except Exception as e:
+            self.log_test("Archive Status Fallback", "FAIL", f"Archival failed: {str(e)}")
+            return False
+
+    def test_archive_query_plan(self):
+        """Test MongoDB answers the archival query with index range scans (needs a real MongoDB)"""
+        database = self.mongo_database()
+        if database is None:
+            self.log_test("Archive Query Plan", "SKIP", f"No MongoDB at {self.settings.mongo_url}")
+            return True
+        try:
+            missing = ensure_indexes(SimpleNamespace(database=database), self.settings)
+            old = datetime(2024, 3, 1, 12, 0, tzinfo=timezone.utc)
+            recent = datetime.now(timezone.utc)
+            transactions = database[db.TRANSACTIONS_COLLECTION]
+            transactions.insert_many([
+                # Every other round of the four states is old: 25 of each
+                {'session_id': f'cs_test_plan_{i}', 'updated_at': old if i // 4 % 2 else recent, **state}
+                for i, state in enumerate([
+                    {'payment_status': 'paid', 'status': 'complete'},
+                    {'payment_status': 'unpaid', 'status': 'expired'},
+                    {'payment_status': 'completed_test', 'status': 'test_success', 'test_mode': True},
+                    {'payment_status': 'pending', 'status': 'initiated'},
+                ] * 50)
+            ])
+            query = settled_before(datetime(2025, 1, 1, tzinfo=timezone.utc))
+            plan = transactions.find(query).explain()['queryPlanner']['winningPlan']
+
+            stages = []
+
+            def walk(node):
+                if isinstance(node, dict):
+                    if 'stage' in node:
+                        stages.append(node['stage'])
+                    for value in node.values():
+                        walk(value)
+                elif isinstance(node, list):
+                    for value in node:
+                        walk(value)
+
+            walk(plan)
+            matched = transactions.count_documents(query)
+
+            if not missing and 'COLLSCAN' not in stages and 'IXSCAN' in stages and matched == 75:
+                self.log_test("Archive Query Plan", "PASS", f"Plan stages: {', '.join(dict.fromkeys(stages))}")
+                return True
+            self.log_test("Archive Query Plan", "FAIL", "Archival query not index-backed",
+                          {'missing': missing, 'stages': stages, 'matched': matched})
+            return False
+
+        except Exception as e:
+            self.log_test("Archive Query Plan", "FAIL", f"Explain failed: {str(e)}")
+            return False
+
+    def test_migrate_timestamps(self):
+        """Test string timestamps are converted to UTC datetimes in batches, once"""
+        try:
+            local = datetime(2025, 6, 1, 9, 30)
+            legacy = [
+                {'session_id': 'cs_test_legacy_local', 'payment_status': 'paid', 'created_at': local.isoformat(),
+                 'updated_at': local.isoformat(), 'completed_at': local.isoformat()},
+                {'session_id': 'cs_test_legacy_offset', 'payment_status': 'pending',
+                 'created_at': '2025-06-01T09:30:00+02:00', 'updated_at': '2025-06-01T09:30:00+02:00'},
+                {'session_id': 'cs_test_legacy_invalid', 'payment_status': 'pending', 'created_at': 'hier'},
+            ]
+            hot = self.pool.database[db.TRANSACTIONS_COLLECTION]
+            hot.insert_many([dict(d) for d in legacy])
+
+            first = self.loop.run_until_complete(migrate_timestamps(self.settings, batch_size=2))
+            second = self.loop.run_until_complete(migrate_timestamps(self.settings, batch_size=2))
+            converted = hot.find_one({'session_id': 'cs_test_legacy_local'})
+            offset = hot.find_one({'session_id': 'cs_test_legacy_offset'})
+            # Range scans on the converted dates now find them
+            window = {'$gte': datetime(2025, 6, 1, tzinfo=timezone.utc),
+                      '$lt': datetime(2025, 6, 1, tzinfo=timezone.utc) + timedelta(days=1)}
+            in_range = {d['session_id'] for d in hot.find({'created_at': window})}
+
+            if (first['converted'] == 2 and first['invalid'] == 1 and second['converted'] == 0
+                    and converted['completed_at'] == local.astimezone(timezone.utc)
+                    and offset['created_at'] == datetime(2025, 6, 1, 7, 30, tzinfo=timezone.utc)
+                    and in_range == {'cs_test_legacy_local', 'cs_test_legacy_offset'}):
+                self.log_test("Migrate Timestamps", "PASS", f"{first['converted']} legacy transactions converted once")
+                return True
+            self.log_test("Migrate Timestamps", "FAIL", "Unexpected conversion",
+                          {'first': first, 'second': second, 'in_range': sorted(in_range)})
+            return False
+
+        except Exception as e:
+            self.log_test("Migrate Timestamps", "FAIL", f"Migration failed: {str(e)}")
+            return False
+        finally:
+            self.pool.database[db.TRANSACTIONS_COLLECTION].delete_many({'session_id': {'$in': [
+                'cs_test_legacy_local', 'cs_test_legacy_offset', 'cs_test_legacy_invalid'
+            ]}})
+
+    def test_export_streams_batches(self):
+        """Test the export writes paid transactions batch by batch, as NDJSON and CSV"""
+        try:
+            today = datetime.now(timezone.utc).date().isoformat()
+            # Paid earlier in this run; the archived ones date from 2024
+            expected = self.pool.database[db.TRANSACTIONS_COLLECTION].count_documents({'payment_status': 'paid'})
+
+            def export(format):
+                chunks = []
+
+                async def write(text):
+                    chunks.append(text)
+
+                stats = self.loop.run_until_complete(export_transactions(
+                    self.settings, write, format=format, since=today, until=today, status='paid', batch_size=1
+                ))
+                return chunks, stats
+
+            ndjson, ndjson_stats = export('ndjson')
+            rows = [json.loads(line) for line in ''.join(ndjson).splitlines()]
+            csv_chunks, csv_stats = export('csv')
+            csv_rows = list(csv.DictReader(io.StringIO(''.join(csv_chunks))))
+
+            if not expected or ndjson_stats['rows'] != expected or len(ndjson) != expected:
+                self.log_test("Export Streams Batches", "FAIL", "Rows not written one batch at a time",
+                              {'expected': expected, 'stats': ndjson_stats, 'chunks': len(ndjson)})
+                return False
+            if any(row['payment_status'] != 'paid' or not row['created_at'].startswith(today) for row in rows):
+                self.log_test("Export Streams Batches", "FAIL", "Export filters not applied", rows)
+                return False
+            if csv_stats['rows'] != expected or len(csv_rows) != expected or tuple(csv_rows[0]) != CSV_FIELDS:
+                self.log_test("Export Streams Batches", "FAIL", "Wrong CSV export", csv_rows[:2])
+                return False
+
+            self.log_test("Export Streams Batches", "PASS",
+                          f"{expected} paid transactions exported as NDJSON and CSV")
+            return True
+
+        except Exception as e:
+            self.log_test("Export Streams Batches", "FAIL", f"Export failed: {str(e)}")
+            return False
+
+    def close(self):
+        self.standin_server.shutdown()
+        self.standin_server.server_close()
+        self.standin.close()
+        db.close_pool()
+        if self.mongo_client:
+            self.mongo_client.drop_database(f'payment_service_test_{os.getpid()}')
+            self.mongo_client.close()
+        self.loop.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run_all_tests(self):
+        """Run all in-process payment service tests"""
+        print("🍕💳 Starting Lucky Pizza Payment Service In-Process Tests")
+        print("=" * 80)
+
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        try:
+            # Checkout tests
+            self.test_checkout_valid_package()
+            self.test_checkout_invalid_package()
+            self.test_amounts_from_catalog()
+            self.test_cart_checkout()
+            self.test_free_pizza_without_stripe()
+
+            # Status and webhook tests
+            self.test_status_open_session()
+            self.test_stripe_connection_reuse()
+            self.test_webhook_marks_paid()
+            self.test_webhook_redelivery()
+            self.test_webhook_invalid_signature()
+            self.test_framed_webhook_bytes()
+            self.test_daily_rollup_counts_once()
+            self.test_rebuild_matches_incremental_rollups()
+            self.test_webhook_wakes_watch()
+            self.test_watch_cancelled_on_hangup()
+            self.test_reconcile_pending()
+
+            # Coalescing, caching, catalog reloads and the worker pool
+            self.test_status_coalescing()
+            self.test_status_cache_ttl()
+            self.test_catalog_hot_reload()
+            self.test_catalog_without_reload()
+            if self.with_workers:
+                self.test_worker_pool_dispatch()
+                self.test_worker_crash_backoff()
+
+            # Write-behind persistence, archival and export
+            self.test_write_behind_journal_replay()
+            self.test_write_behind_overlapping_flushes()
+            self.test_archive_status_fallback()
+            self.test_archive_query_plan()
+            self.test_export_streams_batches()
+            self.test_migrate_timestamps()
+
+            # Failure handling
+            self.test_breaker_serves_stale_status()
+            self.test_breaker_ignores_bad_sessions()
+            self.test_indexes_without_mongo()
+            self.test_stripe_failure()
+        finally:
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu_started
+            self.close()
+
+        # Final summary
+        print("\n" + "=" * 80)
+        print("🏁 Payment Service Test Summary")
+        print("=" * 80)
+
+        total_tests = len(self.test_results)
+        passed_tests = len([t for t in self.test_results if t['status'] == 'PASS'])
+        failed_tests = len([t for t in self.test_results if t['status'] == 'FAIL'])
+
+        print(f"Total Tests: {total_tests}")
+        print(f"✅ Passed: {passed_tests}")
+        print(f"❌ Failed: {failed_tests}")
+        print(f"⏱️  Wall time: {elapsed * 1000:.0f}ms, CPU time: {cpu * 1000:.0f}ms")
+
+        if failed_tests == 0:
+            print("\n🎉 All tests passed! Payment service handlers are working properly.")
+            return True
+        else:
+            print(f"\n❌ {failed_tests} test(s) failed:")
+            for failed_test in self.failed_tests:
+                print(f"   - {failed_test}")
+            return False
+
+if __name__ == "__main__":
+    tester = PaymentServiceTester(with_workers='--workers' in sys.argv)
+    success = tester.run_all_tests()
+    sys.exit(0 if success else 1)